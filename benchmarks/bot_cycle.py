@@ -0,0 +1,510 @@
+"""Time whole bot cycles against a fake letterboxd and a stub discord.
+
+Each scale runs in a fresh process with its own fake letterboxd server (see
+fake_letterboxd.py) and a throwaway sqlite database. Set DATABASE_URL to use
+postgres instead, its tables get dropped. Results are printed as JSON:
+
+    uv run python benchmarks/bot_cycle.py --users 100,1000,10000 --output bench.json
+
+Phases, in order: first diary check (no watermarks yet), delivering what it
+queued, a quiet diary check, a check after 10% of users logged something,
+delivering that, checks until caught up after 10% of users logged 200 films
+during downtime, delivering those, a full watch sync, then /whowatched
+lookups. The clock is
+moved on between checks so cached pages go stale like they would in prod.
+The films table starts out full, a cold film cache is a one-off cost.
+The stub discord rejects messages over its embed limits like the real one.
+Any rejected send or failed user scrape fails the run, the numbers would be
+for work that wasn't all done.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from types import SimpleNamespace
+from typing import Any, cast
+
+import fake_letterboxd
+
+GUILD_ID = 1
+SECOND_GUILD_ID = 2
+USERS_PER_CHANNEL = 10
+# share of users also followed from a second server
+SHARED_USERS = 0.1
+ACTIVE_USERS = 0.1
+# entries each active user logs while the bot is "down", four diary pages
+DOWNTIME_ENTRIES = 200
+WHOWATCHED_LOOKUPS = 50
+# how far the clock moves between diary checks
+CHECK_INTERVAL_SECONDS = 15 * 60
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def fake_request(base_url: str, path: str, method: str = "GET") -> dict:
+    request = urllib.request.Request(base_url + path, method=method)
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
+def start_fake_letterboxd(users: int, seed: int) -> tuple[str, multiprocessing.Process]:
+    port = free_port()
+    server = multiprocessing.Process(
+        target=fake_letterboxd.serve, args=(users, port, seed), daemon=True
+    )
+    server.start()
+
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(600):
+        try:
+            fake_request(base_url, "/__stats")
+            return base_url, server
+        except OSError:
+            time.sleep(0.1)
+
+    raise RuntimeError("fake letterboxd didn't start")
+
+
+def peak_rss_mb() -> float:
+    # linux reports kilobytes, macos bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+async def run_scale(users: int, seed: int, send_latency: float) -> dict:
+    base_url, server = start_fake_letterboxd(users, seed)
+
+    os.environ["LETTERBOXD_URL"] = base_url
+    os.environ["HTTP_CACHE_DIR"] = tempfile.mkdtemp(prefix="bench-http-cache-")
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+    # measure the bot, not the politeness limit
+    os.environ.setdefault("SCRAPE_REQUESTS_PER_SECOND", "100000")
+    os.environ["OUTBOX_MAX_PENDING"] = str(users * 10)
+    os.environ["METRICS_PORT"] = "0"
+
+    import discord
+    from discord.ext import commands
+    from letterboxdpy.core.scraper import Scraper  # type: ignore
+    from sqlalchemy import func, insert, select, update
+
+    from letterboxd_discord_bot.cogs.letterboxd_cog import LetterboxdCog
+    from letterboxd_discord_bot.database import (
+        Base,
+        Film,
+        FollowedUser,
+        LetterboxdUser,
+        SessionLocal,
+        create_tables,
+        engine,
+    )
+    from letterboxd_discord_bot.utils import http_cache as http_cache_module
+    from letterboxd_discord_bot.utils import metrics
+    from letterboxd_discord_bot.utils.db_actions import (
+        check_due_diaries,
+        sync_due_user_films,
+    )
+    from letterboxd_discord_bot.utils.film_index import film_index
+    from letterboxd_discord_bot.utils.http import letterboxd_http
+    from letterboxd_discord_bot.utils.letterboxd_actions import load_letterboxdpy
+    from letterboxd_discord_bot.utils.misc import utcnow
+    from letterboxd_discord_bot.utils.outbox import (
+        count_pending_messages,
+        deliver_outbox,
+    )
+
+    class LocalLetterboxd:
+        """Points letterboxdpy (which always asks letterboxd.com) at the fake."""
+
+        def __init__(self, session):
+            self._session = session
+
+        def __getattr__(self, name: str):
+            return getattr(self._session, name)
+
+        def get(self, url: str, **kwargs):
+            return self._session.get(
+                url.replace("https://letterboxd.com", base_url), **kwargs
+            )
+
+    # outside the cache wrapper, so both fetch paths share cache keys
+    load_letterboxdpy()
+    Scraper.set_instance(LocalLetterboxd(Scraper.instance()))
+
+    class Clock:
+        offset = 0.0
+
+        def time(self) -> float:
+            return time.time() + self.offset
+
+    clock = Clock()
+    http_cache_module.time = clock  # type: ignore[assignment]
+
+    class FakeChannel(discord.abc.Messageable):
+        def __init__(self, channel_id: int):
+            self.id = channel_id
+            self.messages = 0
+            self.embeds = 0
+
+        async def _get_channel(self):
+            return self
+
+    class FakeHTTP:
+        def __init__(self):
+            self.nonces: set[str] = set()
+            self.rejected = 0
+
+        async def send_message(self, channel_id: int, *, params) -> None:
+            await asyncio.sleep(send_latency)
+
+            # discord answers a message over its embed limits with a 400
+            embeds = params.payload.get("embeds", [])
+            if (
+                len(embeds) > 10
+                or sum(len(discord.Embed.from_dict(embed)) for embed in embeds) > 6000
+                or any(len(embed.get("description", "")) > 4096 for embed in embeds)
+            ):
+                self.rejected += 1
+                raise discord.HTTPException(
+                    cast(Any, SimpleNamespace(status=400, reason="Bad Request")),
+                    {"code": 50035, "message": "Invalid Form Body"},
+                )
+
+            # like discord with enforce_nonce, a repeated nonce isn't posted
+            nonce = params.payload["nonce"]
+            if nonce in self.nonces:
+                return
+            self.nonces.add(nonce)
+
+            channel = bot.get_channel(channel_id)
+            channel.messages += 1
+            channel.embeds += len(params.payload.get("embeds", []))
+
+    class FakeBot:
+        def __init__(self):
+            self.channels: dict[int, FakeChannel] = {}
+            self.http = FakeHTTP()
+
+        def get_channel(self, channel_id: int) -> FakeChannel:
+            return self.channels.setdefault(channel_id, FakeChannel(channel_id))
+
+    bot = FakeBot()
+    # only the parts of commands.Bot the delivery and the cog touch are faked
+    discord_bot = cast(commands.Bot, bot)
+
+    async def reset_database():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+        await create_tables()
+
+    async def seed_database() -> int:
+        now = utcnow()
+        rng = random.Random(seed)
+
+        async with SessionLocal() as db:
+            await db.execute(
+                insert(Film),
+                [
+                    {
+                        "letterboxd_id": film_id,
+                        "slug": fake_letterboxd.film_slug(film_id),
+                        "title": fake_letterboxd.film_title(film_id),
+                        "year": fake_letterboxd.film_year(film_id),
+                        "genres": ["Drama"],
+                        "poster": None,
+                        "updated_at": now,
+                    }
+                    for film_id in range(1, fake_letterboxd.FILM_COUNT + 1)
+                ],
+            )
+            await db.execute(
+                insert(LetterboxdUser),
+                [
+                    {"id": i + 1, "username": fake_letterboxd.username(i)}
+                    for i in range(users)
+                ],
+            )
+
+            follows = [
+                {
+                    "guild_id": GUILD_ID,
+                    "channel_id": 1000 + i // USERS_PER_CHANNEL,
+                    "letterboxd_user_id": i + 1,
+                }
+                for i in range(users)
+            ]
+            follows += [
+                {
+                    "guild_id": SECOND_GUILD_ID,
+                    "channel_id": 2_000_000 + i // USERS_PER_CHANNEL,
+                    "letterboxd_user_id": i + 1,
+                }
+                for i in rng.sample(range(users), int(users * SHARED_USERS))
+            ]
+            await db.execute(insert(FollowedUser), follows)
+            await db.commit()
+
+        await film_index.load()
+        return len(follows)
+
+    async def make_due():
+        clock.offset += CHECK_INTERVAL_SECONDS
+        async with SessionLocal() as db:
+            await db.execute(update(LetterboxdUser).values(next_diary_check=None))
+            await db.commit()
+
+    async def deliver_all() -> dict:
+        def messages() -> int:
+            return sum(channel.messages for channel in bot.channels.values())
+
+        before = messages()
+        before_rejected = bot.http.rejected
+        sent = 0
+        while await count_pending_messages():
+            sent_now = await deliver_outbox(discord_bot)
+            if not sent_now:
+                # the rest are backing off after failed sends
+                break
+            sent += sent_now
+
+        return {
+            "updates_sent": sent,
+            "messages_sent": messages() - before,
+            "rejected_sends": bot.http.rejected - before_rejected,
+        }
+
+    async def catch_up() -> dict:
+        checks = queued = 0
+        while True:
+            checks += 1
+            queued += await check_due_diaries(limit=users)
+
+            async with SessionLocal() as db:
+                behind = await db.scalar(
+                    select(func.count()).where(
+                        LetterboxdUser.diary_catchup_page.is_not(None)
+                    )
+                )
+            if not behind:
+                return {"checks": checks, "updates_queued": queued}
+
+            clock.offset += CHECK_INTERVAL_SECONDS
+
+    async def whowatched() -> dict:
+        cog = LetterboxdCog(discord_bot)
+        # the interaction is faked too, call the undecorated callback directly
+        callback = cast(Any, cog.whowatched.callback)
+        replies = []
+
+        async def reply(*args, **kwargs):
+            replies.append(kwargs.get("embed"))
+
+        async def defer(**kwargs):
+            pass
+
+        rng = random.Random(seed)
+        for _ in range(WHOWATCHED_LOOKUPS):
+            interaction = SimpleNamespace(
+                guild=SimpleNamespace(id=GUILD_ID),
+                channel=SimpleNamespace(id=1000 + rng.randrange(users) // 10),
+                response=SimpleNamespace(defer=defer),
+                followup=SimpleNamespace(send=reply),
+            )
+            slug = fake_letterboxd.film_slug(rng.randint(1, fake_letterboxd.FILM_COUNT))
+            await callback(cog, interaction, slug)
+
+        return {"lookups": WHOWATCHED_LOOKUPS, "replies": len(replies)}
+
+    phases = []
+
+    async def measure(name: str, coro) -> dict:
+        before_server = fake_request(base_url, "/__stats")
+        before_requests = metrics.letterboxd_requests.total()
+        before_queries = metrics.db_queries.total()
+        before_failures = metrics.scrape_failures.total()
+
+        start = time.perf_counter()
+        result = await coro
+        seconds = time.perf_counter() - start
+
+        after_server = fake_request(base_url, "/__stats")
+        served = {
+            key: count - before_server.get(key, 0)
+            for key, count in after_server.items()
+            if count != before_server.get(key, 0)
+        }
+
+        phase = {
+            "phase": name,
+            "seconds": round(seconds, 3),
+            "letterboxd_requests": metrics.letterboxd_requests.total()
+            - before_requests,
+            "served": served,
+            "db_queries": metrics.db_queries.total() - before_queries,
+            "scrape_failures": metrics.scrape_failures.total() - before_failures,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+        }
+        if isinstance(result, dict):
+            phase |= result
+        elif result is not None:
+            phase["result"] = result
+
+        phases.append(phase)
+        print(f"  {name}: {seconds:.2f}s", file=sys.stderr)
+        return phase
+
+    try:
+        await reset_database()
+        follows = await seed_database()
+
+        await measure("diary: first check", check_due_diaries(limit=users))
+        await measure("delivery: first check", deliver_all())
+
+        await make_due()
+        await measure("diary: quiet check", check_due_diaries(limit=users))
+
+        fake_request(base_url, f"/__advance?fraction={ACTIVE_USERS}", method="POST")
+        await make_due()
+        await measure(
+            f"diary: {ACTIVE_USERS:.0%} active check", check_due_diaries(limit=users)
+        )
+        await measure("delivery: active check", deliver_all())
+
+        fake_request(
+            base_url,
+            f"/__advance?fraction={ACTIVE_USERS}&entries={DOWNTIME_ENTRIES}",
+            method="POST",
+        )
+        await make_due()
+        await measure("diary: catch-up after downtime", catch_up())
+        await measure("delivery: catch-up", deliver_all())
+
+        await measure("watch sync: full", sync_due_user_films(limit=users))
+        await measure("whowatched", whowatched())
+    finally:
+        await letterboxd_http.close()
+        await engine.dispose()
+        server.terminate()
+
+    return {
+        "users": users,
+        "follows": follows,
+        "database": engine.dialect.name,
+        "phases": phases,
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def problems(scale: dict) -> list[str]:
+    """Phases whose numbers come from a run that didn't do all its work."""
+    found = []
+    for phase in scale["phases"]:
+        if phase["scrape_failures"]:
+            found.append(
+                f"{scale['users']} users, {phase['phase']}: "
+                f"{phase['scrape_failures']:g} user scrapes failed"
+            )
+        if phase.get("rejected_sends"):
+            found.append(
+                f"{scale['users']} users, {phase['phase']}: "
+                f"discord rejected {phase['rejected_sends']} sends"
+            )
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", default="100,1000,10000")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--send-latency",
+        type=float,
+        default=0.05,
+        help="seconds each fake discord send takes",
+    )
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    # internal, runs one scale in this process
+    parser.add_argument("--scale", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scale:
+        # keep the bot's own output off stdout, that's for the results
+        with contextlib.redirect_stdout(sys.stderr):
+            result = asyncio.run(run_scale(args.scale, args.seed, args.send_latency))
+        print(json.dumps(result))
+        return
+
+    scales = []
+    for users in (int(count) for count in args.users.split(",")):
+        print(f"{users} users", file=sys.stderr)
+        child = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--scale",
+                str(users),
+                "--seed",
+                str(args.seed),
+                "--send-latency",
+                str(args.send_latency),
+            ],
+            stdout=subprocess.PIPE,
+            text=True,
+            check=True,
+        )
+        scales.append(json.loads(child.stdout))
+
+    report = json.dumps(
+        {
+            "benchmark": "bot_cycle",
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "ran_at": datetime.datetime.now(datetime.UTC).isoformat(),
+            "send_latency": args.send_latency,
+            "scales": scales,
+        },
+        indent=2,
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+    failed = [problem for scale in scales for problem in problems(scale)]
+    for problem in failed:
+        print(f"error: {problem}", file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
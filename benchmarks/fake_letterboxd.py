@@ -0,0 +1,391 @@
+"""Synthetic letterboxd for benchmarks, served on localhost.
+
+Serves just enough of the profile, diary, watched/liked films, review and
+film pages for letterboxdpy and the bot's own parsers. Pages carry an ETag
+and answer conditional requests with a 304, and every page has a per-request
+token in it like the real site, so a changed body doesn't mean changed data.
+
+    python benchmarks/fake_letterboxd.py --users 1000 --port 8123
+
+GET /__stats returns request counts, POST /__advance?fraction=0.1 logs new
+diary entries for that share of users (add &entries=200 for a set number).
+"""
+
+import argparse
+import datetime
+import hashlib
+import html
+import json
+import random
+import uuid
+from collections import Counter
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+FILM_COUNT = 5000
+DIARY_ENTRIES_PER_USER = 30
+WATCHED_FILMS_PER_USER = 200
+DIARY_PAGE_SIZE = 50
+FILMS_PAGE_SIZE = 72
+START_DATE = datetime.date(2024, 1, 1)
+
+
+def username(i: int) -> str:
+    return f"bench_user_{i}"
+
+
+TITLE_WORDS = [
+    "the", "last", "night", "city", "of", "long", "summer", "dark", "river",
+    "house", "return", "secret", "garden", "lost", "stranger", "before", "after",
+]  # fmt: skip
+
+
+def film_words(film_id: int) -> list[str]:
+    # real titles and slugs run to a few words, which matters for embed sizes
+    return random.Random(film_id).choices(TITLE_WORDS, k=2 + film_id % 5)
+
+
+def film_slug(film_id: int) -> str:
+    return "-".join(["film", str(film_id), *film_words(film_id)])
+
+
+def film_title(film_id: int) -> str:
+    return " ".join(film_words(film_id)).title() + f" {film_id}"
+
+
+def film_year(film_id: int) -> int:
+    return 1950 + film_id % 75
+
+
+@dataclass
+class DiaryEntry:
+    viewing_id: int
+    film_id: int
+    date: datetime.date
+    rating: int | None
+    liked: bool
+    reviewed: bool
+
+
+@dataclass
+class FakeUser:
+    name: str
+    diary: list[DiaryEntry]  # oldest first
+    watched: dict[int, tuple[int | None, bool]]  # film id -> (rating, liked)
+    version: int = 0
+
+
+@dataclass
+class FakeSite:
+    users: dict[str, FakeUser]
+    rng: random.Random
+    next_viewing_id: int
+    requests: Counter = field(default_factory=Counter)
+
+    @classmethod
+    def generate(cls, user_count: int, seed: int = 0) -> "FakeSite":
+        rng = random.Random(seed)
+        users = {}
+        viewing_id = 1
+
+        for i in range(user_count):
+            watched = {
+                film_id: (rng.choice([None, *range(1, 11)]), rng.random() < 0.1)
+                for film_id in rng.sample(
+                    range(1, FILM_COUNT + 1), WATCHED_FILMS_PER_USER
+                )
+            }
+
+            diary = []
+            date = START_DATE
+            for film_id in rng.sample(list(watched), DIARY_ENTRIES_PER_USER):
+                date += datetime.timedelta(days=rng.randint(0, 10))
+                rating, liked = watched[film_id]
+                diary.append(
+                    DiaryEntry(
+                        viewing_id, film_id, date, rating, liked, rng.random() < 0.2
+                    )
+                )
+                viewing_id += 1
+
+            users[username(i)] = FakeUser(username(i), diary, watched)
+
+        return cls(users, rng, viewing_id)
+
+    def advance(self, fraction: float, entries: int | None = None) -> int:
+        """Log new diary entries for `fraction` of the users, 1-3 by default."""
+        changed = self.rng.sample(
+            list(self.users.values()), int(len(self.users) * fraction)
+        )
+        today = datetime.date.today()
+
+        for user in changed:
+            for _ in range(entries or self.rng.randint(1, 3)):
+                film_id = self.rng.randint(1, FILM_COUNT)
+                rating = self.rng.choice([None, *range(1, 11)])
+                liked = self.rng.random() < 0.1
+
+                user.diary.append(
+                    DiaryEntry(
+                        self.next_viewing_id,
+                        film_id,
+                        today,
+                        rating,
+                        liked,
+                        self.rng.random() < 0.2,
+                    )
+                )
+                user.watched[film_id] = (rating, liked)
+                self.next_viewing_id += 1
+
+            user.version += 1
+
+        return len(changed)
+
+
+def page(body: str, title: str = "Letterboxd", meta: str = "") -> str:
+    # a fresh token per request, like the csrf token on the real site
+    return (
+        f"<html><head><title>{title}</title>{meta}</head><body>"
+        f'<input type="hidden" name="__csrf" value="{uuid.uuid4().hex}">'
+        f"{body}</body></html>"
+    )
+
+
+def film_component(film_id: int) -> str:
+    name = html.escape(f"{film_title(film_id)} ({film_year(film_id)})")
+    return (
+        f'<div class="react-component" data-film-id="{film_id}" '
+        f'data-item-slug="{film_slug(film_id)}" data-item-name="{name}"></div>'
+    )
+
+
+def rating_span(rating: int | None) -> str:
+    return f'<span class="rating rated-{rating}"></span>' if rating else ""
+
+
+def render_profile(user: FakeUser, user_id: int) -> str:
+    meta = (
+        f'<meta property="og:title" content="{user.name}Letterboxd">'
+        '<meta property="og:description" content="Bio: benchmark user">'
+    )
+    body = (
+        f'<button data-js-trigger="report" data-report-url="/ajax/person:{user_id}/report-for"></button>'
+        '<div class="profile-avatar"><img src="https://a.ltrbxd.com/avatar-0-220-0-220.jpg"></div>'
+        f'<h4 class="profile-statistic"><span>{len(user.watched)}</span> Films</h4>'
+        f'<h4 class="profile-statistic"><span>{len(user.diary)}</span> This year</h4>'
+    )
+    return page(body, meta=meta)
+
+
+def render_diary(user: FakeUser, page_number: int) -> str:
+    newest_first = user.diary[::-1]
+    start = (page_number - 1) * DIARY_PAGE_SIZE
+    entries = newest_first[start : start + DIARY_PAGE_SIZE]
+
+    columns = [
+        "monthdate",
+        "daydate",
+        "production",
+        "releaseyear",
+        "rating",
+        "like",
+        "rewatch",
+        "review",
+        "actions",
+    ]
+    header = "".join(f'<th class="col-{column}"></th>' for column in columns)
+
+    rows = []
+    for entry in entries:
+        date = entry.date
+        review = (
+            f'<a href="/{user.name}/film/{film_slug(entry.film_id)}/">review</a>'
+            if entry.reviewed
+            else ""
+        )
+        rows.append(
+            f'<tr class="diary-entry-row" data-viewing-id="{entry.viewing_id}">'
+            f'<td class="col-monthdate">{date:%b}</td>'
+            f'<td class="col-daydate"><a href="/{user.name}/films/diary/for/{date.year}/{date.month:02}/{date.day:02}/">{date.day}</a></td>'
+            f'<td class="col-production">{film_component(entry.film_id)}</td>'
+            f'<td class="col-releaseyear">{film_year(entry.film_id)}</td>'
+            f'<td class="col-rating">{rating_span(entry.rating) or "<span class=rating></span>"}</td>'
+            f'<td class="col-like">{"<span class=icon-liked></span>" if entry.liked else ""}</td>'
+            '<td class="col-rewatch icon-status-off"></td>'
+            f'<td class="col-review">{review}</td>'
+            '<td class="col-actions" data-film-run-time="100"></td>'
+            "</tr>"
+        )
+
+    if not rows:
+        return page("<p>No diary entries.</p>")
+
+    return page(
+        f'<table id="diary-table"><thead><tr>{header}</tr></thead>'
+        f"<tbody>{''.join(rows)}</tbody></table>"
+    )
+
+
+def render_film_grid(films: list[tuple[int, int | None, bool]], item_class: str):
+    items = "".join(
+        f'<li class="{item_class}">{film_component(film_id)}'
+        f'<p class="poster-viewingdata">{rating_span(rating)}'
+        f"{'<span class=like></span>' if liked else ''}</p></li>"
+        for film_id, rating, liked in films
+    )
+    return page(f'<ul class="grid">{items}</ul>')
+
+
+def render_review(user: FakeUser, slug: str) -> str:
+    return page(
+        f'<div class="js-review-body"><p>{user.name} on {slug}.</p>'
+        "<p>A perfectly average review.</p></div>"
+    )
+
+
+def render_film(film_id: int) -> str:
+    meta = '<meta property="og:type" content="video.movie">'
+    ld = json.dumps(
+        {
+            "image": f"https://a.ltrbxd.com/poster-{film_id}.jpg",
+            "releasedEvent": [{"startDate": str(film_year(film_id))}],
+        }
+    )
+    body = (
+        f'<span class="block-flag-wrapper"><a data-report-url="/ajax/film:{film_id}/report/"></a></span>'
+        f'<h1 class="primaryname"><span class="name">{film_title(film_id)}</span></h1>'
+        f'<span class="releasedate">{film_year(film_id)}</span>'
+        f'<script type="application/ld+json">{ld}</script>'
+    )
+    return page(body, meta=meta)
+
+
+def make_app(site: FakeSite) -> web.Application:
+    def respond(request: web.Request, kind: str, version: str, render) -> web.Response:
+        # etags follow the underlying data, not the body (which has a token)
+        etag = f'W/"{hashlib.sha1(version.encode()).hexdigest()[:16]}"'
+
+        if request.headers.get("if-none-match") == etag:
+            site.requests[(kind, 304)] += 1
+            return web.Response(status=304, headers={"etag": etag})
+
+        site.requests[(kind, 200)] += 1
+        return web.Response(
+            text=render(), content_type="text/html", headers={"etag": etag}
+        )
+
+    def get_user(request: web.Request, kind: str) -> FakeUser:
+        user = site.users.get(request.match_info["user"])
+        if not user:
+            site.requests[(kind, 404)] += 1
+            raise web.HTTPNotFound()
+        return user
+
+    async def profile(request: web.Request):
+        user = get_user(request, "profile")
+        user_id = int(user.name.rsplit("_", 1)[-1]) + 1
+        return respond(
+            request, "profile", user.name, lambda: render_profile(user, user_id)
+        )
+
+    async def diary(request: web.Request):
+        user = get_user(request, "diary")
+        page_number = int(request.match_info.get("page", 1))
+        return respond(
+            request,
+            "diary",
+            f"{user.name}:diary:{user.version}:{page_number}",
+            lambda: render_diary(user, page_number),
+        )
+
+    async def films(request: web.Request):
+        user = get_user(request, "films")
+        page_number = int(request.match_info.get("page", 1))
+        watched = sorted(user.watched.items())
+        start = (page_number - 1) * FILMS_PAGE_SIZE
+        chunk = [
+            (film_id, rating, liked)
+            for film_id, (rating, liked) in watched[start : start + FILMS_PAGE_SIZE]
+        ]
+        return respond(
+            request,
+            "films",
+            f"{user.name}:films:{user.version}:{page_number}",
+            lambda: render_film_grid(chunk, "griditem"),
+        )
+
+    async def likes(request: web.Request):
+        user = get_user(request, "likes")
+        liked = [
+            (film_id, rating, True)
+            for film_id, (rating, is_liked) in sorted(user.watched.items())
+            if is_liked
+        ][:FILMS_PAGE_SIZE]
+        return respond(
+            request,
+            "likes",
+            f"{user.name}:likes:{user.version}",
+            lambda: render_film_grid(liked, "posteritem"),
+        )
+
+    async def review(request: web.Request):
+        user = get_user(request, "review")
+        slug = request.match_info["slug"]
+        return respond(
+            request,
+            "review",
+            f"{user.name}:review:{slug}",
+            lambda: render_review(user, slug),
+        )
+
+    async def film(request: web.Request):
+        film_id = int(request.match_info["slug"].split("-")[1])
+        return respond(request, "film", f"film:{film_id}", lambda: render_film(film_id))
+
+    async def stats(request: web.Request):
+        return web.json_response(
+            {
+                f"{kind}:{status}": count
+                for (kind, status), count in site.requests.items()
+            }
+        )
+
+    async def advance(request: web.Request):
+        entries = request.query.get("entries")
+        changed = site.advance(
+            float(request.query.get("fraction", "0.1")),
+            int(entries) if entries else None,
+        )
+        return web.json_response({"changed_users": changed})
+
+    app = web.Application()
+    app.router.add_get("/__stats", stats)
+    app.router.add_post("/__advance", advance)
+    app.router.add_get("/film/{slug}/", film)
+    app.router.add_get("/{user}", profile)  # letterboxdpy leaves off the slash
+    app.router.add_get("/{user}/", profile)
+    app.router.add_get("/{user}/films/diary/", diary)
+    app.router.add_get("/{user}/films/diary/page/{page:\\d+}/", diary)
+    app.router.add_get("/{user}/films/", films)
+    app.router.add_get("/{user}/films/page/{page:\\d+}/", films)
+    app.router.add_get("/{user}/likes/films/", likes)
+    app.router.add_get("/{user}/film/{slug}/", review)
+
+    return app
+
+
+def serve(user_count: int, port: int, seed: int = 0):
+    site = FakeSite.generate(user_count, seed)
+    web.run_app(make_app(site), host="127.0.0.1", port=port, print=None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--port", type=int, default=8123)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    serve(args.users, args.port, args.seed)
@@ -0,0 +1,166 @@
+"""Compare the old per-film update_user_films path with the paged bulk upsert.
+
+Runs against DATABASE_URL if it's set, otherwise a throwaway sqlite file:
+
+    DATABASE_URL=postgresql://... uv run python benchmarks/update_user_films.py
+"""
+
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+if not os.getenv("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+
+from sqlalchemy import delete, event, select  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncSession  # noqa: E402
+
+from letterboxd_discord_bot.database import (  # noqa: E402
+    MovieWatch,
+    SessionLocal,
+    create_tables,
+    engine,
+)
+from letterboxd_discord_bot.utils.db_actions import (  # noqa: E402
+    apply_film_page,
+    get_user_id,
+    remove_unseen_watches,
+)
+from letterboxd_discord_bot.utils.misc import utcnow  # noqa: E402
+
+USERNAME = "bench_user"
+FILM_COUNT = 5000
+# films on one page of a letterboxd film list
+FILMS_PAGE_SIZE = 72
+
+queries = 0
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def count_query(*args):
+    global queries
+    queries += 1
+
+
+def make_films(count: int) -> dict[str, dict]:
+    films = {}
+    for i in range(count):
+        rating = random.choice([None, *range(1, 11)])
+        films[f"film-{i}"] = {"id": i + 1, "rating": rating, "liked": i % 7 == 0}
+
+    return films
+
+
+def mutate(films: dict[str, dict]) -> dict[str, dict]:
+    # a typical resync: a few ratings changed, a few films unlogged, a few new
+    films = {slug: dict(watch) for slug, watch in films.items()}
+    slugs = list(films)
+
+    for slug in random.sample(slugs, len(slugs) // 20):
+        films[slug]["rating"] = random.randint(1, 10)
+
+    for slug in random.sample(slugs, len(slugs) // 100):
+        del films[slug]
+
+    for i in range(len(slugs) // 100):
+        films[f"new-film-{i}"] = {"id": 1_000_000 + i, "rating": None, "liked": False}
+
+    return films
+
+
+async def legacy_update_user_films(
+    db: AsyncSession, username: str, films: dict[str, dict]
+):
+    user_id = await get_user_id(db, username)
+
+    for watch in films.values():
+        movie_id = watch["id"]
+
+        existing_watch = await db.scalar(
+            select(MovieWatch)
+            .filter_by(movie_id=movie_id, letterboxd_user_id=user_id)
+            .limit(1)
+        )
+
+        rating = watch.get("rating")
+        liked = watch.get("liked")
+
+        if existing_watch:
+            if existing_watch.rating != rating:
+                existing_watch.rating = rating
+
+            if existing_watch.liked != liked:
+                existing_watch.liked = liked
+        else:
+            db.add(
+                MovieWatch(
+                    movie_id=movie_id,
+                    letterboxd_user_id=user_id,
+                    rating=rating,
+                    liked=liked,
+                )
+            )
+
+    await db.commit()
+
+
+async def paged_sync(db: AsyncSession, username: str, films: dict[str, dict]):
+    # what sync_user_films does with the pages it scrapes, minus the scraping
+    user_id = await get_user_id(db, username)
+    started_at = utcnow()
+    await db.commit()
+
+    films_list = list(films.items())
+    for i in range(0, len(films_list), FILMS_PAGE_SIZE):
+        await apply_film_page(db, user_id, dict(films_list[i : i + FILMS_PAGE_SIZE]))
+        await db.commit()
+
+    await remove_unseen_watches(db, user_id, started_at)
+    await db.commit()
+
+
+async def measure(name: str, fn, films: dict[str, dict]):
+    global queries
+
+    async with SessionLocal() as db:
+        queries = 0
+        start = time.perf_counter()
+        await fn(db, USERNAME, films)
+        elapsed = time.perf_counter() - start
+
+    print(f"{name:<28} {elapsed * 1000:>10.1f} ms {queries:>8} queries")
+
+
+async def reset():
+    async with SessionLocal() as db:
+        await db.execute(
+            delete(MovieWatch).where(
+                MovieWatch.letterboxd_user_id == await get_user_id(db, USERNAME)
+            )
+        )
+        await db.commit()
+
+
+async def main():
+    random.seed(0)
+    await create_tables()
+
+    films = make_films(FILM_COUNT)
+    resync = mutate(films)
+
+    print(f"{FILM_COUNT} films on {engine.dialect.name}\n")
+
+    for name, fn in (("legacy", legacy_update_user_films), ("paged", paged_sync)):
+        await reset()
+        await measure(f"{name} first sync", fn, films)
+        await measure(f"{name} resync", fn, resync)
+        await measure(f"{name} unchanged resync", fn, resync)
+
+    await reset()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,22 +1,68 @@
-from urllib.parse import quote
+from functools import partial
 
 import discord
 from discord import app_commands
 from discord.ext import commands
-from letterboxdpy import movie as lb_movie  # type: ignore
-from letterboxdpy import search as lb_search  # type: ignore
-from letterboxdpy import user as lb_user  # type: ignore
-from sqlalchemy.orm import Session
-
-from ..database import FollowedUser, MovieWatch, get_db
-from ..utils.embeds import create_watchers_embed
-from ..utils.misc import escape
+from sqlalchemy import select
+
+from .. import config
+from ..database import (
+    FollowedUser,
+    LetterboxdUser,
+    MovieWatch,
+    SessionLocal,
+    normalize_username,
+    schema_ready,
+)
+from ..utils.db_actions import get_user_id
+from ..utils.embeds import (
+    create_compat_embed,
+    create_leaderboard_embed,
+    create_recommend_embed,
+    create_similar_embed,
+    create_stats_embed,
+    create_top_embed,
+    create_user_stats_embed,
+    create_watchers_embed,
+)
+from ..utils.film_cache import film_cache
+from ..utils.film_index import film_index
+from ..utils.letterboxd_actions import get_user, search_film_slug
+from ..utils.metrics import record_startup
+from ..utils.misc import escape, utcnow
+from ..utils.outbox import count_pending_messages
+from ..utils.scraper import Lane, scrape_executor, set_lane
+from ..utils.stats import (
+    apply_follow_change,
+    get_leaderboard,
+    get_top_films,
+    get_user_stats,
+    month_start,
+)
+from ..utils.taste import (
+    TasteProfile,
+    compare,
+    most_similar,
+    recommend_films,
+    taste_index,
+)
+from ..utils.worker_stats import get_scrape_stats
 
 
 class LetterboxdCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
 
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # someone's waiting on the reply, so scrapes from here go ahead of
+        # background ones. only lasts for this interaction's task
+        set_lane(Lane.INTERACTIVE)
+
+        # commands can arrive while the schema check is still running
+        await schema_ready.wait()
+        record_startup("first_command")
+        return True
+
     @app_commands.command(
         name="follow",
         description="Follow a Letterboxd user to get updates.",
@@ -32,27 +78,28 @@ class LetterboxdCog(commands.Cog):
             )
             return
 
-        db: Session = next(get_db())
-        existing_follow = (
-            db.query(FollowedUser)
-            .filter_by(
-                guild_id=interaction.guild.id,
-                channel_id=interaction.channel.id,
-                letterboxd_username=username,
+        username = normalize_username(username)
+
+        async with SessionLocal() as db:
+            existing_follow = await db.scalar(
+                select(FollowedUser)
+                .join(FollowedUser.letterboxd_user)
+                .where(
+                    FollowedUser.guild_id == interaction.guild.id,
+                    FollowedUser.channel_id == interaction.channel.id,
+                    LetterboxdUser.username == username,
+                )
             )
-            .first()
-        )
 
         if existing_follow:
             await interaction.followup.send(
                 f"You are already following `{escape(username)}` on this server.",
                 ephemeral=True,
             )
-            db.close()
             return
 
         try:
-            if not lb_user.User(username).username:
+            if not (await scrape_executor.run(partial(get_user, username))).username:
                 await interaction.followup.send(
                     f"Could not find a Letterboxd user with the username `{escape(username)}`.",
                     ephemeral=True,
@@ -65,20 +112,25 @@ class LetterboxdCog(commands.Cog):
             )
             return
 
-        new_follow = FollowedUser(
-            guild_id=interaction.guild.id,
-            channel_id=interaction.channel.id,
-            letterboxd_username=username,
-        )
-        db.add(new_follow)
-        db.commit()
+        async with SessionLocal() as db:
+            user_id = await get_user_id(db, username)
+            db.add(
+                FollowedUser(
+                    guild_id=interaction.guild.id,
+                    channel_id=interaction.channel.id,
+                    letterboxd_user_id=user_id,
+                )
+            )
+            await apply_follow_change(
+                db, interaction.guild.id, interaction.channel.id, user_id, True
+            )
+            await db.commit()
 
         # todo: would be nice to show profile on follow - in case you followed the wrong person
 
         await interaction.followup.send(
             f"✅ Successfully started following `{escape(username)}`!"
         )
-        db.close()
 
     @app_commands.command(
         name="unfollow",
@@ -95,31 +147,40 @@ class LetterboxdCog(commands.Cog):
             )
             return
 
-        db: Session = next(get_db())
-        follow_to_delete = (
-            db.query(FollowedUser)
-            .filter_by(
-                guild_id=interaction.guild.id,
-                channel_id=interaction.channel.id,
-                letterboxd_username=username,
+        username = normalize_username(username)
+
+        async with SessionLocal() as db:
+            follow_to_delete = await db.scalar(
+                select(FollowedUser)
+                .join(FollowedUser.letterboxd_user)
+                .where(
+                    FollowedUser.guild_id == interaction.guild.id,
+                    FollowedUser.channel_id == interaction.channel.id,
+                    LetterboxdUser.username == username,
+                )
             )
-            .first()
-        )
+
+            if follow_to_delete:
+                await db.delete(follow_to_delete)
+                await apply_follow_change(
+                    db,
+                    interaction.guild.id,
+                    interaction.channel.id,
+                    follow_to_delete.letterboxd_user_id,
+                    False,
+                )
+                await db.commit()
 
         if not follow_to_delete:
             await interaction.followup.send(
                 f"You are not currently following `{escape(username)}` on this server.",
                 ephemeral=True,
             )
-            db.close()
             return
 
-        db.delete(follow_to_delete)
-        db.commit()
         await interaction.followup.send(
             f"🗑️ Successfully unfollowed `{escape(username)}`."
         )
-        db.close()
 
     @app_commands.command(
         name="following",
@@ -136,17 +197,15 @@ class LetterboxdCog(commands.Cog):
             )
             return
 
-        db: Session = next(get_db())
-
-        followed_list = (
-            db.query(FollowedUser)
-            .filter_by(
-                guild_id=interaction.guild.id,
-                channel_id=interaction.channel.id,
-            )
-            .all()
-        )
-        db.close()
+        async with SessionLocal() as db:
+            followed_list = (
+                await db.scalars(
+                    select(FollowedUser).filter_by(
+                        guild_id=interaction.guild.id,
+                        channel_id=interaction.channel.id,
+                    )
+                )
+            ).all()
 
         if not followed_list:
             await interaction.followup.send(
@@ -155,14 +214,30 @@ class LetterboxdCog(commands.Cog):
             )
             return
 
-        description = "\n".join(
-            [f"• {escape(user.letterboxd_username)}" for user in followed_list]
-        )
+        lines = []
+        paused = False
+
+        for followed in followed_list:
+            line = f"• {escape(followed.letterboxd_username)}"
+
+            user = followed.letterboxd_user
+            if user.quarantined_at:
+                line += f" - ⚠️ paused, {user.last_scrape_error}"
+                paused = True
+
+            lines.append(line)
+
         embed = discord.Embed(
             title=f"Following {len(followed_list)} Letterboxd Users",
-            description=description,
+            description="\n".join(lines),
             color=discord.Color.blue(),
         )
+
+        if paused:
+            embed.set_footer(
+                text=f"Paused users are checked every {config.SCRAPE_QUARANTINE_PROBE_HOURS:g} hours and resume automatically."
+            )
+
         await interaction.followup.send(embed=embed)
 
     @app_commands.command(
@@ -180,72 +255,261 @@ class LetterboxdCog(commands.Cog):
             )
             return
 
-        query = lb_search.Search(movie_title, "films")
-        search_results = query.get_results(max=1)["results"]
+        async with SessionLocal() as db:
+            followed_user_ids = set(
+                await db.scalars(
+                    select(FollowedUser.letterboxd_user_id).filter_by(
+                        guild_id=interaction.guild.id,
+                        channel_id=interaction.channel.id,
+                    )
+                )
+            )
 
-        db: Session = next(get_db())
+        if not followed_user_ids:
+            await interaction.followup.send(
+                "This server isn't following anyone yet! Use `/follow`.",
+                ephemeral=True,
+            )
+            return
 
-        try:
-            followed_usernames = set(
-                r.letterboxd_username
-                for r in db.query(FollowedUser)
-                .filter_by(
-                    guild_id=interaction.guild.id,
-                    channel_id=interaction.channel.id,
-                )
-                .all()
+        # autocomplete sends the slug, otherwise try the local index before
+        # searching letterboxd
+        indexed_film = film_index.resolve(movie_title)
+        film_slug = (
+            indexed_film.slug
+            if indexed_film
+            else await scrape_executor.run(partial(search_film_slug, movie_title))
+        )
+
+        if not film_slug:
+            await interaction.followup.send(
+                f"Could not find a movie matching '{escape(movie_title)}'. Please try a different title or be more specific.",
+                ephemeral=True,
             )
+            return
 
-            if not followed_usernames:
-                await interaction.followup.send(
-                    "This server isn't following anyone yet! Use `/follow`.",
-                    ephemeral=True,
+        film = await film_cache.get(film_slug)
+
+        async with SessionLocal() as db:
+            watchers = list(
+                await db.scalars(
+                    select(MovieWatch).where(
+                        MovieWatch.movie_id == film.letterboxd_id,
+                        MovieWatch.letterboxd_user_id.in_(followed_user_ids),
+                    )
                 )
-                return
+            )
+
+        # sort by rating descending
+        watchers.sort(
+            key=lambda watcher: (watcher.rating is None, -(watcher.rating or 0))
+        )
+
+        embed = create_watchers_embed(film, watchers)
+
+        await interaction.followup.send(embed=embed)
 
-            query = lb_search.Search(quote(movie_title), "films")
-            search_results = query.get_results(max=1)["results"]
+    async def get_taste_profiles(
+        self, interaction: discord.Interaction, *usernames: str
+    ) -> tuple[list[TasteProfile], list[TasteProfile]] | None:
+        """The named users' profiles and everyone's in the channel, or None
+        (after replying) if one of them isn't followed here."""
+        if not interaction.guild or not interaction.channel:
+            # todo: when does this happen? in dms?
+            await interaction.followup.send(
+                "Failed to fetch channel.",
+                ephemeral=True,
+            )
+            return None
+
+        profiles = await taste_index.channel_profiles(
+            interaction.guild.id, interaction.channel.id
+        )
 
-            if not search_results:
+        named = []
+        for username in usernames:
+            profile = profiles.get(normalize_username(username))
+            if not profile:
                 await interaction.followup.send(
-                    f"Could not find a movie matching '{escape(movie_title)}'. Please try a different title or be more specific.",
+                    f"`{escape(username)}` isn't followed on this server. Use `/follow` first.",
                     ephemeral=True,
                 )
-                return
+                return None
+            named.append(profile)
 
-            film_slug = search_results[0]["slug"]
+        return named, list(profiles.values())
 
-            movie = lb_movie.Movie(film_slug)
+    @app_commands.command(
+        name="compat",
+        description="See how similar two Letterboxd users' tastes are.",
+    )
+    async def compat(self, interaction: discord.Interaction, user1: str, user2: str):
+        await interaction.response.defer()
 
-            watchers = (
-                db.query(MovieWatch)
-                .filter(
-                    MovieWatch.movie_id == movie.letterboxd_id,
-                    MovieWatch.letterboxd_username.in_(followed_usernames),
-                )
-                .all()
+        found = await self.get_taste_profiles(interaction, user1, user2)
+        if not found:
+            return
+        (a, b), _ = found
+
+        compatibility = compare(a, b)
+        films = await film_cache.get_stored(
+            compatibility.both_loved + compatibility.disagreed
+        )
+
+        await interaction.followup.send(
+            embed=create_compat_embed(a, b, compatibility, films)
+        )
+
+    @app_commands.command(
+        name="similar",
+        description="Find the followed users with the most similar taste.",
+    )
+    async def similar(self, interaction: discord.Interaction, username: str):
+        await interaction.response.defer()
+
+        found = await self.get_taste_profiles(interaction, username)
+        if not found:
+            return
+        (profile,), everyone = found
+
+        await interaction.followup.send(
+            embed=create_similar_embed(
+                profile, most_similar(profile, everyone, limit=5)
+            )
+        )
+
+    @app_commands.command(
+        name="recommend",
+        description="Recommend films based on what similar followed users liked.",
+    )
+    async def recommend(self, interaction: discord.Interaction, username: str):
+        await interaction.response.defer()
+
+        found = await self.get_taste_profiles(interaction, username)
+        if not found:
+            return
+        (profile,), everyone = found
+
+        recommendations = recommend_films(profile, everyone, limit=10)
+        films = await film_cache.get_stored([item.movie_id for item in recommendations])
+
+        await interaction.followup.send(
+            embed=create_recommend_embed(profile, recommendations, films)
+        )
+
+    @app_commands.command(
+        name="top",
+        description="The highest rated films among the users followed here.",
+    )
+    async def top(self, interaction: discord.Interaction):
+        await interaction.response.defer()
+
+        if not interaction.guild or not interaction.channel:
+            # todo: when does this happen? in dms?
+            await interaction.followup.send(
+                "Failed to fetch channel.",
+                ephemeral=True,
+            )
+            return
+
+        top = await get_top_films(
+            interaction.guild.id, interaction.channel.id, limit=10
+        )
+        films = await film_cache.get_stored([stats.movie_id for stats in top])
+
+        await interaction.followup.send(embed=create_top_embed(top, films))
+
+    @app_commands.command(
+        name="leaderboard",
+        description="Who has logged the most films this month.",
+    )
+    async def leaderboard(self, interaction: discord.Interaction):
+        await interaction.response.defer()
+
+        if not interaction.guild or not interaction.channel:
+            # todo: when does this happen? in dms?
+            await interaction.followup.send(
+                "Failed to fetch channel.",
+                ephemeral=True,
+            )
+            return
+
+        month = month_start(utcnow().date())
+        leaders = await get_leaderboard(
+            interaction.guild.id, interaction.channel.id, month, limit=10
+        )
+
+        await interaction.followup.send(embed=create_leaderboard_embed(month, leaders))
+
+    @app_commands.command(
+        name="stats",
+        description="Show a followed Letterboxd user's stats.",
+    )
+    async def stats(self, interaction: discord.Interaction, username: str):
+        await interaction.response.defer()
+
+        if not interaction.guild or not interaction.channel:
+            # todo: when does this happen? in dms?
+            await interaction.followup.send(
+                "Failed to fetch channel.",
+                ephemeral=True,
             )
+            return
 
-            # sort by rating descending
-            watchers.sort(
-                key=lambda watcher: (watcher.rating is None, -(watcher.rating or 0))
+        stats = await get_user_stats(
+            interaction.guild.id,
+            interaction.channel.id,
+            normalize_username(username),
+            utcnow().date(),
+        )
+        if not stats:
+            await interaction.followup.send(
+                f"`{escape(username)}` isn't followed on this server. Use `/follow` first.",
+                ephemeral=True,
             )
+            return
+
+        await interaction.followup.send(embed=create_user_stats_embed(stats))
+
+    @app_commands.command(
+        name="botstats",
+        description="Show scraping and delivery stats for the bot.",
+    )
+    @app_commands.default_permissions(manage_guild=True)
+    async def botstats(self, interaction: discord.Interaction):
+        await interaction.response.defer(ephemeral=True)
+
+        embed = create_stats_embed(
+            await count_pending_messages(), await get_scrape_stats()
+        )
 
-            embed = create_watchers_embed(movie, watchers)
+        await interaction.followup.send(embed=embed, ephemeral=True)
 
-            await interaction.followup.send(embed=embed)
-        finally:
-            db.close()
+    @whowatched.autocomplete("movie_title")
+    async def whowatched_autocomplete(
+        self, interaction: discord.Interaction, current: str
+    ) -> list[app_commands.Choice[str]]:
+        return [
+            app_commands.Choice(name=film.display_name[:100], value=film.slug)
+            for film in film_index.search(current, limit=25)
+        ]
 
 
 async def setup(bot: commands.Bot, TEST_GUILD_ID=None):
     cog = LetterboxdCog(bot)
     await bot.add_cog(cog)
 
+    # syncing happens in the background once connected, see main.py
     if TEST_GUILD_ID:
         guild = discord.Object(id=TEST_GUILD_ID)
         bot.tree.add_command(cog.follow, guild=guild)
         bot.tree.add_command(cog.unfollow, guild=guild)
         bot.tree.add_command(cog.following, guild=guild)
         bot.tree.add_command(cog.whowatched, guild=guild)
-        await bot.tree.sync(guild=guild)
+        bot.tree.add_command(cog.compat, guild=guild)
+        bot.tree.add_command(cog.similar, guild=guild)
+        bot.tree.add_command(cog.recommend, guild=guild)
+        bot.tree.add_command(cog.top, guild=guild)
+        bot.tree.add_command(cog.leaderboard, guild=guild)
+        bot.tree.add_command(cog.stats, guild=guild)
+        bot.tree.add_command(cog.botstats, guild=guild)
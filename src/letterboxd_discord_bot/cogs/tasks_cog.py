@@ -1,13 +1,12 @@
 import asyncio
 
 from discord.ext import commands, tasks
-from sqlalchemy.orm import Session
 
-from ..database import get_db
-from ..utils.db_actions import (
-    collect_diary_updates,
-    update_all_user_films,
-)
+from .. import config
+from ..database import schema_ready
+from ..utils.db_actions import check_due_diaries, sync_due_user_films
+from ..utils.metrics import time_loop
+from ..utils.outbox import deliver_outbox, wait_for_outbox
 
 WAIT_UNTIL_READY_TIMEOUT = 900.0  # 15 minutes
 
@@ -40,16 +39,22 @@ async def wait_until_ready(bot) -> None:
             print("wait_until_ready: timeout waiting for ready or resumed")
             break
         except BaseException as e:  # Catch EVERYTHING so tasks don't die
-            print("error: exception in task before loop: %s", e)
+            print(f"error: exception in task before loop: {e!r}")
 
 
 class TasksCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.check_new_films.start()
-        self.update_all_movie_watches.start()
+        self.deliver_updates.start()
+
+        # in "discord" mode separate worker processes do the scraping
+        self.scraping = config.BOT_MODE != "discord"
+        if self.scraping:
+            self.check_new_films.start()
+            self.update_all_movie_watches.start()
 
     def cog_unload(self):
+        self.deliver_updates.cancel()
         self.check_new_films.cancel()
         self.update_all_movie_watches.cancel()
 
@@ -59,40 +64,48 @@ class TasksCog(commands.Cog):
     async def on_shard_ready(self, shard_id: int) -> None:
         print(f"shard {shard_id} ready")
 
-    @tasks.loop(minutes=15)
+    # each tick only checks users whose adaptive poll time is due
+    @tasks.loop(seconds=config.DIARY_POLL_TICK_SECONDS)
     async def check_new_films(self):
         try:
-            print("Running scheduled check for new diary entries...")
+            with time_loop("diary check"):
+                queued = await check_due_diaries()
 
-            db: Session = next(get_db())
-            updates = await asyncio.to_thread(collect_diary_updates, db, self.bot)
+            if queued:
+                print(f"Queued {queued} diary updates")
+        except BaseException as e:  # Catch EVERYTHING so tasks don't die
+            print(f"error: exception in task cog: {e!r}")
 
-            for update in updates:
-                try:
-                    await update.channel.send(embed=update.embed)
-                except Exception as e:
-                    print(f"Failed to send message: {e}")
+    # runs back to back, woken as soon as updates are queued in this process
+    # and polling every OUTBOX_POLL_SECONDS for ones queued by workers
+    @tasks.loop()
+    async def deliver_updates(self):
+        try:
+            await wait_for_outbox(config.OUTBOX_POLL_SECONDS)
 
-            print("Finished checking diaries")
+            with time_loop("delivery"):
+                await deliver_outbox(self.bot)
         except BaseException as e:  # Catch EVERYTHING so tasks don't die
-            print("error: exception in task cog: %s", e)
+            print(f"error: exception in task cog: {e!r}")
 
-    @tasks.loop(hours=6)
-    async def update_all_movie_watches(self):  # todo: how to run this in bg? it blocks
+    # each tick only syncs users that haven't been synced for WATCH_SYNC_HOURS
+    @tasks.loop(minutes=1)
+    async def update_all_movie_watches(self):
         try:
-            print("Running scheduled update for all movie watches...")
-
-            db: Session = next(get_db())
-            await asyncio.to_thread(update_all_user_films, db)
+            with time_loop("watch sync"):
+                synced = await sync_due_user_films()
 
-            print("Finished updating all movie watches")
+            if synced:
+                print(f"Updated movie watches for {synced} users")
         except BaseException as e:  # Catch EVERYTHING so tasks don't die
-            print("error: exception in task cog: %s", e)
+            print(f"error: exception in task cog: {e!r}")
 
     @check_new_films.before_loop
+    @deliver_updates.before_loop
     @update_all_movie_watches.before_loop
     async def before_check(self):
         await wait_until_ready(self.bot)
+        await schema_ready.wait()
 
 
 async def setup(bot):
@@ -8,3 +8,81 @@ DISCORD_TOKEN = os.getenv("DISCORD_TOKEN", "")
 DATABASE_URL = os.getenv("DATABASE_URL", "")
 test_guild_id_str = os.getenv("TEST_GUILD_ID")
 TEST_GUILD_ID = int(test_guild_id_str) if test_guild_id_str is not None else None
+# slash commands are only synced to discord when their definitions change,
+# set to 1 to sync on every start anyway
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "") == "1"
+
+# scraping
+SCRAPE_CONCURRENCY = int(os.getenv("SCRAPE_CONCURRENCY", "8"))
+SCRAPE_REQUESTS_PER_SECOND = float(os.getenv("SCRAPE_REQUESTS_PER_SECOND", "4"))
+SCRAPE_USER_TIMEOUT = float(os.getenv("SCRAPE_USER_TIMEOUT", "300"))
+# commands go ahead of diary checks, which go ahead of watch syncs. these are
+# the shares of requests the lower lanes keep however busy the ones above are
+SCRAPE_DIARY_SHARE = float(os.getenv("SCRAPE_DIARY_SHARE", "0.25"))
+SCRAPE_SYNC_SHARE = float(os.getenv("SCRAPE_SYNC_SHARE", "0.1"))
+# threads kept for blocking scrapes from commands
+SCRAPE_INTERACTIVE_THREADS = int(os.getenv("SCRAPE_INTERACTIVE_THREADS", "2"))
+
+# film metadata cache
+FILM_CACHE_SIZE = int(os.getenv("FILM_CACHE_SIZE", "5000"))
+FILM_CACHE_TTL_HOURS = float(os.getenv("FILM_CACHE_TTL_HOURS", "168"))
+
+# taste profiles for /compat, /similar and /recommend, in users
+TASTE_CACHE_SIZE = int(os.getenv("TASTE_CACHE_SIZE", "2000"))
+
+# letterboxd http
+LETTERBOXD_URL = os.getenv("LETTERBOXD_URL", "https://letterboxd.com").rstrip("/")
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "16"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+# on-disk response cache, set the dir to "" to turn it off
+HTTP_CACHE_DIR = os.getenv("HTTP_CACHE_DIR", ".cache/http")
+HTTP_CACHE_MAX_MB = float(os.getenv("HTTP_CACHE_MAX_MB", "512"))
+
+# film sync
+FULL_WATCH_SYNC_DAYS = float(os.getenv("FULL_WATCH_SYNC_DAYS", "7"))
+# an interrupted full sync carries on from its last page if it's picked up
+# again within this long, otherwise it starts over
+FILM_SYNC_RESUME_HOURS = float(os.getenv("FILM_SYNC_RESUME_HOURS", "24"))
+
+# diary polling
+DIARY_POLL_TICK_SECONDS = float(os.getenv("DIARY_POLL_TICK_SECONDS", "60"))
+DIARY_POLL_MIN_MINUTES = float(os.getenv("DIARY_POLL_MIN_MINUTES", "5"))
+DIARY_POLL_DEFAULT_MINUTES = float(os.getenv("DIARY_POLL_DEFAULT_MINUTES", "15"))
+DIARY_POLL_MAX_MINUTES = float(os.getenv("DIARY_POLL_MAX_MINUTES", "720"))
+# diary pages read per user per check. a longer backlog (after downtime, say)
+# is worked through over the following checks
+DIARY_MAX_PAGES_PER_CHECK = int(os.getenv("DIARY_MAX_PAGES_PER_CHECK", "3"))
+# a channel with at least this many new entries from one user gets them as a
+# single digest rather than an embed each
+DIARY_DIGEST_MIN_ENTRIES = int(os.getenv("DIARY_DIGEST_MIN_ENTRIES", "5"))
+
+# users whose scrapes fail back off, and are only probed now and then once
+# their profile looks gone for good (deleted, renamed, private)
+SCRAPE_FAILURE_BACKOFF_MINUTES = float(
+    os.getenv("SCRAPE_FAILURE_BACKOFF_MINUTES", "10")
+)
+SCRAPE_QUARANTINE_FAILURES = int(os.getenv("SCRAPE_QUARANTINE_FAILURES", "5"))
+SCRAPE_QUARANTINE_PROBE_HOURS = float(os.getenv("SCRAPE_QUARANTINE_PROBE_HOURS", "24"))
+
+# workers. "all" runs discord and scraping in one process, "discord" only
+# delivers notifications, "worker" only scrapes (run as many as you like)
+BOT_MODE = os.getenv("BOT_MODE", "all")
+SCRAPE_BATCH_SIZE = int(os.getenv("SCRAPE_BATCH_SIZE", "200"))
+LEASE_SECONDS = float(os.getenv("LEASE_SECONDS", "900"))
+WATCH_SYNC_HOURS = float(os.getenv("WATCH_SYNC_HOURS", "6"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_MAX_PENDING = int(os.getenv("OUTBOX_MAX_PENDING", "1000"))
+OUTBOX_RETRY_SECONDS = float(os.getenv("OUTBOX_RETRY_SECONDS", "30"))
+# how many channels are sent to at once
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", "10"))
+
+# prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics, 0 turns it off
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# database connection pool
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
@@ -1,73 +1,514 @@
+import asyncio
+import time
+
 from sqlalchemy import (
+    JSON,
     BigInteger,
     Boolean,
     DateTime,
+    Float,
+    ForeignKey,
+    Index,
     Integer,
+    SmallInteger,
     String,
+    Text,
     UniqueConstraint,
-    create_engine,
+    case,
+    event,
+    func,
+    insert,
+    inspect,
+    select,
+    text,
 )
-from sqlalchemy.orm import DeclarativeBase, mapped_column, sessionmaker
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import URL, Connection, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import DeclarativeBase, mapped_column, relationship
 
-from .config import DATABASE_URL
+from . import config
+from .utils import metrics
 
 
 class Base(DeclarativeBase):
     pass
 
 
+def normalize_username(username: str) -> str:
+    # letterboxd usernames are case insensitive, profile urls are lowercase
+    return username.strip().lower()
+
+
+class LetterboxdUser(Base):
+    """One row per letterboxd account, follows and watches point at it by id."""
+
+    __tablename__ = "letterboxd_users"
+
+    id = mapped_column(Integer, primary_key=True)
+    username = mapped_column(String, nullable=False, unique=True)  # normalized
+    last_watch_sync = mapped_column(DateTime, nullable=True)
+    last_full_sync = mapped_column(DateTime, nullable=True)
+    # bumped whenever their watches change, taste profiles are rebuilt off it
+    watches_changed_at = mapped_column(DateTime, nullable=True)
+    # progress of an unfinished full film sync, see sync_user_films in
+    # utils/db_actions.py
+    film_sync_started_at = mapped_column(DateTime, nullable=True)
+    film_sync_page = mapped_column(Integer, nullable=True)  # last one written
+
+    # adaptive diary polling, see utils/poll_schedule.py
+    next_diary_check = mapped_column(DateTime, nullable=True)
+    last_diary_activity = mapped_column(DateTime, nullable=True)
+    diary_gap_ewma = mapped_column(Float, nullable=True)  # seconds
+    diary_active_hours = mapped_column(JSON, nullable=True)  # 24 counts, utc
+
+    # diary entries already seen, see DiaryWatermark in utils/letterboxd_actions.py
+    diary_last_entry_id = mapped_column(BigInteger, nullable=True)
+    diary_recent_entry_ids = mapped_column(JSON, nullable=True)
+    # fingerprint of the first diary page, an unchanged page isn't parsed again
+    diary_page_hash = mapped_column(String(64), nullable=True)
+    # set while working through a long backlog, e.g. after downtime
+    diary_catchup_page = mapped_column(Integer, nullable=True)
+
+    # failed scrapes in a row, see record_diary_failure in utils/poll_schedule.py
+    scrape_failures = mapped_column(Integer, nullable=True, default=0)
+    last_scrape_error = mapped_column(String, nullable=True)
+    quarantined_at = mapped_column(DateTime, nullable=True)
+
+    # work leases so several worker processes can share users, see utils/leases.py
+    diary_lease_owner = mapped_column(String, nullable=True)
+    diary_lease_expires = mapped_column(DateTime, nullable=True)
+    watch_lease_owner = mapped_column(String, nullable=True)
+    watch_lease_expires = mapped_column(DateTime, nullable=True)
+
+
 class FollowedUser(Base):
-    __tablename__ = "followed_users"
+    __tablename__ = "follows"
 
     id = mapped_column(Integer, primary_key=True)
     guild_id = mapped_column(BigInteger, nullable=False)
     channel_id = mapped_column(BigInteger, nullable=False)
-    letterboxd_username = mapped_column(String, nullable=False)
+    letterboxd_user_id = mapped_column(
+        Integer, ForeignKey("letterboxd_users.id", ondelete="CASCADE"), nullable=False
+    )
     last_diary_entry = mapped_column(DateTime, nullable=True)
 
-    # A user can only be followed once per server channel
+    letterboxd_user = relationship(LetterboxdUser, lazy="joined")
+
     __table_args__ = (
+        # A user can only be followed once per server channel. Also serves the
+        # per-channel lookups (/following, /whowatched)
         UniqueConstraint(
             "guild_id",
             "channel_id",
-            "letterboxd_username",
-            name="_guild_channel_user_uc",
+            "letterboxd_user_id",
+            name="uq_follows_channel_user",
         ),
+        # follows of a user, for diary checks and work claims
+        Index("ix_follows_letterboxd_user", "letterboxd_user_id"),
     )
 
+    @property
+    def letterboxd_username(self) -> str:
+        return self.letterboxd_user.username
+
 
 class MovieWatch(Base):
-    __tablename__ = "movie_watches"
+    __tablename__ = "watches"
 
-    id = mapped_column(Integer, primary_key=True)
-    movie_id = mapped_column(Integer, nullable=False)  # or should i use slug?
-    letterboxd_username = mapped_column(String, nullable=False)
-    rating = mapped_column(Integer, nullable=True)
+    # primary key doubles as the index for syncing one user's films
+    letterboxd_user_id = mapped_column(
+        Integer,
+        ForeignKey("letterboxd_users.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    movie_id = mapped_column(Integer, primary_key=True)  # letterboxd film id
+    rating = mapped_column(SmallInteger, nullable=True)
     liked = mapped_column(Boolean, nullable=True)
     watch_date = mapped_column(DateTime, nullable=True)
+    # last time a scrape saw it on letterboxd, full syncs drop what they didn't
+    seen_at = mapped_column(DateTime, nullable=True)
     # todo: review/diary entry url
 
+    letterboxd_user = relationship(LetterboxdUser, lazy="joined")
+
     __table_args__ = (
-        UniqueConstraint(
+        # /whowatched: one film, the channel's users. includes what the embed
+        # shows so postgres can answer from the index alone
+        Index(
+            "ix_watches_movie_user",
             "movie_id",
-            "letterboxd_username",
-            name="_movie_user_uc",
+            "letterboxd_user_id",
+            postgresql_include=["rating", "liked", "watch_date"],
         ),
     )
 
+    @property
+    def letterboxd_username(self) -> str:
+        return self.letterboxd_user.username
+
+
+class Film(Base):
+    __tablename__ = "films"
+
+    letterboxd_id = mapped_column(Integer, primary_key=True, autoincrement=False)
+    slug = mapped_column(String, nullable=False, unique=True)
+    title = mapped_column(String, nullable=False)
+    year = mapped_column(Integer, nullable=True)
+    genres = mapped_column(JSON, nullable=False, default=list)
+    poster = mapped_column(String, nullable=True)
+    updated_at = mapped_column(DateTime, nullable=False)
+
+
+class ChannelFilmStats(Base):
+    """Running totals of a channel's followed users' watches, per film.
+
+    Updated alongside watches (see utils/stats.py) so /top doesn't have to
+    group every follower's history.
+    """
+
+    __tablename__ = "channel_film_stats"
+
+    guild_id = mapped_column(BigInteger, primary_key=True)
+    channel_id = mapped_column(BigInteger, primary_key=True)
+    movie_id = mapped_column(Integer, primary_key=True)
+    watch_count = mapped_column(Integer, nullable=False, default=0)
+    rating_sum = mapped_column(Integer, nullable=False, default=0)  # out of 10
+    rating_count = mapped_column(Integer, nullable=False, default=0)
+    like_count = mapped_column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        # /top only looks at films enough of the channel has rated
+        Index("ix_channel_film_stats_rated", "guild_id", "channel_id", "rating_count"),
+    )
+
+
+class DiaryMonth(Base):
+    """Diary entries logged per user per month, for /leaderboard and /stats."""
+
+    __tablename__ = "diary_months"
+
+    letterboxd_user_id = mapped_column(
+        Integer,
+        ForeignKey("letterboxd_users.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    month = mapped_column(DateTime, primary_key=True)  # first of the month
+    entries = mapped_column(Integer, nullable=False, default=0)
+
+
+def channel_film_totals(*filters):
+    """channel_film_stats rows computed from scratch for the matching follows.
+
+    Columns are in channel_film_totals_columns order.
+    """
+    return (
+        select(
+            FollowedUser.guild_id,
+            FollowedUser.channel_id,
+            MovieWatch.movie_id,
+            func.count(),
+            func.coalesce(func.sum(MovieWatch.rating), 0),
+            func.count(MovieWatch.rating),
+            func.sum(case((MovieWatch.liked.is_(True), 1), else_=0)),
+        )
+        .join(
+            MovieWatch, MovieWatch.letterboxd_user_id == FollowedUser.letterboxd_user_id
+        )
+        .where(*filters)
+        .group_by(FollowedUser.guild_id, FollowedUser.channel_id, MovieWatch.movie_id)
+    )
+
+
+channel_film_totals_columns = [
+    "guild_id",
+    "channel_id",
+    "movie_id",
+    "watch_count",
+    "rating_sum",
+    "rating_count",
+    "like_count",
+]
+
 
-engine = create_engine(DATABASE_URL)
+class Review(Base):
+    """Review text by diary entry link, so each review is only fetched once."""
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    __tablename__ = "reviews"
+
+    entry_link = mapped_column(String, primary_key=True)
+    text = mapped_column(Text, nullable=True)  # none if the page had no review
+    fetched_at = mapped_column(DateTime, nullable=False)
+
+
+class CommandTreeSync(Base):
+    """Slash command definitions last synced to discord, see utils/command_sync.py."""
+
+    __tablename__ = "command_tree_syncs"
+
+    scope = mapped_column(String, primary_key=True)  # guild id, or "global"
+    definitions_hash = mapped_column(String(64), nullable=False)
+    synced_at = mapped_column(DateTime, nullable=False)
+
+
+class DiaryOutbox(Base):
+    """Diary embeds waiting to be sent by the discord process.
+
+    Rows are deleted once they're sent. batch_nonce is stamped on a batch's
+    rows just before it's sent, so a retry resends exactly the same batch
+    under the same nonce.
+    """
+
+    __tablename__ = "diary_outbox"
+
+    id = mapped_column(Integer, primary_key=True)
+    follow_id = mapped_column(
+        Integer, ForeignKey("follows.id", ondelete="CASCADE"), nullable=False
+    )
+    guild_id = mapped_column(BigInteger, nullable=False)
+    channel_id = mapped_column(BigInteger, nullable=False)
+    embed = mapped_column(JSON, nullable=False)
+    diary_entry_date = mapped_column(DateTime, nullable=False)
+    created_at = mapped_column(DateTime, nullable=False)
+    attempts = mapped_column(Integer, nullable=False, default=0)
+    next_attempt_at = mapped_column(DateTime)
+    batch_nonce = mapped_column(String(25))
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+class WorkerStats(Base):
+    """Scraping numbers each worker process reports, see utils/worker_stats.py."""
+
+    __tablename__ = "worker_stats"
+
+    worker_id = mapped_column(String, primary_key=True)
+    stats = mapped_column(JSON, nullable=False)
+    updated_at = mapped_column(DateTime, nullable=False)
+
+
+def async_database_url(url: str) -> URL:
+    # DATABASE_URL usually names the sync driver (postgresql://), swap in the
+    # async one so existing configs keep working
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+
+    if backend == "postgresql":
+        return parsed.set(drivername="postgresql+asyncpg")
+    if backend == "sqlite":
+        return parsed.set(drivername="sqlite+aiosqlite")
+
+    return parsed
+
+
+class PoolMetrics:
+    """Connection pool usage, fed by pool events."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.exhausted = 0
+        self.held_seconds = 0.0
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.checkouts += 1
+        self.checked_out += 1
+        self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+        connection_record.info["checked_out_at"] = time.monotonic()
+
+        if self.checked_out >= config.DB_POOL_SIZE + config.DB_MAX_OVERFLOW:
+            # anything else that needs a connection now waits up to DB_POOL_TIMEOUT
+            self.exhausted += 1
+            print("warning: database connection pool exhausted")
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop("checked_out_at", None)
+        if checked_out_at is None:
+            return
+
+        self.checked_out -= 1
+        self.held_seconds += time.monotonic() - checked_out_at
+
+
+database_url = async_database_url(config.DATABASE_URL)
+
+SQLITE_BUSY_TIMEOUT = 60
+
+# sqlite (benchmarks, local testing) picks its own pool. it only allows one
+# writer, so wait for the lock rather than failing after the default 5s
+pool_options = (
+    {"connect_args": {"timeout": SQLITE_BUSY_TIMEOUT}}
+    if database_url.get_backend_name() == "sqlite"
+    else {
+        "pool_size": config.DB_POOL_SIZE,
+        "max_overflow": config.DB_MAX_OVERFLOW,
+        "pool_timeout": config.DB_POOL_TIMEOUT,
+        "pool_pre_ping": True,
+    }
+)
+
+engine = create_async_engine(database_url, **pool_options)
+
+pool_metrics = PoolMetrics()
+event.listen(engine.sync_engine.pool, "checkout", pool_metrics.on_checkout)
+event.listen(engine.sync_engine.pool, "checkin", pool_metrics.on_checkin)
+event.listen(
+    engine.sync_engine, "before_cursor_execute", lambda *args: metrics.db_queries.inc()
+)
+
+metrics.Gauge(
+    "bot_db_pool_checked_out",
+    "Database connections currently checked out.",
+    lambda: pool_metrics.checked_out,
+)
+metrics.Gauge(
+    "bot_db_pool_peak_checked_out",
+    "Most database connections checked out at once.",
+    lambda: pool_metrics.peak_checked_out,
+)
+metrics.Gauge(
+    "bot_db_pool_exhausted",
+    "Times every pooled connection was in use.",
+    lambda: pool_metrics.exhausted,
+)
+metrics.Gauge(
+    "bot_db_pool_held_seconds",
+    "Total time connections have been checked out for.",
+    lambda: pool_metrics.held_seconds,
+)
+
+# objects stay usable after commit, nothing gets lazily reloaded outside a session
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+
+# set once create_tables has run in this process. the bot connects to discord
+# while it's still running, so anything touching the database waits on this
+schema_ready = asyncio.Event()
+
+
+async def create_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_missing_columns)
+        await conn.run_sync(migrate_username_tables)
+        await conn.run_sync(backfill_channel_film_stats)
+
+    schema_ready.set()
+
+
+def add_missing_columns(conn: Connection):
+    # create_all won't touch existing tables, so add any new (nullable) columns
+    inspector = inspect(conn)
+
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.execute(
+                text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+            )
+
+
+def migrate_username_tables(conn: Connection):
+    """Move follows and watches keyed by username onto letterboxd_users ids.
+
+    The old followed_users and movie_watches tables are copied into follows
+    and watches, then dropped. Runs once, in the create_tables transaction.
+    """
+    if not inspect(conn).has_table("followed_users"):
+        return
+
+    print("Migrating followed_users and movie_watches to letterboxd user ids...")
+
+    # usernames used to be stored as typed, merge case variants
+    conn.execute(
+        text(
+            "DELETE FROM letterboxd_users WHERE id NOT IN "
+            "(SELECT min(id) FROM letterboxd_users GROUP BY lower(username))"
+        )
+    )
+    conn.execute(text("UPDATE letterboxd_users SET username = lower(username)"))
+
+    for old_table in ("followed_users", "movie_watches"):
+        conn.execute(
+            text(
+                "INSERT INTO letterboxd_users (username) "
+                f"SELECT DISTINCT lower(letterboxd_username) FROM {old_table} "
+                "WHERE true ON CONFLICT DO NOTHING"
+            )
+        )
+
+    # ids are kept so pending outbox rows still point at the right follow
+    conn.execute(
+        text(
+            "INSERT INTO follows "
+            "(id, guild_id, channel_id, letterboxd_user_id, last_diary_entry) "
+            "SELECT f.id, f.guild_id, f.channel_id, u.id, f.last_diary_entry "
+            "FROM followed_users f "
+            "JOIN letterboxd_users u ON u.username = lower(f.letterboxd_username) "
+            "WHERE true ORDER BY f.id ON CONFLICT DO NOTHING"
+        )
+    )
+    conn.execute(
+        text(
+            "INSERT INTO watches "
+            "(letterboxd_user_id, movie_id, rating, liked, watch_date) "
+            "SELECT u.id, w.movie_id, w.rating, w.liked, w.watch_date "
+            "FROM movie_watches w "
+            "JOIN letterboxd_users u ON u.username = lower(w.letterboxd_username) "
+            "WHERE true ON CONFLICT DO NOTHING"
+        )
+    )
+
+    # the outbox's foreign key still points at followed_users, recreate it
+    outbox = Base.metadata.tables["diary_outbox"]
+    follows = Base.metadata.tables["follows"]
+    pending = [
+        dict(row)
+        for row in conn.execute(
+            outbox.select().where(outbox.c.follow_id.in_(select(follows.c.id)))
+        ).mappings()
+    ]
+    outbox.drop(conn)
+    outbox.create(conn)
+    if pending:
+        conn.execute(outbox.insert(), pending)
+
+    conn.execute(text("DROP TABLE followed_users"))
+    conn.execute(text("DROP TABLE movie_watches"))
+
+    if conn.dialect.name == "postgresql":
+        # ids were inserted explicitly, move the sequences past them
+        for table in ("follows", "diary_outbox"):
+            conn.execute(
+                text(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                    f"coalesce(max(id), 0) + 1, false) FROM {table}"
+                )
+            )
+
+
+def backfill_channel_film_stats(conn: Connection):
+    # fill the totals once for watches that were synced before they existed
+    if conn.scalar(select(ChannelFilmStats.movie_id).limit(1)) is not None:
+        return
+    if conn.scalar(select(MovieWatch.movie_id).limit(1)) is None:
+        return
+
+    print("Building channel film stats...")
+    conn.execute(
+        insert(ChannelFilmStats).from_select(
+            channel_film_totals_columns, channel_film_totals()
+        )
+    )
+
 
+def dialect_insert(db: AsyncSession):
+    # upserts are dialect specific. postgres in prod, sqlite for local benchmarks
+    if db.get_bind().dialect.name == "sqlite":
+        return sqlite.insert
 
-def create_tables():
-    Base.metadata.create_all(bind=engine)
+    return postgresql.insert
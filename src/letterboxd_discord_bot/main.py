@@ -1,3 +1,5 @@
+import asyncio
+
 import discord
 from discord.ext import commands
 from dotenv import load_dotenv
@@ -5,7 +7,13 @@ from rich import print
 
 from . import config
 from .cogs import letterboxd_cog, tasks_cog
-from .database import create_tables
+from .database import create_tables, engine
+from .utils.command_sync import sync_command_tree
+from .utils.film_cache import film_cache
+from .utils.film_index import film_index
+from .utils.http import letterboxd_http
+from .utils.metrics import record_startup, serve_metrics
+from .worker import run_worker
 
 description = """Hello bro"""
 
@@ -26,23 +34,86 @@ class LetterboxdBot(commands.Bot):
             intents=intents,
             allowed_mentions=allowed_mentions,
         )
+        self.metrics_server = None
+        self.startup_task: asyncio.Task | None = None
 
     async def setup_hook(self):
+        self.metrics_server = await serve_metrics()
+
         await tasks_cog.setup(self)
         await letterboxd_cog.setup(self, config.TEST_GUILD_ID)
 
         print("Cogs initialised")
 
+        # nothing above touches the database, so connecting to the gateway
+        # isn't held up by it. the rest happens alongside
+        self.startup_task = asyncio.create_task(self.finish_startup())
+
+    async def finish_startup(self):
+        try:
+            await init_database()
+        except Exception as e:
+            # commands and loops would wait on the schema forever
+            print(f"error: database setup failed: {e!r}")
+            await self.close()
+            return
+
+        await self.wait_until_ready()
+
+        try:
+            guild = (
+                discord.Object(id=config.TEST_GUILD_ID)
+                if config.TEST_GUILD_ID
+                else None
+            )
+            await sync_command_tree(self.tree, guild, force=config.FORCE_COMMAND_SYNC)
+        except Exception as e:
+            print(f"error: syncing commands failed: {e!r}")
+
+        await warm_caches()
+
     async def close(self):
+        await letterboxd_http.close()
+        if self.metrics_server:
+            await self.metrics_server.cleanup()
         await super().close()
+        await engine.dispose()
 
     async def on_ready(self):
         print(f"Logged in as {self.user}")
+        record_startup("gateway_ready")
+
+
+async def init_database():
+    print("Initializing database...")
+    await create_tables()
+    print("Database tables verified.")
+    record_startup("schema_ready")
+
+
+async def warm_caches():
+    try:
+        await film_index.load()
+        await film_cache.warm(config.FILM_CACHE_SIZE)
+    except Exception as e:
+        # they fill up as they're used anyway
+        print(f"error: warming caches failed: {e!r}")
+        return
+
+    record_startup("caches_warm")
+
+
+async def start_worker():
+    await init_database()
 
+    try:
+        await run_worker()
+    finally:
+        await engine.dispose()
 
-print("Initializing database...")
-create_tables()
-print("Database tables verified.")
 
-bot = LetterboxdBot()
-bot.run(config.DISCORD_TOKEN)
+if config.BOT_MODE == "worker":
+    asyncio.run(start_worker())
+else:
+    bot = LetterboxdBot()
+    bot.run(config.DISCORD_TOKEN)
@@ -0,0 +1,55 @@
+import hashlib
+import json
+
+import discord
+from discord import app_commands
+
+from ..database import CommandTreeSync, SessionLocal, dialect_insert
+from .misc import utcnow
+
+
+def definitions_hash(
+    tree: app_commands.CommandTree, guild: discord.abc.Snowflake | None
+) -> str:
+    definitions = [command.to_dict(tree) for command in tree.get_commands(guild=guild)]
+    definitions.sort(key=lambda definition: (definition["type"], definition["name"]))
+
+    return hashlib.sha256(json.dumps(definitions, sort_keys=True).encode()).hexdigest()
+
+
+async def sync_command_tree(
+    tree: app_commands.CommandTree,
+    guild: discord.abc.Snowflake | None = None,
+    force: bool = False,
+) -> bool:
+    """Push slash commands to discord, if they've changed since the last sync.
+
+    Discord rate limits syncs hard, and every restart or deploy used to do
+    one. The last synced hash is kept in the database so every process
+    shares it. Returns whether a sync happened.
+    """
+    scope = str(guild.id) if guild else "global"
+    new_hash = definitions_hash(tree, guild)
+
+    async with SessionLocal() as db:
+        last_sync = await db.get(CommandTreeSync, scope)
+
+    if not force and last_sync and last_sync.definitions_hash == new_hash:
+        print(f"Commands ({scope}) unchanged, not syncing")
+        return False
+
+    await tree.sync(guild=guild)
+
+    async with SessionLocal() as db:
+        values = {"scope": scope, "definitions_hash": new_hash, "synced_at": utcnow()}
+        stmt = dialect_insert(db)(CommandTreeSync).values(values)
+        await db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["scope"],
+                set_={k: v for k, v in values.items() if k != "scope"},
+            )
+        )
+        await db.commit()
+
+    print(f"Synced commands ({scope})")
+    return True
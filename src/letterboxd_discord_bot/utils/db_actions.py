@@ -1,112 +1,810 @@
+import asyncio
 import datetime
-from dataclasses import dataclass
+from collections import defaultdict
+from dataclasses import dataclass, field, replace
+from functools import partial
 from typing import Any
 
 import discord
-from discord.ext import commands
-from letterboxdpy import movie as lb_movie  # type: ignore
-from letterboxdpy import user as lb_user  # type: ignore
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, func, select
+from sqlalchemy import update as sql_update
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..database import FollowedUser, MovieWatch
-from ..utils.embeds import create_diary_embed
-from ..utils.letterboxd_actions import get_diary
+from .. import config
+from ..database import (
+    DiaryOutbox,
+    Film,
+    FollowedUser,
+    LetterboxdUser,
+    MovieWatch,
+    SessionLocal,
+    dialect_insert,
+    normalize_username,
+)
+from ..utils.embeds import create_diary_digest_embed, create_diary_embed
+from ..utils.film_cache import film_cache
+from ..utils.film_index import film_index
+from ..utils.leases import (
+    WORKER_ID,
+    claim_diary_users,
+    claim_watch_sync_users,
+    holds_lease,
+)
+from ..utils.letterboxd_actions import (
+    DiaryWatermark,
+    get_diary,
+    get_diary_page_hash,
+    get_recent_liked_films,
+    get_user,
+    iter_user_films,
+)
+from ..utils.misc import utcnow
+from ..utils.outbox import count_pending_messages, outbox_ready
+from ..utils.poll_schedule import record_diary_check, record_diary_failure
+from ..utils.scraper import Lane, scrape_executor
+from ..utils.stats import (
+    WatchState,
+    apply_watch_changes,
+    lock_user_watches,
+    record_diary_months,
+)
+
+
+@dataclass(frozen=True)
+class Follow:
+    """Detached copy of a FollowedUser row, safe to hand to scrape tasks."""
+
+    id: int
+    guild_id: int
+    channel_id: int
+    last_diary_entry: datetime.datetime | None
 
 
 @dataclass(frozen=True)
 class DiaryUpdate:
-    channel: Any  # todo: it has bad typing
+    follow: Follow
     embed: discord.Embed
-    diary_entry_date: datetime.datetime
+    diary_entry_date: datetime.date
 
 
-def collect_diary_updates(db: Session, bot: commands.Bot) -> list[DiaryUpdate]:
-    channels = db.query(FollowedUser).all()
-    updates: list[DiaryUpdate] = []
+@dataclass(frozen=True)
+class DiaryCheck:
+    new_entries: int
+    updates: list[DiaryUpdate]
+    # None if it didn't move (failed check, empty diary)
+    watermark: DiaryWatermark | None = None
+    # new entries, oldest first. recorded as watches along with the watermark
+    entries: list[dict] = field(default_factory=list)
 
-    for channel in channels:
-        guild = bot.get_guild(channel.guild_id)
-        if not guild:
-            continue
 
-        ch = guild.get_channel(channel.channel_id)
-        if not ch:
-            continue
+async def get_user_id(db: AsyncSession, username: str) -> int:
+    """Id of a letterboxd user's row, created if it doesn't exist yet."""
+    username = normalize_username(username)
+
+    await db.execute(
+        dialect_insert(db)(LetterboxdUser)
+        .values(username=username)
+        .on_conflict_do_nothing()
+    )
+    return (
+        await db.scalars(select(LetterboxdUser.id).filter_by(username=username))
+    ).one()
+
+
+async def get_follows_by_user(usernames: list[str]) -> dict[str, list[Follow]]:
+    follows_by_user: dict[str, list[Follow]] = defaultdict(list)
+
+    # watermarks only move once an update is sent, so entries still sitting in
+    # the outbox count as seen or they'd be queued again
+    pending = (
+        select(
+            DiaryOutbox.follow_id,
+            func.max(DiaryOutbox.diary_entry_date).label("diary_entry_date"),
+        )
+        .group_by(DiaryOutbox.follow_id)
+        .subquery()
+    )
+
+    async with SessionLocal() as db:
+        rows = await db.execute(
+            select(FollowedUser, pending.c.diary_entry_date)
+            .outerjoin(pending, pending.c.follow_id == FollowedUser.id)
+            .where(
+                FollowedUser.letterboxd_user_id.in_(
+                    select(LetterboxdUser.id).where(
+                        LetterboxdUser.username.in_(usernames)
+                    )
+                )
+            )
+        )
+
+        for follow, pending_entry_date in rows:
+            seen = [
+                date for date in (follow.last_diary_entry, pending_entry_date) if date
+            ]
+            follows_by_user[follow.letterboxd_username].append(
+                Follow(
+                    id=follow.id,
+                    guild_id=follow.guild_id,
+                    channel_id=follow.channel_id,
+                    last_diary_entry=max(seen) if seen else None,
+                )
+            )
+
+    return follows_by_user
+
+
+async def get_diary_watermarks(usernames: list[str]) -> dict[str, DiaryWatermark]:
+    async with SessionLocal() as db:
+        rows = await db.execute(
+            select(
+                LetterboxdUser.username,
+                LetterboxdUser.diary_last_entry_id,
+                LetterboxdUser.diary_recent_entry_ids,
+                LetterboxdUser.diary_page_hash,
+                LetterboxdUser.diary_catchup_page,
+            ).where(
+                LetterboxdUser.username.in_(usernames),
+                LetterboxdUser.diary_last_entry_id.is_not(None),
+            )
+        )
+
+        return {
+            username: DiaryWatermark(
+                last_entry_id,
+                frozenset(recent_entry_ids or ()),
+                page_hash,
+                catchup_page,
+            )
+            for username, last_entry_id, recent_entry_ids, page_hash, catchup_page in rows
+        }
+
+
+async def check_due_diaries(limit: int = config.SCRAPE_BATCH_SIZE) -> int:
+    """Scrape the diaries of users that are due into the outbox.
+
+    Each user's updates are queued as soon as their scrape finishes. Safe to
+    run from several processes at once, users are leased to whoever claims
+    them. Returns how many updates were queued.
+    """
+    # discord is down or way behind, let it catch up before scraping more
+    if await count_pending_messages() >= config.OUTBOX_MAX_PENDING:
+        print("warning: outbox is full, skipping diary check")
+        return 0
+
+    usernames = await claim_diary_users(limit)
+    if not usernames:
+        return 0
+
+    # group follows by letterboxd user so each profile is only scraped once
+    follows_by_user = await get_follows_by_user(usernames)
+    watermarks = await get_diary_watermarks(usernames)
+
+    queued = 0
+    checked: set[str] = set()
+    errors: dict[str, Exception] = {}
+
+    async for username, check in scrape_executor.stream_per_user(
+        {
+            username: partial(
+                collect_user_diary_updates,
+                username,
+                follows,
+                watermarks.get(username),
+            )
+            for username, follows in follows_by_user.items()
+        },
+        on_error=errors.__setitem__,
+        task="diary",
+        lane=Lane.DIARY,
+    ):
+        await save_diary_check(username, check)
+        checked.add(username)
+
+        if check.updates:
+            queued += len(check.updates)
+            outbox_ready.set()
+
+    # one broken profile only backs itself off, everyone else was saved above
+    for username, error in errors.items():
+        async with SessionLocal() as db:
+            if await holds_lease(db, username, LetterboxdUser.diary_lease_owner):
+                await record_diary_failure(db, username, error)
+                await db.commit()
+
+    # unfollowed since being claimed
+    for username in usernames:
+        if username not in checked and username not in errors:
+            await save_diary_check(username, DiaryCheck(0, []))
+
+    return queued
 
-        user = lb_user.User(username=channel.letterboxd_username)
-        last_diary_entry = channel.last_diary_entry
 
-        new_diary_entries = get_diary(
+async def save_diary_check(username: str, check: DiaryCheck):
+    # outbox rows, watches and stats, the diary watermark, the next poll time
+    # and the lease release go in one transaction, so every new entry is
+    # queued and counted exactly once
+    now = utcnow()
+
+    async with SessionLocal() as db:
+        if not await holds_lease(db, username, LetterboxdUser.diary_lease_owner):
+            # ran past the lease and another worker has the user now
+            print(f"warning: lost the diary lease on {username}, not saving")
+            return
+
+        if check.entries:
+            # diary entries double as an incremental watch sync
+            user_id = await get_user_id(db, username)
+            await record_diary_watches(db, user_id, check.entries)
+
+        for update in check.updates:
+            db.add(
+                DiaryOutbox(
+                    follow_id=update.follow.id,
+                    guild_id=update.follow.guild_id,
+                    channel_id=update.follow.channel_id,
+                    embed=update.embed.to_dict(),
+                    diary_entry_date=datetime.datetime.combine(
+                        update.diary_entry_date, datetime.time()
+                    ),
+                    created_at=now,
+                )
+            )
+
+        if check.watermark:
+            updated = await db.scalar(
+                sql_update(LetterboxdUser)
+                .where(
+                    LetterboxdUser.username == username,
+                    LetterboxdUser.diary_lease_owner == WORKER_ID,
+                )
+                .values(
+                    diary_last_entry_id=check.watermark.last_entry_id,
+                    diary_recent_entry_ids=sorted(
+                        check.watermark.recent_entry_ids, reverse=True
+                    ),
+                    diary_page_hash=check.watermark.page_hash,
+                    diary_catchup_page=check.watermark.catchup_page,
+                )
+                .returning(LetterboxdUser.id)
+            )
+            if updated is None:
+                # the lease moved on, drop the outbox rows with everything else
+                await db.rollback()
+                return
+
+        await record_diary_check(
+            db,
+            username,
+            check.new_entries,
+            catching_up=bool(check.watermark and check.watermark.catchup_page),
+        )
+        await db.commit()
+
+
+async def collect_user_diary_updates(
+    username: str, follows: list[Follow], watermark: DiaryWatermark | None
+) -> DiaryCheck:
+    """Scrape a user's new diary entries and build the updates to send."""
+    # users checked before diary ids were tracked fall back to the channels'
+    # date watermarks once, scraping back to the oldest so every channel is covered
+    channel_watermarks = [
+        follow.last_diary_entry.date() for follow in follows if follow.last_diary_entry
+    ]
+
+    page_hash = await get_diary_page_hash(username)
+    if watermark and watermark.page_hash == page_hash and not watermark.catchup_page:
+        # first diary page is the same as last time, nothing new to parse
+        return DiaryCheck(0, [])
+
+    user = await scrape_executor.run(partial(get_user, username))
+
+    # only capped with an id watermark, the date one can't be held part way
+    new_diary_entries, entry_ids, next_page = await scrape_executor.run(
+        partial(
+            get_diary,
             user,
-            last_diary_entry.date() if last_diary_entry else None,
+            watermark,
+            min(channel_watermarks) if channel_watermarks else None,
+            config.DIARY_MAX_PAGES_PER_CHECK if watermark else None,
         )
+    )
 
-        new_diary_entries.reverse()  # reverse so newest = last
+    if watermark and next_page:
+        # more backlog than one check reads, the rest comes over the next ones
+        new_watermark: DiaryWatermark | None = watermark.hold(entry_ids, next_page)
+    elif watermark:
+        new_watermark = watermark.advance(entry_ids)
+    else:
+        new_watermark = DiaryWatermark.start(entry_ids)
 
-        if not new_diary_entries:
-            continue
+    if new_watermark:
+        new_watermark = replace(new_watermark, page_hash=page_hash)
+
+    new_diary_entries.reverse()  # reverse so newest = last
+
+    if not new_diary_entries:
+        return DiaryCheck(0, [], new_watermark)
 
-        films = [lb_movie.Movie(entry["slug"]) for entry in new_diary_entries]
+    pending_by_follow: list[tuple[Follow, list[dict]]] = []
 
-        for diary_entry, film in zip(new_diary_entries, films):
-            embed = create_diary_embed(user, film, diary_entry)
+    for follow in follows:
+        if watermark:
+            # everything past the watermark is new to every channel
+            pending = new_diary_entries
+        elif follow.last_diary_entry:
+            since = follow.last_diary_entry.date()
+            pending = [
+                diary_entry
+                for diary_entry in new_diary_entries
+                if diary_entry["date"] > since
+            ]
+        else:
+            # channel hasn't seen anything yet, just send the newest
+            pending = new_diary_entries[-1:]
+
+        pending_by_follow.append((follow, pending))
+
+    # long runs (catching up after downtime, say) go out as one digest, so
+    # only entries sent on their own need their film scraped and an embed
+    full_entries = {
+        diary_entry["id"]: diary_entry
+        for _, pending in pending_by_follow
+        if len(pending) < config.DIARY_DIGEST_MIN_ENTRIES
+        for diary_entry in pending
+    }
+
+    films = await asyncio.gather(
+        *(film_cache.get(entry["slug"]) for entry in full_entries.values())
+    )
+
+    # embeds only depend on the user and the entry, so each entry is rendered
+    # (and its review fetched) once and shared by every channel
+    rendered = await asyncio.gather(
+        *(
+            create_diary_embed(user, film, diary_entry)
+            for diary_entry, film in zip(full_entries.values(), films)
+        )
+    )
+    embeds = dict(zip(full_entries, rendered))
+
+    updates: list[DiaryUpdate] = []
+
+    for follow, pending in pending_by_follow:
+        if len(pending) >= config.DIARY_DIGEST_MIN_ENTRIES:
             updates.append(
                 DiaryUpdate(
-                    channel=ch, embed=embed, diary_entry_date=diary_entry["date"]
+                    follow=follow,
+                    embed=create_diary_digest_embed(user, pending[::-1]),
+                    diary_entry_date=max(entry["date"] for entry in pending),
+                )
+            )
+            continue
+
+        updates.extend(
+            DiaryUpdate(
+                follow=follow,
+                embed=embeds[diary_entry["id"]],
+                diary_entry_date=diary_entry["date"],
+            )
+            for diary_entry in pending
+        )
+
+    return DiaryCheck(len(new_diary_entries), updates, new_watermark, new_diary_entries)
+
+
+async def get_full_sync_due(usernames: list[str]) -> set[str]:
+    cutoff = utcnow() - datetime.timedelta(days=config.FULL_WATCH_SYNC_DAYS)
+
+    async with SessionLocal() as db:
+        synced = set(
+            await db.scalars(
+                select(LetterboxdUser.username).where(
+                    LetterboxdUser.last_full_sync >= cutoff
                 )
             )
+        )
+
+    return set(usernames) - synced
+
 
-        # store newest diary entry date
-        channel.last_diary_entry = new_diary_entries[-1]["date"]
+async def mark_watches_synced(db: AsyncSession, username: str, full: bool):
+    now = utcnow()
+    values = {
+        "username": username,
+        "last_watch_sync": now,
+        "watch_lease_owner": None,
+        "watch_lease_expires": None,
+    }
+    if full:
+        values |= {
+            "last_full_sync": now,
+            "film_sync_started_at": None,
+            "film_sync_page": None,
+        }
+
+    stmt = dialect_insert(db)(LetterboxdUser).values(values)
+    await db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["username"],
+            set_={k: v for k, v in values.items() if k != "username"},
+        )
+    )
 
-    db.commit()
-    return updates
 
+async def mark_watches_changed(db: AsyncSession, user_id: int):
+    await db.execute(
+        sql_update(LetterboxdUser)
+        .where(LetterboxdUser.id == user_id)
+        .values(watches_changed_at=utcnow())
+    )
 
-def update_all_user_films(db: Session):
-    # Get all unique followed users
-    followed_users = db.query(FollowedUser.letterboxd_username).distinct().all()
 
-    for (username,) in followed_users:
-        print(f"Updating watches for user: {username}")
+async def sync_due_user_films(limit: int = config.SCRAPE_BATCH_SIZE) -> int:
+    """Sync watches for users that are due. Returns how many users were claimed."""
+    usernames = await claim_watch_sync_users(limit)
+    if not usernames:
+        return 0
 
-        update_user_films(db, username)
+    # new diary entries are recorded as they're posted, so most runs only need
+    # the recent likes. the full film list is a safety net for everything else
+    # (rating changes without a diary entry, unlikes, unlogged films)
+    full_sync_due = await get_full_sync_due(usernames)
 
-        db.commit()
+    await scrape_executor.run_per_user(
+        {
+            username: partial(
+                sync_user_films if username in full_sync_due else sync_user_likes,
+                username,
+            )
+            for username in usernames
+        },
+        task="watch sync",
+        lane=Lane.SYNC,
+    )
 
+    return len(usernames)
 
-def update_user_films(db: Session, username: str):
-    user = lb_user.User(username=username)
 
-    user_films = user.get_films()  # todo: modify fn to return more info - date, review url. may need to use different function?
+@dataclass(frozen=True)
+class FilmSyncCursor:
+    started_at: datetime.datetime
+    page: int  # first page still to write
 
-    # todo: this can def be optimised
-    for movie_slug, watch in user_films["movies"].items():
-        movie_id = watch["id"]
 
-        # Check if this watch already exists
-        existing_watch = (
-            db.query(MovieWatch)
-            .filter_by(movie_id=movie_id, letterboxd_username=username)
-            .first()
+async def start_film_sync(db: AsyncSession, user_id: int) -> FilmSyncCursor:
+    """Pick up an interrupted full sync where it left off, or start a new one."""
+    started_at, last_page = (
+        await db.execute(
+            select(
+                LetterboxdUser.film_sync_started_at, LetterboxdUser.film_sync_page
+            ).where(LetterboxdUser.id == user_id)
         )
+    ).one()
 
-        rating = watch.get("rating")
-        liked = watch.get("liked")
+    resume_cutoff = utcnow() - datetime.timedelta(hours=config.FILM_SYNC_RESUME_HOURS)
+    if started_at and last_page and started_at >= resume_cutoff:
+        # the last written page is read again, in case films moved up a page
+        # since. an overlap is harmless, a gap would drop watches
+        return FilmSyncCursor(started_at, last_page)
 
-        if existing_watch:
-            if existing_watch.rating != rating:
-                existing_watch.rating = rating
+    cursor = FilmSyncCursor(utcnow(), 1)
+    await db.execute(
+        sql_update(LetterboxdUser)
+        .where(LetterboxdUser.id == user_id)
+        .values(film_sync_started_at=cursor.started_at, film_sync_page=None)
+    )
+    return cursor
 
-            if existing_watch.liked != liked:
-                existing_watch.liked = liked
-        else:
-            new_watch = MovieWatch(
-                movie_id=movie_id,
-                letterboxd_username=username,
-                rating=rating,
-                liked=liked,
+
+async def sync_user_films(username: str):
+    """Sync a user's whole film list, writing it a page at a time.
+
+    Each page is committed along with the cursor, so a sync that times out or
+    crashes carries on from there next time. Watches the sync never saw are
+    removed at the end, they've been unlogged.
+    """
+    print(f"Updating watches for user: {username}")
+
+    async with SessionLocal() as db:
+        user_id = await get_user_id(db, username)
+        cursor = await start_film_sync(db, user_id)
+        await db.commit()
+
+    async def lease_lost(db: AsyncSession) -> bool:
+        if await holds_lease(db, username, LetterboxdUser.watch_lease_owner):
+            return False
+        # ran past the lease and another worker has the user now
+        print(f"warning: lost the watch sync lease on {username}, stopping")
+        return True
+
+    if cursor.page > 1:
+        print(f"Resuming watch sync for {username} from page {cursor.page}")
+
+    # todo: modify fn to return more info - date, review url. may need to use different function?
+    async for page, films in iter_user_films(username, cursor.page):
+        async with SessionLocal() as db:
+            if await lease_lost(db):
+                return
+
+            await apply_film_page(db, user_id, films)
+            await db.execute(
+                sql_update(LetterboxdUser)
+                .where(LetterboxdUser.id == user_id)
+                .values(film_sync_page=page)
             )
-            db.add(new_watch)
+            await db.commit()
+
+    async with SessionLocal() as db:
+        if await lease_lost(db):
+            return
+
+        await remove_unseen_watches(db, user_id, cursor.started_at)
+        await mark_watches_synced(db, username, full=True)
+        await db.commit()
+
+
+async def sync_user_likes(username: str):
+    liked_films = await get_recent_liked_films(username)
+
+    await record_liked_films(username, liked_films)
+
+
+async def record_liked_films(username: str, films: dict[str, dict]):
+    async with SessionLocal() as db:
+        if not await holds_lease(db, username, LetterboxdUser.watch_lease_owner):
+            print(f"warning: lost the watch sync lease on {username}, not saving")
+            return
+
+        user_id = await get_user_id(db, username)
+        rows: list[dict[str, Any]] = [
+            {
+                "movie_id": int(watch["id"]),
+                "letterboxd_user_id": user_id,
+                "rating": watch.get("rating"),
+                "liked": True,
+                "seen_at": utcnow(),
+            }
+            for watch in films.values()
+        ]
+
+        await add_unknown_films(db, films)
+
+        await lock_user_watches(db, user_id)
+        existing = {
+            movie_id: (rating, liked)
+            for movie_id, rating, liked in await db.execute(
+                select(MovieWatch.movie_id, MovieWatch.rating, MovieWatch.liked).where(
+                    MovieWatch.letterboxd_user_id == user_id,
+                    MovieWatch.movie_id.in_([row["movie_id"] for row in rows]),
+                )
+            )
+        }
+
+        # only films that weren't already liked change anything
+        changes: dict[int, tuple[WatchState, WatchState]] = {}
+        for row in rows:
+            old = existing.get(row["movie_id"])
+            if not old:
+                changes[row["movie_id"]] = (None, (row["rating"], True))
+            elif not old[1]:
+                changes[row["movie_id"]] = (old, (old[0], True))
+
+        if changes:
+            stmt = dialect_insert(db)(MovieWatch).values(
+                [row for row in rows if row["movie_id"] in changes]
+            )
+            await db.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=["letterboxd_user_id", "movie_id"],
+                    set_={"liked": True, "seen_at": stmt.excluded.seen_at},
+                )
+            )
+            await apply_watch_changes(db, user_id, changes)
+            await mark_watches_changed(db, user_id)
+
+        await mark_watches_synced(db, username, full=False)
+        await db.commit()
+
+
+async def record_diary_watches(db: AsyncSession, user_id: int, entries: list[dict]):
+    """Record new diary entries as watches. Runs in the caller's transaction."""
+    # entries are oldest first, so later entries for the same film win
+    latest: dict[int, dict] = {}
+    films: dict[str, dict] = {}
+    for diary_entry in entries:
+        movie_id = diary_entry.get("film_id")
+        if not movie_id:
+            # no film id on the diary page, the full sync will pick it up
+            continue
+
+        films[diary_entry["slug"]] = {
+            "id": movie_id,
+            "name": diary_entry.get("name"),
+            "year": diary_entry.get("release"),
+        }
+
+        actions = diary_entry.get("actions", {})
+        latest[movie_id] = {
+            "movie_id": movie_id,
+            "rating": actions.get("rating"),
+            "liked": bool(actions.get("liked")),
+            "watch_date": datetime.datetime.combine(
+                diary_entry["date"], datetime.time()
+            ),
+            "seen_at": utcnow(),
+        }
+
+    if not latest:
+        return
+
+    await add_unknown_films(db, films)
+
+    await lock_user_watches(db, user_id)
+    existing = {
+        movie_id: (rating, liked, watch_date)
+        for movie_id, rating, liked, watch_date in await db.execute(
+            select(
+                MovieWatch.movie_id,
+                MovieWatch.rating,
+                MovieWatch.liked,
+                MovieWatch.watch_date,
+            ).where(
+                MovieWatch.letterboxd_user_id == user_id,
+                MovieWatch.movie_id.in_(latest),
+            )
+        )
+    }
+
+    rows = []
+    changes: dict[int, tuple[WatchState, WatchState]] = {}
+    for movie_id, row in latest.items():
+        old = existing.get(movie_id)
+        # don't let a backdated entry overwrite a newer watch
+        if old and old[2] and old[2] > row["watch_date"]:
+            continue
+
+        rows.append({**row, "letterboxd_user_id": user_id})
+        changes[movie_id] = (
+            old[:2] if old else None,
+            (row["rating"], row["liked"]),
+        )
+
+    if rows:
+        stmt = dialect_insert(db)(MovieWatch).values(rows)
+        await db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["letterboxd_user_id", "movie_id"],
+                set_={
+                    "rating": stmt.excluded.rating,
+                    "liked": stmt.excluded.liked,
+                    "watch_date": stmt.excluded.watch_date,
+                    "seen_at": stmt.excluded.seen_at,
+                },
+            )
+        )
+        await apply_watch_changes(db, user_id, changes)
+        await mark_watches_changed(db, user_id)
+
+    await record_diary_months(
+        db, user_id, [diary_entry["date"] for diary_entry in entries]
+    )
+
+
+UPSERT_BATCH_SIZE = 1000
+
+# placeholder films from film lists are stale straight away, so the film cache
+# scrapes the full metadata the first time one is actually used
+PLACEHOLDER_FILM_DATE = datetime.datetime(1970, 1, 1)
+
+
+async def add_unknown_films(db: AsyncSession, films: dict[str, dict]):
+    # feed the title index (and films table) from film lists we already have
+    rows = []
+    for slug, watch in films.items():
+        if slug in film_index or not watch.get("name"):
+            continue
+
+        rows.append(
+            {
+                "letterboxd_id": int(watch["id"]),
+                "slug": slug,
+                "title": watch["name"],
+                "year": watch.get("year"),
+                "genres": [],
+                "updated_at": PLACEHOLDER_FILM_DATE,
+            }
+        )
+        film_index.add(slug, watch["name"], watch.get("year"))
+
+    insert = dialect_insert(db)
+    for i in range(0, len(rows), UPSERT_BATCH_SIZE):
+        await db.execute(
+            insert(Film)
+            .values(rows[i : i + UPSERT_BATCH_SIZE])
+            .on_conflict_do_nothing()
+        )
+
+
+async def apply_film_page(db: AsyncSession, user_id: int, films: dict[str, dict]):
+    """Write one page of a user's film list. Runs in the caller's transaction."""
+    if not films:
+        return
+
+    now = utcnow()
+    rows: list[dict[str, Any]] = [
+        {
+            "movie_id": int(watch["id"]),
+            "letterboxd_user_id": user_id,
+            "rating": watch.get("rating"),
+            "liked": watch.get("liked"),
+            "seen_at": now,
+        }
+        for watch in films.values()
+    ]
+
+    await lock_user_watches(db, user_id)
+    existing = {
+        movie_id: (rating, liked)
+        for movie_id, rating, liked in await db.execute(
+            select(MovieWatch.movie_id, MovieWatch.rating, MovieWatch.liked).where(
+                MovieWatch.letterboxd_user_id == user_id,
+                MovieWatch.movie_id.in_([row["movie_id"] for row in rows]),
+            )
+        )
+    }
+
+    await add_unknown_films(db, films)
+
+    # unchanged rows are written too, to mark them as seen
+    stmt = dialect_insert(db)(MovieWatch).values(rows)
+    await db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["letterboxd_user_id", "movie_id"],
+            set_={
+                "rating": stmt.excluded.rating,
+                "liked": stmt.excluded.liked,
+                "seen_at": stmt.excluded.seen_at,
+            },
+        )
+    )
+
+    changes: dict[int, tuple[WatchState, WatchState]] = {
+        row["movie_id"]: (existing.get(row["movie_id"]), (row["rating"], row["liked"]))
+        for row in rows
+        if existing.get(row["movie_id"]) != (row["rating"], row["liked"])
+    }
+    if changes:
+        await apply_watch_changes(db, user_id, changes)
+        await mark_watches_changed(db, user_id)
+
+
+async def remove_unseen_watches(
+    db: AsyncSession, user_id: int, since: datetime.datetime
+):
+    """Drop watches no scrape has seen since `since`, the end of a full sync.
+
+    Runs in the caller's transaction.
+    """
+    unseen = (MovieWatch.seen_at.is_(None)) | (MovieWatch.seen_at < since)
+
+    await lock_user_watches(db, user_id)
+    removed = (
+        await db.execute(
+            select(MovieWatch.movie_id, MovieWatch.rating, MovieWatch.liked).where(
+                MovieWatch.letterboxd_user_id == user_id, unseen
+            )
+        )
+    ).all()
+    if not removed:
+        return
 
-    db.commit()
+    await db.execute(
+        delete(MovieWatch).where(MovieWatch.letterboxd_user_id == user_id, unseen)
+    )
+    await apply_watch_changes(
+        db,
+        user_id,
+        {movie_id: ((rating, liked), None) for movie_id, rating, liked in removed},
+    )
+    await mark_watches_changed(db, user_id)
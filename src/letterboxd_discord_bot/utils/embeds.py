@@ -1,13 +1,21 @@
 import datetime
+from typing import TYPE_CHECKING
 
 import discord
-from bs4 import Tag
-from letterboxdpy import movie as lb_movie  # type: ignore
-from letterboxdpy import user as lb_user  # type: ignore
-from letterboxdpy.core.scraper import parse_url  # type: ignore
 
-from ..database import MovieWatch  # type: ignore
+from ..database import ChannelFilmStats, MovieWatch, pool_metrics  # type: ignore
+from . import metrics
+from .film_cache import FilmInfo
+from .leases import WORKER_ID
 from .misc import escape
+from .outbox import MAX_EMBED_CHARS_PER_MESSAGE
+from .reviews import get_review
+from .stats import UserStats
+from .taste import Compatibility, Recommendation, TasteProfile
+from .worker_stats import ScrapeStats
+
+if TYPE_CHECKING:
+    from letterboxdpy import user as lb_user  # type: ignore
 
 EMOJI_STAR = "<:lb_star:1403009346492698764>"
 EMOJI_STAR_HALF = "<:lb_halfstar:1403009343867191386>"
@@ -22,23 +30,18 @@ def get_stars(rating_out_of_10: int):
     return EMOJI_STAR * full_stars + EMOJI_STAR_HALF * half_star
 
 
-def create_watchers_embed(
-    movie: lb_movie.Movie, watchers: list[MovieWatch]
-) -> discord.Embed:
+def create_watchers_embed(film: FilmInfo, watchers: list[MovieWatch]) -> discord.Embed:
     embed = discord.Embed(
-        title=movie.title,
-        url=movie.url,
+        title=film.title,
+        url=film.url,
         color=discord.Color.green() if watchers else discord.Color.red(),
     )
 
-    if hasattr(movie, "genres"):
-        genres = ", ".join(
-            genre["name"] for genre in movie.genres if genre.get("type") == "genre"
-        )
-        embed.set_footer(text=f"{movie.year} - {genres}")
+    if film.genres:
+        embed.set_footer(text=f"{film.year} - {', '.join(film.genres)}")
 
-    if movie.poster:
-        embed.set_thumbnail(url=movie.poster)
+    if film.poster:
+        embed.set_thumbnail(url=film.poster)
 
     if watchers:
         lines = []
@@ -53,8 +56,7 @@ def create_watchers_embed(
                 parts.append("❤️")
 
             if watcher.watch_date:
-                dt = datetime.datetime.strptime(watcher.watch_date, "%d %b %Y")
-                timestamp = int(dt.timestamp())
+                timestamp = int(watcher.watch_date.timestamp())
                 parts.append(f"<t:{timestamp}:R>")
 
             watch_info = (" - " + " ".join(parts)) if parts else ""
@@ -63,13 +65,13 @@ def create_watchers_embed(
 
         embed.description = "\n".join(lines)
     else:
-        embed.description = f"Nobody's watched '{escape(movie.title or '')}'."
+        embed.description = f"Nobody's watched '{escape(film.title or '')}'."
 
     return embed
 
 
-def create_diary_embed(
-    user: lb_user.User, movie: lb_movie.Movie, diary_entry: dict
+async def create_diary_embed(
+    user: "lb_user.User", film: FilmInfo, diary_entry: dict
 ) -> discord.Embed:
     actions = diary_entry.get("actions", {})
 
@@ -79,20 +81,10 @@ def create_diary_embed(
     review_text = None
 
     if reviewed and url:
+        review_text = await get_review(url)
         url = "https://letterboxd.com" + url
-
-        review_dom = parse_url(url)
-        review_text_elem = review_dom.find("div", class_="js-review-body")
-
-        if isinstance(review_text_elem, Tag):
-            # replace <br> with newline characters
-            for br in review_text_elem.find_all("br"):
-                br.replace_with("\n")
-
-            paragraphs = review_text_elem.find_all("p")
-            review_text = "\n\n".join(p.get_text().strip() for p in paragraphs).strip()
     else:
-        url = movie.url
+        url = film.url
 
     description_parts = []
 
@@ -127,7 +119,7 @@ def create_diary_embed(
         formatted_date = date.strftime("%B %-d")
         embed.add_field(name="", value=f"-# {formatted_date}")
 
-    poster = diary_entry.get("poster") or getattr(movie, "poster", None)
+    poster = diary_entry.get("poster") or film.poster
     if poster:
         embed.set_thumbnail(url=poster)
 
@@ -136,11 +128,283 @@ def create_diary_embed(
         name=f"{user.display_name} watched", icon_url=avatar_url, url=user.url
     )
 
-    if hasattr(movie, "genres"):
-        genres = ", ".join(
-            genre["name"] for genre in movie.genres if genre.get("type") == "genre"
+    if film.genres:
+        embed.set_footer(text=f"{film.year} - {', '.join(film.genres)}")
+
+    return embed
+
+
+# discord rejects a message with a longer embed description
+MAX_DESCRIPTION_CHARS = 4096
+
+
+def format_digest_line(diary_entry: dict) -> str:
+    name = diary_entry["name"]
+    if diary_entry.get("release"):
+        name += f" ({diary_entry['release']})"
+
+    line = f"[{escape(name)}](https://letterboxd.com/film/{diary_entry['slug']}/)"
+
+    actions = diary_entry.get("actions", {})
+    if actions.get("rating") is not None:
+        line += " " + get_stars(actions["rating"])
+    if actions.get("liked"):
+        line += " ❤️"
+    if actions.get("rewatched"):
+        line += " 🔁"
+
+    return f"• {line} - {diary_entry['date'].strftime('%B %-d')}"
+
+
+def create_diary_digest_embed(
+    user: "lb_user.User", diary_entries: list[dict]
+) -> discord.Embed:
+    """One embed for a run of diary entries, newest first.
+
+    Built from the diary page alone, so unlike create_diary_embed there's
+    nothing else to scrape. Entries that don't fit are summed up in a last
+    "…and N more" line.
+    """
+    title = f"{len(diary_entries)} films"
+    author = f"{user.display_name} watched"
+    # the description, title and author all count towards the embed's total
+    max_chars = min(
+        MAX_DESCRIPTION_CHARS, MAX_EMBED_CHARS_PER_MESSAGE - len(title) - len(author)
+    )
+
+    lines: list[str] = []
+    chars = 0
+    for i, diary_entry in enumerate(diary_entries):
+        line = format_digest_line(diary_entry)
+        added = len(line) + (1 if lines else 0)
+
+        # always leave room to say how many were left out
+        left_out = len(diary_entries) - i - 1
+        more = len(f"\n…and {left_out} more") if left_out else 0
+        if chars + added + more > max_chars:
+            break
+
+        lines.append(line)
+        chars += added
+
+    if len(lines) < len(diary_entries):
+        lines.append(f"…and {len(diary_entries) - len(lines)} more")
+
+    embed = discord.Embed(
+        title=title,
+        description="\n".join(lines),
+        color=discord.Color.green(),
+        url=f"https://letterboxd.com/{user.username}/films/diary/",
+    )
+
+    avatar_url = user.avatar.get("url")
+    embed.set_author(name=author, icon_url=avatar_url, url=user.url)
+
+    return embed
+
+
+def format_film(film: FilmInfo) -> str:
+    name = f"{film.title} ({film.year})" if film.year else film.title
+    return f"[{escape(name)}]({film.url})"
+
+
+def create_compat_embed(
+    a: TasteProfile,
+    b: TasteProfile,
+    compatibility: Compatibility,
+    films: dict[int, FilmInfo],
+) -> discord.Embed:
+    embed = discord.Embed(
+        title=f"{a.username} & {b.username}",
+        description=f"**{compatibility.percent}% compatible**, "
+        f"{compatibility.shared} films in common",
+        color=discord.Color.green()
+        if compatibility.similarity > 0
+        else discord.Color.red(),
+    )
+
+    for name, movie_ids in (
+        ("Both loved", compatibility.both_loved),
+        ("Disagreed on", compatibility.disagreed),
+    ):
+        lines = [f"• {format_film(films[i])}" for i in movie_ids if i in films]
+        if lines:
+            embed.add_field(name=name, value="\n".join(lines), inline=False)
+
+    return embed
+
+
+def create_similar_embed(
+    profile: TasteProfile, similar: list[tuple[TasteProfile, float]]
+) -> discord.Embed:
+    lines = [
+        f"• [{escape(other.username)}](https://letterboxd.com/{other.username}/) - "
+        f"{round((similarity + 1) * 50)}% compatible"
+        for other, similarity in similar
+    ]
+
+    return discord.Embed(
+        title=f"Most similar to {profile.username}",
+        description="\n".join(lines) or "Nobody else to compare with yet.",
+        color=discord.Color.blue(),
+    )
+
+
+def create_recommend_embed(
+    profile: TasteProfile,
+    recommendations: list[Recommendation],
+    films: dict[int, FilmInfo],
+) -> discord.Embed:
+    lines = [
+        f"• {format_film(films[recommendation.movie_id])} - "
+        f"seen by {recommendation.support} similar users"
+        for recommendation in recommendations
+        if recommendation.movie_id in films
+    ]
+
+    return discord.Embed(
+        title=f"Recommended for {profile.username}",
+        description="\n".join(lines)
+        or "Nothing to recommend yet, similar users need to rate more films.",
+        color=discord.Color.green(),
+    )
+
+
+def create_top_embed(
+    top: list[ChannelFilmStats], films: dict[int, FilmInfo]
+) -> discord.Embed:
+    lines = [
+        f"{i}. {format_film(films[stats.movie_id])} - "
+        f"{get_stars(round(stats.rating_sum / stats.rating_count))} "
+        f"({stats.rating_sum / stats.rating_count / 2:.1f}, {stats.rating_count} ratings)"
+        for i, stats in enumerate(top, 1)
+        if stats.movie_id in films
+    ]
+
+    return discord.Embed(
+        title="Top rated here",
+        description="\n".join(lines) or "Not enough ratings yet.",
+        color=discord.Color.gold(),
+    )
+
+
+def create_leaderboard_embed(
+    month: datetime.date, leaders: list[tuple[str, int]]
+) -> discord.Embed:
+    lines = [
+        f"{i}. [{escape(username)}](https://letterboxd.com/{username}/) - "
+        f"{entries} {'film' if entries == 1 else 'films'}"
+        for i, (username, entries) in enumerate(leaders, 1)
+    ]
+
+    return discord.Embed(
+        title=f"Most films logged in {month:%B}",
+        description="\n".join(lines) or "Nobody has logged anything yet this month.",
+        color=discord.Color.gold(),
+    )
+
+
+def create_user_stats_embed(stats: UserStats) -> discord.Embed:
+    embed = discord.Embed(
+        title=stats.username,
+        url=f"https://letterboxd.com/{stats.username}/",
+        color=discord.Color.blue(),
+    )
+
+    embed.add_field(name="Films", value=str(stats.watched))
+    embed.add_field(name="Liked", value=str(stats.liked))
+    if stats.average_rating is not None:
+        embed.add_field(
+            name="Average rating",
+            value=f"{get_stars(round(stats.average_rating))} "
+            f"({stats.average_rating / 2:.2f} over {stats.rated} ratings)",
+            inline=False,
         )
-        if genres:
-            embed.set_footer(text=f"{movie.year} - {genres}")
+
+    embed.add_field(name="Logged this month", value=str(stats.this_month))
+    embed.add_field(name="Logged this year", value=str(stats.this_year))
+
+    return embed
+
+
+def format_hit_rate(lookups: dict[str, float], hits: list[str]) -> str:
+    total = sum(lookups.values())
+    if not total:
+        return "no lookups yet"
+
+    hit_count = sum(lookups.get(result, 0) for result in hits)
+    return f"{hit_count / total:.0%} of {total:g}"
+
+
+def format_loop(loop: str, runs: int, total: float, last: float) -> str:
+    return f"**{loop}**: last {last:.1f}s, avg {total / runs:.1f}s over {runs} runs"
+
+
+def create_stats_embed(pending_updates: int, scrape: ScrapeStats) -> discord.Embed:
+    """Scraping covers every process that scrapes, the rest is this process'."""
+    embed = discord.Embed(title="Bot stats", color=discord.Color.blue())
+
+    loops = [
+        format_loop(loop, runs, total, last)
+        for loop, (runs, total, last) in scrape.loops.items()
+        if runs
+    ]
+    runs, total = metrics.loop_seconds.summary(loop="delivery")
+    if runs:
+        last = metrics.loop_last_seconds.get(loop="delivery")
+        loops.append(format_loop("delivery", runs, total, last))
+    embed.add_field(
+        name="Loops", value="\n".join(loops) or "nothing has run yet", inline=False
+    )
+
+    if scrape.processes:
+        lookups = scrape.lookups
+        scraping = "\n".join(
+            [
+                (
+                    f"{scrape.letterboxd_requests:g} letterboxd requests, "
+                    f"{scrape.scrape_failures:g} failed user scrapes"
+                ),
+                "page cache: "
+                + format_hit_rate(lookups.get("page", {}), ["hit", "not_modified"]),
+                "film cache: "
+                + format_hit_rate(lookups.get("film", {}), ["memory", "db"]),
+                "review cache: " + format_hit_rate(lookups.get("review", {}), ["db"]),
+            ]
+        )
+    else:
+        scraping = "no workers have reported yet"
+    embed.add_field(
+        name=f"Scraping (workers: {scrape.processes})", value=scraping, inline=False
+    )
+
+    slowest = [
+        f"{escape(timing.username)} ({timing.task}) - {timing.seconds:.1f}s, "
+        f"{timing.requests} requests"
+        for timing in scrape.slowest
+    ]
+    if slowest:
+        embed.add_field(name="Slowest users", value="\n".join(slowest), inline=False)
+
+    embed.add_field(
+        name="Database",
+        value=f"{metrics.db_queries.total():g} queries, "
+        f"{pool_metrics.checked_out} connections in use "
+        f"(peak {pool_metrics.peak_checked_out}, pool ran out {pool_metrics.exhausted} times)",
+        inline=False,
+    )
+
+    sends, send_seconds = metrics.discord_send_seconds.summary()
+    embed.add_field(
+        name="Delivery",
+        value=f"{pending_updates} updates pending, "
+        f"{metrics.discord_sends.get(result='sent'):g} messages sent"
+        + (f" (avg {send_seconds / sends:.2f}s)" if sends else "")
+        + f", {metrics.discord_sends.get(result='failed'):g} failed",
+        inline=False,
+    )
+
+    # workers only report scraping, see /metrics on each for the rest
+    embed.set_footer(text=f"Database and delivery since {WORKER_ID} started")
 
     return embed
@@ -0,0 +1,184 @@
+import datetime
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import partial
+from typing import TYPE_CHECKING
+
+from sqlalchemy import select
+
+from .. import config
+from ..database import Film, SessionLocal, dialect_insert
+from . import metrics
+from .film_index import film_index
+from .letterboxd_actions import get_movie
+from .misc import utcnow
+from .scraper import scrape_executor
+
+if TYPE_CHECKING:
+    from letterboxdpy import movie as lb_movie  # type: ignore
+
+
+@dataclass(frozen=True)
+class FilmInfo:
+    letterboxd_id: int
+    slug: str
+    title: str
+    year: int | None
+    genres: tuple[str, ...]
+    poster: str | None
+    updated_at: datetime.datetime
+
+    @property
+    def url(self) -> str:
+        return f"https://letterboxd.com/film/{self.slug}/"
+
+    @classmethod
+    def from_movie(cls, movie: "lb_movie.Movie") -> "FilmInfo":
+        genres = getattr(movie, "genres", None) or []
+
+        return cls(
+            letterboxd_id=int(movie.letterboxd_id),
+            slug=movie.slug,
+            title=movie.title,
+            year=movie.year,
+            genres=tuple(
+                genre["name"] for genre in genres if genre.get("type") == "genre"
+            ),
+            poster=movie.poster,
+            updated_at=utcnow(),
+        )
+
+    @classmethod
+    def from_row(cls, film: Film) -> "FilmInfo":
+        return cls(
+            letterboxd_id=film.letterboxd_id,
+            slug=film.slug,
+            title=film.title,
+            year=film.year,
+            genres=tuple(film.genres or ()),
+            poster=film.poster,
+            updated_at=film.updated_at,
+        )
+
+
+class FilmCache:
+    """Film metadata by slug or letterboxd id.
+
+    Lookups go LRU -> films table -> letterboxd. Entries older than the ttl get
+    re-scraped, but stale data is still served if that scrape fails.
+    """
+
+    def __init__(self, max_size: int, ttl: datetime.timedelta):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._by_slug: OrderedDict[str, FilmInfo] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _is_fresh(self, film: FilmInfo) -> bool:
+        return utcnow() - film.updated_at < self.ttl
+
+    def _remember(self, film: FilmInfo):
+        with self._lock:
+            self._by_slug[film.slug] = film
+            self._by_slug.move_to_end(film.slug)
+
+            while len(self._by_slug) > self.max_size:
+                self._by_slug.popitem(last=False)
+
+    def _from_memory(self, slug: str) -> FilmInfo | None:
+        with self._lock:
+            film = self._by_slug.get(slug)
+            if film:
+                self._by_slug.move_to_end(slug)
+            return film
+
+    async def _from_db(self, **filters) -> FilmInfo | None:
+        async with SessionLocal() as db:
+            row = await db.scalar(select(Film).filter_by(**filters).limit(1))
+            return FilmInfo.from_row(row) if row else None
+
+    async def _store(self, film: FilmInfo):
+        async with SessionLocal() as db:
+            values = {
+                "letterboxd_id": film.letterboxd_id,
+                "slug": film.slug,
+                "title": film.title,
+                "year": film.year,
+                "genres": list(film.genres),
+                "poster": film.poster,
+                "updated_at": film.updated_at,
+            }
+            stmt = dialect_insert(db)(Film).values(values)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["letterboxd_id"],
+                set_={k: v for k, v in values.items() if k != "letterboxd_id"},
+            )
+            await db.execute(stmt)
+            await db.commit()
+
+        self._remember(film)
+        film_index.add(film.slug, film.title, film.year)
+
+    async def add(self, movie: "lb_movie.Movie") -> FilmInfo:
+        """Cache a movie that was already scraped elsewhere."""
+        film = FilmInfo.from_movie(movie)
+        await self._store(film)
+        return film
+
+    async def get(self, slug: str) -> FilmInfo:
+        """Get a film by slug, scraping letterboxd on a miss."""
+        film = self._from_memory(slug)
+        source = "memory"
+
+        if not film:
+            film = await self._from_db(slug=slug)
+            source = "db"
+            if film:
+                self._remember(film)
+
+        if film and self._is_fresh(film):
+            metrics.film_cache_lookups.inc(result=source)
+            return film
+
+        metrics.film_cache_lookups.inc(result="scrape")
+
+        try:
+            return await self.add(await scrape_executor.run(partial(get_movie, slug)))
+        except Exception:
+            if film:
+                print(f"warning: refreshing film {slug} failed, using stale data")
+                return film
+            raise
+
+    async def warm(self, limit: int):
+        """Load the most recently scraped films into memory."""
+        async with SessionLocal() as db:
+            films = list(
+                await db.scalars(
+                    select(Film).order_by(Film.updated_at.desc()).limit(limit)
+                )
+            )
+
+        # oldest first, so the newest end up least likely to be evicted
+        for film in reversed(films):
+            self._remember(FilmInfo.from_row(film))
+
+    async def get_stored(self, movie_ids: list[int]) -> dict[int, FilmInfo]:
+        """Whatever the films table has for these ids, without scraping anything.
+
+        For lists of films, where a stale poster or missing genres don't matter.
+        """
+        if not movie_ids:
+            return {}
+
+        async with SessionLocal() as db:
+            films = await db.scalars(
+                select(Film).where(Film.letterboxd_id.in_(movie_ids))
+            )
+            return {film.letterboxd_id: FilmInfo.from_row(film) for film in films}
+
+
+film_cache = FilmCache(
+    config.FILM_CACHE_SIZE, datetime.timedelta(hours=config.FILM_CACHE_TTL_HOURS)
+)
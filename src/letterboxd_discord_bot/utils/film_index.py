@@ -0,0 +1,150 @@
+import bisect
+import re
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+
+from sqlalchemy import select
+
+from ..database import Film, SessionLocal
+
+MIN_TRIGRAM_SIMILARITY = 0.3
+
+
+@dataclass(frozen=True)
+class IndexedFilm:
+    slug: str
+    title: str
+    year: int | None
+
+    @property
+    def display_name(self) -> str:
+        return f"{self.title} ({self.year})" if self.year else self.title
+
+
+def normalize_title(title: str) -> str:
+    # "Amélie!" -> "amelie"
+    title = unicodedata.normalize("NFKD", title)
+    title = "".join(c for c in title if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^\w]+", " ", title.lower()).split())
+
+
+def trigrams(text: str) -> set[str]:
+    padded = f"  {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class FilmTitleIndex:
+    """In-memory title search over every film the bot has seen.
+
+    Matches are ranked exact title, then title prefix, then trigram similarity.
+    """
+
+    def __init__(self):
+        self._films: dict[str, IndexedFilm] = {}
+        self._by_title: dict[str, set[str]] = defaultdict(set)
+        self._sorted_titles: list[tuple[str, str]] = []
+        self._by_trigram: dict[str, set[str]] = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._films)
+
+    def __contains__(self, slug: str) -> bool:
+        return slug in self._films
+
+    def add(self, slug: str, title: str, year: int | None = None):
+        film = IndexedFilm(slug=slug, title=title, year=year)
+        normalized = normalize_title(title)
+
+        with self._lock:
+            existing = self._films.get(slug)
+            if existing == film:
+                return
+
+            if existing:
+                self._remove(existing)
+
+            self._films[slug] = film
+            self._by_title[normalized].add(slug)
+            bisect.insort(self._sorted_titles, (normalized, slug))
+            for trigram in trigrams(normalized):
+                self._by_trigram[trigram].add(slug)
+
+    def _remove(self, film: IndexedFilm):
+        normalized = normalize_title(film.title)
+
+        self._by_title[normalized].discard(film.slug)
+        i = bisect.bisect_left(self._sorted_titles, (normalized, film.slug))
+        if i < len(self._sorted_titles) and self._sorted_titles[i] == (
+            normalized,
+            film.slug,
+        ):
+            del self._sorted_titles[i]
+        for trigram in trigrams(normalized):
+            self._by_trigram[trigram].discard(film.slug)
+
+    async def load(self):
+        """Fill the index from the films table."""
+        async with SessionLocal() as db:
+            rows = (await db.execute(select(Film.slug, Film.title, Film.year))).all()
+
+        for slug, title, year in rows:
+            self.add(slug, title, year)
+
+    def search(self, query: str, limit: int = 25) -> list[IndexedFilm]:
+        normalized = normalize_title(query)
+        if not normalized:
+            return []
+
+        with self._lock:
+            ranked: dict[str, float] = {}
+
+            for slug in self._by_title.get(normalized, ()):
+                ranked[slug] = 3.0
+
+            i = bisect.bisect_left(self._sorted_titles, (normalized, ""))
+            while i < len(self._sorted_titles) and len(ranked) < limit * 4:
+                title, slug = self._sorted_titles[i]
+                if not title.startswith(normalized):
+                    break
+                ranked.setdefault(slug, 2.0)
+                i += 1
+
+            query_trigrams = trigrams(normalized)
+            shared: Counter[str] = Counter()
+            for trigram in query_trigrams:
+                shared.update(self._by_trigram.get(trigram, ()))
+
+            for slug, count in shared.items():
+                if slug in ranked:
+                    continue
+
+                title_trigrams = len(trigrams(normalize_title(self._films[slug].title)))
+                similarity = count / (len(query_trigrams) + title_trigrams - count)
+                if similarity >= MIN_TRIGRAM_SIMILARITY:
+                    ranked[slug] = similarity
+
+            best = sorted(
+                ranked.items(),
+                key=lambda item: (-item[1], len(self._films[item[0]].title)),
+            )
+            return [self._films[slug] for slug, _ in best[:limit]]
+
+    def resolve(self, query: str) -> IndexedFilm | None:
+        """Only returns a film when the query is a slug or an exact title."""
+        with self._lock:
+            film = self._films.get(query)
+            if film:
+                return film
+
+            slugs = self._by_title.get(normalize_title(query))
+            if not slugs:
+                return None
+
+            # ambiguous titles (remakes etc.) go to the letterboxd search instead
+            return self._films[next(iter(slugs))] if len(slugs) == 1 else None
+
+
+film_index = FilmTitleIndex()
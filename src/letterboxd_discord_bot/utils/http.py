@@ -0,0 +1,128 @@
+import asyncio
+import random
+from collections.abc import Awaitable, Callable, Mapping
+from typing import TYPE_CHECKING
+
+import aiohttp
+
+from .. import config
+from . import metrics
+from .http_cache import CachedPage, http_cache
+from .scraper import count_request, scrape_executor
+
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup
+
+# takes a url and request headers, returns (status, body, response headers)
+FetchFn = Callable[[str, dict[str, str]], Awaitable[tuple[int, str, Mapping[str, str]]]]
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+HEADERS = {
+    "user-agent": "Mozilla/5.0 (compatible; letterboxd-discord-bot)",
+    "accept": "text/html,application/xhtml+xml",
+    "accept-language": "en-US,en;q=0.9",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, url: str, status: int):
+        super().__init__(f"{status} fetching {url}")
+        self.url = url
+        self.status = status
+
+
+class LetterboxdHTTP:
+    """Async letterboxd fetcher on one shared keep-alive connection pool.
+
+    aiohttp only speaks HTTP/1.1, keep-alive reuse gets us most of what HTTP/2
+    would. Pass `fetch` (or use `set_fetch`) to swap the transport out, e.g.
+    for a local fake server.
+    """
+
+    def __init__(self, fetch: FetchFn | None = None):
+        self._fetch = fetch
+        self._session: aiohttp.ClientSession | None = None
+
+    def set_fetch(self, fetch: FetchFn | None):
+        self._fetch = fetch
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=config.HTTP_MAX_CONNECTIONS, keepalive_timeout=60
+                ),
+                timeout=aiohttp.ClientTimeout(total=config.HTTP_TIMEOUT),
+                headers=HEADERS,
+            )
+
+        return self._session
+
+    async def _aiohttp_fetch(
+        self, url: str, headers: dict[str, str]
+    ) -> tuple[int, str, Mapping[str, str]]:
+        async with self._get_session().get(url, headers=headers) as response:
+            return response.status, await response.text(), response.headers
+
+    async def fetch_page(self, url: str) -> CachedPage:
+        """Fetch a page through the response cache.
+
+        Fresh cached pages skip the request (and the rate limiter), stale ones
+        are revalidated with a conditional request. The cache is on disk (and
+        reads its whole index on first use), so it's used from a thread to
+        keep the event loop free.
+        """
+        if url.startswith("/"):
+            url = config.LETTERBOXD_URL + url
+
+        cached = await asyncio.to_thread(http_cache.get, url)
+        if cached and cached.entry.is_fresh():
+            metrics.http_cache_lookups.inc(result="hit")
+            return cached
+
+        fetch = self._fetch or self._aiohttp_fetch
+        headers = cached.entry.validators() if cached else {}
+
+        for attempt in range(config.HTTP_RETRIES + 1):
+            await scrape_executor.rate_limiter.acquire_async()
+            count_request()
+
+            try:
+                status, body, response_headers = await fetch(url, headers)
+            except (aiohttp.ClientError, TimeoutError):
+                if attempt == config.HTTP_RETRIES:
+                    raise
+            else:
+                if status == 304 and cached:
+                    metrics.http_cache_lookups.inc(result="not_modified")
+                    return await asyncio.to_thread(http_cache.refresh, cached)
+                if status == 200:
+                    metrics.http_cache_lookups.inc(result="miss")
+                    return await asyncio.to_thread(
+                        http_cache.put, url, body, response_headers
+                    )
+                if status not in RETRY_STATUSES or attempt == config.HTTP_RETRIES:
+                    raise HTTPError(url, status)
+
+            # full jitter backoff
+            await asyncio.sleep(random.uniform(0, min(30, 2**attempt)))
+
+        raise AssertionError("unreachable")
+
+    async def fetch_text(self, url: str) -> str:
+        return (await self.fetch_page(url)).text
+
+    async def fetch_dom(self, url: str) -> "BeautifulSoup":
+        # imported here, bs4 and lxml are slow to load and only scrapes need them
+        from bs4 import BeautifulSoup
+
+        return BeautifulSoup(await self.fetch_text(url), "lxml")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+letterboxd_http = LetterboxdHTTP()
@@ -0,0 +1,286 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from collections.abc import Mapping
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any
+from urllib.parse import urlsplit
+
+from .. import config
+from . import metrics
+from .scraper import count_request
+
+# how long a response is used without asking letterboxd again, by path. past
+# this it's revalidated with a conditional request, which is usually a 304
+TTL_RULES: list[tuple[re.Pattern, float]] = [
+    # film pages barely change, and a stale one is refreshed by film_cache anyway
+    (re.compile(r"^/film/[^/]+/"), 24 * 60 * 60),
+    # diary pages are read twice per check (change detection, then letterboxdpy)
+    (re.compile(r"^/[^/]+/films/diary/"), 60),
+    (re.compile(r"^/[^/]+/(films|likes)/"), 0),
+    # review/diary entry pages
+    (re.compile(r"^/[^/]+/film/[^/]+/"), 24 * 60 * 60),
+    # profiles, for display names and avatars
+    (re.compile(r"^/[^/]+/?$"), 60 * 60),
+]
+
+
+def ttl_for(url: str) -> float:
+    path = urlsplit(url).path
+    for pattern, ttl in TTL_RULES:
+        if pattern.match(path):
+            return ttl
+    return 0
+
+
+def url_key(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+@dataclass
+class CacheEntry:
+    url: str
+    etag: str | None
+    last_modified: str | None
+    # bodies are stored by the hash of their content, so identical pages
+    # (and a page that comes back unchanged) share one file
+    body_hash: str
+    size: int
+    stored_at: float
+    # where redirects ended up, letterboxdpy resolves some slugs from it
+    final_url: str | None = None
+
+    def is_fresh(self) -> bool:
+        return time.time() - self.stored_at < ttl_for(self.url)
+
+    def validators(self) -> dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["if-none-match"] = self.etag
+        if self.last_modified:
+            headers["if-modified-since"] = self.last_modified
+        return headers
+
+
+@dataclass(frozen=True)
+class CachedPage:
+    entry: CacheEntry
+    text: str
+
+
+class HTTPCache:
+    """On-disk letterboxd response cache, evicted least recently used first.
+
+    Shared by every process pointed at the same directory. Each process keeps
+    its own index in memory and falls back to disk for urls it hasn't seen, so
+    eviction is only roughly global.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.enabled = bool(directory)
+        self.max_bytes = max_bytes
+        self._entries_dir = Path(directory) / "entries"
+        self._bodies_dir = Path(directory) / "bodies"
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._body_refs: dict[str, int] = {}
+        self._size = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _body_path(self, body_hash: str) -> Path:
+        return self._bodies_dir / body_hash[:2] / body_hash
+
+    def _entry_path(self, key: str) -> Path:
+        return self._entries_dir / f"{key}.json"
+
+    def _write(self, path: Path, data: bytes):
+        # write then rename, so another process never reads half a file
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def _read_entry(self, path: Path) -> CacheEntry | None:
+        try:
+            return CacheEntry(**json.loads(path.read_text()))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _track(self, key: str, entry: CacheEntry):
+        # take the new body's ref before dropping the old one, an unchanged
+        # page points at the same body and it mustn't be deleted in between
+        refs = self._body_refs.get(entry.body_hash, 0)
+        if refs == 0:
+            self._size += entry.size
+        self._body_refs[entry.body_hash] = refs + 1
+
+        old = self._entries.pop(key, None)
+        if old:
+            self._release(old)
+
+        self._entries[key] = entry
+
+    def _release(self, entry: CacheEntry):
+        refs = self._body_refs.get(entry.body_hash, 0) - 1
+        if refs > 0:
+            self._body_refs[entry.body_hash] = refs
+            return
+
+        self._body_refs.pop(entry.body_hash, None)
+        self._size -= entry.size
+        self._body_path(entry.body_hash).unlink(missing_ok=True)
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+
+        # least recently used first, hits bump the entry file's mtime
+        paths = sorted(
+            self._entries_dir.glob("*.json"), key=lambda path: path.stat().st_mtime
+        )
+        for path in paths:
+            entry = self._read_entry(path)
+            if entry:
+                self._track(path.stem, entry)
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            key, entry = self._entries.popitem(last=False)
+            self._entry_path(key).unlink(missing_ok=True)
+            self._release(entry)
+
+    def get(self, url: str) -> CachedPage | None:
+        if not self.enabled:
+            return None
+
+        key = url_key(url)
+        path = self._entry_path(key)
+
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+
+            if not entry:
+                # maybe another process cached it
+                entry = self._read_entry(path)
+                if not entry:
+                    return None
+                self._track(key, entry)
+
+            self._entries.move_to_end(key)
+
+        try:
+            text = zlib.decompress(self._body_path(entry.body_hash).read_bytes())
+            os.utime(path)
+        except (OSError, zlib.error):
+            return None
+
+        return CachedPage(entry, text.decode())
+
+    def put(
+        self,
+        url: str,
+        text: str,
+        headers: Mapping[str, Any],
+        final_url: str | None = None,
+    ) -> CachedPage:
+        body = text.encode()
+        data = zlib.compress(body)
+
+        entry = CacheEntry(
+            url=url,
+            etag=headers.get("etag"),
+            last_modified=headers.get("last-modified"),
+            body_hash=hashlib.sha256(body).hexdigest(),
+            size=len(data),
+            stored_at=time.time(),
+            final_url=final_url if final_url and final_url != url else None,
+        )
+        if not self.enabled:
+            return CachedPage(entry, text)
+
+        key = url_key(url)
+        body_path = self._body_path(entry.body_hash)
+
+        with self._lock:
+            self._load()
+            if not body_path.exists():
+                self._write(body_path, data)
+            self._write(self._entry_path(key), json.dumps(asdict(entry)).encode())
+
+            self._track(key, entry)
+            self._evict()
+
+        return CachedPage(entry, text)
+
+    def refresh(self, page: CachedPage) -> CachedPage:
+        """Mark a cached response as still current after a 304."""
+        entry = CacheEntry(**{**asdict(page.entry), "stored_at": time.time()})
+
+        with self._lock:
+            key = url_key(entry.url)
+            self._write(self._entry_path(key), json.dumps(asdict(entry)).encode())
+            self._track(key, entry)
+
+        return CachedPage(entry, page.text)
+
+
+@dataclass
+class CachedResponse:
+    """Enough of a curl_cffi response for letterboxdpy's scraper."""
+
+    url: str
+    text: str
+    status_code: int = 200
+    reason: str = "OK"
+
+    @property
+    def headers(self) -> dict[str, str]:
+        return {}
+
+
+class CachingSession:
+    """Wraps letterboxdpy's requests session so its page loads use the cache."""
+
+    def __init__(self, session, cache: HTTPCache):
+        self._session = session
+        self._cache = cache
+
+    def __getattr__(self, name: str):
+        return getattr(self._session, name)
+
+    def get(self, url: str, headers: dict[str, str] | None = None, **kwargs):
+        cached = self._cache.get(url)
+        if cached and cached.entry.is_fresh():
+            metrics.http_cache_lookups.inc(result="hit")
+            return CachedResponse(cached.entry.final_url or url, cached.text)
+
+        request_headers = dict(headers or {})
+        if cached:
+            request_headers |= cached.entry.validators()
+
+        count_request()
+        response = self._session.get(url, headers=request_headers, **kwargs)
+
+        if response.status_code == 304 and cached:
+            metrics.http_cache_lookups.inc(result="not_modified")
+            self._cache.refresh(cached)
+            return CachedResponse(cached.entry.final_url or url, cached.text)
+
+        if response.status_code == 200:
+            metrics.http_cache_lookups.inc(result="miss")
+            self._cache.put(url, response.text, response.headers, str(response.url))
+
+        return response
+
+
+http_cache = HTTPCache(
+    config.HTTP_CACHE_DIR, int(config.HTTP_CACHE_MAX_MB * 1024 * 1024)
+)
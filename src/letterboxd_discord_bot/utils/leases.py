@@ -0,0 +1,103 @@
+import datetime
+import os
+import socket
+
+from sqlalchemy import ColumnElement, and_, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import InstrumentedAttribute
+
+from .. import config
+from ..database import FollowedUser, LetterboxdUser, SessionLocal
+from .misc import utcnow
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+async def claim_users(
+    due: ColumnElement[bool],
+    order_by: ColumnElement,
+    lease_owner: InstrumentedAttribute,
+    lease_expires: InstrumentedAttribute,
+    limit: int,
+) -> list[str]:
+    """Lease up to `limit` due users to this worker.
+
+    Rows are picked with FOR UPDATE SKIP LOCKED so concurrent workers never
+    claim the same user. A lease that isn't released (crashed worker, failed
+    scrape) expires after LEASE_SECONDS and the user becomes claimable again.
+    """
+    now = utcnow()
+
+    async with SessionLocal() as db:
+        users = (
+            await db.scalars(
+                select(LetterboxdUser)
+                .where(
+                    due,
+                    or_(lease_expires.is_(None), lease_expires < now),
+                    LetterboxdUser.id.in_(select(FollowedUser.letterboxd_user_id)),
+                )
+                .order_by(order_by)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+            )
+        ).all()
+
+        expires = now + datetime.timedelta(seconds=config.LEASE_SECONDS)
+        for user in users:
+            setattr(user, lease_owner.key, WORKER_ID)
+            setattr(user, lease_expires.key, expires)
+
+        usernames = [user.username for user in users]
+        await db.commit()
+
+    return usernames
+
+
+async def holds_lease(
+    db: AsyncSession, username: str, lease_owner: InstrumentedAttribute
+) -> bool:
+    """Whether this worker still holds a user's lease, locking their row if so.
+
+    A job that ran past LEASE_SECONDS may have lost the user to another
+    worker, so its results must not be saved. The lock stops the lease being
+    claimed while the caller's transaction commits.
+    """
+    held = await db.scalar(
+        select(LetterboxdUser.id)
+        .where(LetterboxdUser.username == username, lease_owner == WORKER_ID)
+        .with_for_update()
+    )
+    return held is not None
+
+
+async def claim_diary_users(limit: int) -> list[str]:
+    return await claim_users(
+        or_(
+            LetterboxdUser.next_diary_check.is_(None),
+            LetterboxdUser.next_diary_check <= utcnow(),
+        ),
+        LetterboxdUser.next_diary_check.asc().nulls_first(),
+        LetterboxdUser.diary_lease_owner,
+        LetterboxdUser.diary_lease_expires,
+        limit,
+    )
+
+
+async def claim_watch_sync_users(limit: int) -> list[str]:
+    cutoff = utcnow() - datetime.timedelta(hours=config.WATCH_SYNC_HOURS)
+
+    return await claim_users(
+        and_(
+            or_(
+                LetterboxdUser.last_watch_sync.is_(None),
+                LetterboxdUser.last_watch_sync <= cutoff,
+            ),
+            # diary probes find out when these come back
+            LetterboxdUser.quarantined_at.is_(None),
+        ),
+        LetterboxdUser.last_watch_sync.asc().nulls_first(),
+        LetterboxdUser.watch_lease_owner,
+        LetterboxdUser.watch_lease_expires,
+        limit,
+    )
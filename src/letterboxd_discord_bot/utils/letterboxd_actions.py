@@ -1,35 +1,292 @@
 import datetime
+import functools
+import hashlib
+import itertools
+import re
+from collections.abc import AsyncIterator, Iterable
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import TYPE_CHECKING
+from urllib.parse import quote
 
-from letterboxdpy import user as lb_user  # type: ignore
+from .http import HTTPError, letterboxd_http
+from .http_cache import CachingSession, http_cache
+from .scraper import scrape_executor
 
+if TYPE_CHECKING:
+    from letterboxdpy import movie as lb_movie  # type: ignore
+    from letterboxdpy import user as lb_user  # type: ignore
 
-def get_diary(user: lb_user.User, last_diary_entry: datetime.date | None = None):
+FILMS_PER_PAGE = 12 * 6
+
+# every letterboxd request should go through one of these (or letterboxd_http)
+# so it counts toward the global rate limit. the blocking ones are for
+# letterboxdpy calls that fetch pages themselves, run them on scrape_executor
+
+
+@functools.cache
+def load_letterboxdpy() -> SimpleNamespace:
+    """Import letterboxdpy the first time it's needed.
+
+    It pulls in bs4, lxml and requests, which is a good chunk of startup for
+    a bot that might not scrape anything for a while (or ever, in discord
+    mode).
+    """
+    from letterboxdpy import movie, search, user  # type: ignore
+    from letterboxdpy.core import exceptions  # type: ignore
+    from letterboxdpy.core.scraper import Scraper  # type: ignore
+    from letterboxdpy.pages import user_films  # type: ignore
+
+    # letterboxdpy's own page loads go through the response cache too
+    Scraper.set_instance(CachingSession(Scraper.instance(), http_cache))
+
+    return SimpleNamespace(
+        movie=movie,
+        search=search,
+        user=user,
+        exceptions=exceptions,
+        user_films=user_films,
+    )
+
+
+def get_user(username: str) -> "lb_user.User":
+    lb = load_letterboxdpy()
+    scrape_executor.throttle()
+    return lb.user.User(username=username)
+
+
+def get_movie(slug: str) -> "lb_movie.Movie":
+    lb = load_letterboxdpy()
+    scrape_executor.throttle()
+    return lb.movie.Movie(slug)
+
+
+async def get_review_text(entry_link: str) -> str | None:
+    from bs4 import Tag
+
+    review_dom = await letterboxd_http.fetch_dom(entry_link)
+    review_text_elem = review_dom.find("div", class_="js-review-body")
+
+    if not isinstance(review_text_elem, Tag):
+        return None
+
+    # replace <br> with newline characters
+    for br in review_text_elem.find_all("br"):
+        br.replace_with("\n")
+
+    paragraphs = review_text_elem.find_all("p")
+    return "\n\n".join(p.get_text().strip() for p in paragraphs).strip()
+
+
+async def iter_user_films(
+    username: str, start_page: int = 1
+) -> AsyncIterator[tuple[int, dict[str, dict]]]:
+    """Yields (page number, films on it) for a user's film list, a page at a time.
+
+    Nothing is kept between pages, so a 10k film list costs no more memory
+    than a short one.
+    """
+    lb = load_letterboxdpy()
+
+    page = start_page
+    while True:
+        dom = await letterboxd_http.fetch_dom(f"/{username}/films/page/{page}/")
+        page_films = lb.user_films.extract_movies_from_user_watched(dom)
+        yield page, page_films
+
+        if len(page_films) < FILMS_PER_PAGE:
+            return
+
+        page += 1
+
+
+async def get_recent_liked_films(username: str) -> dict[str, dict]:
+    # newest likes first, one page is plenty between syncs
+    lb = load_letterboxdpy()
+
+    dom = await letterboxd_http.fetch_dom(f"/{username}/likes/films/")
+    return lb.user_films.extract_movies_from_user_watched(dom)
+
+
+def describe_profile_error(e: BaseException) -> str | None:
+    """Why a scrape failed, if it's down to the profile itself.
+
+    None means it could be temporary (timeouts, rate limits, letterboxd being
+    down) and shouldn't count against the user.
+    """
+    lb = load_letterboxdpy()
+
+    if isinstance(e, lb.exceptions.ResourceNotFoundError) or (
+        isinstance(e, HTTPError) and e.status == 404
+    ):
+        return "profile not found"
+
+    # a bare 403 from our own fetcher is more likely a block than the profile
+    if isinstance(e, lb.exceptions.PrivateRouteError):
+        return "profile is private"
+
+    return None
+
+
+@functools.lru_cache(maxsize=1024)
+def search_film_slug(query: str) -> str | None:
+    lb = load_letterboxdpy()
+    scrape_executor.throttle()
+    results = lb.search.Search(quote(query), "films").get_results(max=1)["results"]
+    return results[0]["slug"] if results else None
+
+
+# how many recent diary entry ids are remembered past the highest one
+RECENT_DIARY_IDS = 100
+
+DIARY_TABLE = re.compile(r'<table[^>]*id="diary-table".*?</table>', re.DOTALL)
+
+
+async def get_diary_page_hash(username: str) -> str:
+    """Fingerprint the first diary page without parsing it.
+
+    Only the diary table is hashed, so unrelated bits of the page changing
+    don't count. Same url as letterboxdpy, so its read comes from the cache.
+    """
+    page = await letterboxd_http.fetch_page(f"/{username}/films/diary/page/1/")
+
+    match = DIARY_TABLE.search(page.text)
+    if not match:
+        return page.entry.body_hash
+
+    return hashlib.sha256(match.group().encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class DiaryWatermark:
+    """Diary entries already seen for a user, by letterboxd viewing id.
+
+    Viewing ids only go up, so anything above `last_entry_id` was logged since
+    the last check, even if it's dated further back.
+    """
+
+    last_entry_id: int
+    recent_entry_ids: frozenset[int]
+    # first diary page fingerprint when this was taken, see get_diary_page_hash
+    page_hash: str | None = None
+    # diary page to carry on from when a backlog was too long for one check
+    catchup_page: int | None = None
+
+    def is_seen(self, entry_id: int) -> bool:
+        return entry_id <= self.last_entry_id or entry_id in self.recent_entry_ids
+
+    def advance(self, entry_ids: Iterable[int]) -> "DiaryWatermark":
+        recent = sorted(self.recent_entry_ids | set(entry_ids), reverse=True)
+        return DiaryWatermark(
+            last_entry_id=max([self.last_entry_id, *recent]),
+            recent_entry_ids=frozenset(recent[:RECENT_DIARY_IDS]),
+        )
+
+    def hold(self, entry_ids: Iterable[int], next_page: int) -> "DiaryWatermark":
+        """Remember entries read part way through a backlog.
+
+        `last_entry_id` stays put, so the entries further down that haven't
+        been read yet still count as new. Everything read in the meantime is
+        kept in the recent ids, uncapped, until the backlog is done.
+        """
+        return DiaryWatermark(
+            last_entry_id=self.last_entry_id,
+            recent_entry_ids=self.recent_entry_ids | frozenset(entry_ids),
+            catchup_page=next_page,
+        )
+
+    @classmethod
+    def start(cls, entry_ids: Iterable[int]) -> "DiaryWatermark | None":
+        entry_ids = set(entry_ids)
+        if not entry_ids:
+            return None
+
+        return cls(max(entry_ids), frozenset()).advance(entry_ids)
+
+
+def get_diary(
+    user: "lb_user.User",
+    watermark: DiaryWatermark | None = None,
+    last_diary_entry: datetime.date | None = None,
+    max_pages: int | None = None,
+) -> tuple[list[dict], list[int], int | None]:
+    """Returns new diary entries (newest first), the ids of every entry read
+    and the page to carry on from if `max_pages` ran out first.
+
+    With a watermark, pages are read until one reaches an entry that's already
+    been seen. The rest of that page is still checked, so an entry backdated
+    onto it isn't missed, but no further pages are fetched. Without one, the
+    old date watermark is used, and with neither only the first page is read.
+
+    A watermark part way through a backlog reads the first page for anything
+    new, then carries on from its `catchup_page`. That first page doesn't
+    count against `max_pages`, so the backlog always moves.
+    """
     lb_diary_to_process: list[dict] = []
+    entry_ids: list[int] = []
 
-    page = 1
+    catchup_page = watermark.catchup_page if watermark else None
+    pages = (
+        itertools.chain([1], itertools.count(catchup_page))
+        if catchup_page
+        else itertools.count(1)
+    )
+
+    pages_read = 0
     while True:
+        page = next(pages)
+        if max_pages and pages_read >= max_pages:
+            return lb_diary_to_process, entry_ids, page
+        if not (catchup_page and page == 1):
+            pages_read += 1
+
+        scrape_executor.throttle()
         lb_page_diary_entries: dict[str, dict] = user.get_diary(page=page)["entries"]
         if not lb_page_diary_entries:
             # reached the end.
-            return lb_diary_to_process
+            return lb_diary_to_process, entry_ids, None
+
+        reached_seen = False
 
         for entry_key, entry in lb_page_diary_entries.items():
-            # convert date dict to date object
-            entry["date"] = datetime.date(
-                entry["date"]["year"],
-                entry["date"]["month"],
-                entry["date"]["day"],
+            # diary entries are keyed by their viewing id, letterboxdpy's "id"
+            # is the film's
+            entry["film_id"] = int(entry["id"]) if entry.get("id") else None
+            entry["id"] = int(entry_key)
+            if entry["id"] in entry_ids:
+                # pushed onto this page by something logged mid scrape
+                continue
+            entry_ids.append(entry["id"])
+
+            # convert date to a date object, newer letterboxdpy gives an iso
+            # timestamp rather than a dict
+            date = entry["date"]
+            entry["date"] = (
+                datetime.date.fromisoformat(date[:10])
+                if isinstance(date, str)
+                else datetime.date(date["year"], date["month"], date["day"])
             )
 
-            if last_diary_entry:
-                if entry["date"] <= last_diary_entry:
-                    # reached stuff we've already processed
-                    return lb_diary_to_process
+            if watermark:
+                seen = watermark.is_seen(entry["id"])
+            elif last_diary_entry:
+                seen = entry["date"] <= last_diary_entry
+            else:
+                seen = False
 
-            lb_diary_to_process.append(entry)
+            if not seen:
+                lb_diary_to_process.append(entry)
+            elif not catchup_page or (
+                watermark and entry["id"] <= watermark.last_entry_id
+            ):
+                # part way through a backlog, entries an earlier check read
+                # are skipped, but only the old watermark is the end of it
+                reached_seen = True
 
-            if not last_diary_entry:
-                # just getting the newest :)
-                return lb_diary_to_process
+        if catchup_page and page == 1:
+            # the backlog is further down, the first page was just for new ones
+            continue
 
-        page += 1
+        if reached_seen or not (watermark or last_diary_entry):
+            # reached stuff we've already processed, or just getting the newest
+            return lb_diary_to_process, entry_ids, None
@@ -0,0 +1,273 @@
+import bisect
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+
+from aiohttp import web
+
+from .. import config
+
+LabelKey = tuple[tuple[str, str], ...]
+
+
+def label_key(labels: dict[str, str]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_labels(key: LabelKey) -> str:
+    if not key:
+        return ""
+
+    def escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in key) + "}"
+
+
+class Metric:
+    """Bare bones prometheus metric, only what the bot needs."""
+
+    kind = ""
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self) -> Iterator[tuple[str, LabelKey, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, value in self.samples():
+            lines.append(f"{name}{format_labels(key)} {value:g}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self._values: dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(label_key(labels), 0)
+
+    def total(self) -> float:
+        with self._lock:
+            return sum(self._values.values())
+
+    def by_label(self, label: str) -> dict[str, float]:
+        """Totals for each value of one label."""
+        totals: dict[str, float] = {}
+        for _, key, value in self.samples():
+            name = dict(key).get(label, "")
+            totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield self.name, key, value
+
+
+class Gauge(Metric):
+    """Set directly, or read from `fn` whenever metrics are collected."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float] | None = None):
+        super().__init__(name, help)
+        self._values: dict[LabelKey, float] = {}
+        self._fn = fn
+
+    def set(self, value: float, **labels: str):
+        with self._lock:
+            self._values[label_key(labels)] = value
+
+    def get(self, **labels: str) -> float:
+        if self._fn:
+            return self._fn()
+        return self._values.get(label_key(labels), 0)
+
+    def samples(self):
+        if self._fn:
+            yield self.name, (), self._fn()
+            return
+
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield self.name, key, value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...]):
+        super().__init__(name, help)
+        self.buckets = buckets
+        # per label set: bucket counts (+inf last), sum, count
+        self._values: dict[LabelKey, tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = label_key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0, 0)
+            )
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def summary(self, **labels: str) -> tuple[int, float]:
+        """(count, sum) for one label set."""
+        _, total, count = self._values.get(label_key(labels), ([], 0.0, 0))
+        return count, total
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(c), t, n) for key, (c, t, n) in self._values.items()}
+
+        for key, (counts, total, count) in values.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                yield f"{self.name}_bucket", (*key, ("le", le)), cumulative
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, count
+
+
+registry: list[Metric] = []
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+# startup, timed from when this module was first imported, which is near
+# enough to process start
+process_started = time.monotonic()
+startup_seconds = Gauge(
+    "bot_startup_seconds",
+    "Seconds from process start until each startup stage was reached.",
+)
+
+
+def record_startup(stage: str):
+    """Note when a startup stage was first reached, later calls are ignored."""
+    if startup_seconds.get(stage=stage):
+        return
+
+    seconds = time.monotonic() - process_started
+    startup_seconds.set(seconds, stage=stage)
+    print(f"Startup: {stage} after {seconds:.2f}s")
+
+
+# loops
+loop_seconds = Histogram(
+    "bot_loop_seconds",
+    "Time taken by one run of a background loop.",
+    (1, 5, 10, 30, 60, 120, 300, 600, 900, 1800),
+)
+loop_last_seconds = Gauge(
+    "bot_loop_last_seconds", "Time taken by the latest run of a background loop."
+)
+
+
+@contextmanager
+def time_loop(loop: str) -> Iterator[None]:
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - start
+        loop_seconds.observe(elapsed, loop=loop)
+        loop_last_seconds.set(elapsed, loop=loop)
+
+
+# scraping
+scrape_user_seconds = Histogram(
+    "bot_scrape_user_seconds",
+    "Time taken to scrape one letterboxd user.",
+    (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+scrape_user_requests = Histogram(
+    "bot_scrape_user_requests",
+    "Letterboxd requests made while scraping one user.",
+    (0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+scrape_failures = Counter("bot_scrape_failures_total", "Failed per-user scrapes.")
+scrape_wait_seconds = Histogram(
+    "bot_scrape_wait_seconds",
+    "Time a letterboxd request waited on the rate limiter, by lane.",
+    (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+letterboxd_requests = Counter(
+    "bot_letterboxd_requests_total", "Requests sent to letterboxd."
+)
+http_cache_lookups = Counter(
+    "bot_http_cache_lookups_total",
+    "Letterboxd page loads by cache result (hit, not_modified, miss).",
+)
+film_cache_lookups = Counter(
+    "bot_film_cache_lookups_total",
+    "Film metadata lookups by where they were answered (memory, db, scrape).",
+)
+review_lookups = Counter(
+    "bot_review_lookups_total",
+    "Review text lookups by where they were answered (db, scrape).",
+)
+
+# database
+db_queries = Counter("bot_db_queries_total", "SQL statements executed.")
+
+# delivery
+discord_send_seconds = Histogram(
+    "bot_discord_send_seconds",
+    "Time taken to send one message of diary updates, including rate limit waits.",
+    (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+discord_sends = Counter(
+    "bot_discord_sends_total", "Diary update messages sent, by result."
+)
+outbox_pending = Gauge(
+    "bot_outbox_pending", "Diary updates waiting in the outbox, as of the last count."
+)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def serve_metrics() -> web.AppRunner | None:
+    """Serve /metrics in prometheus' text format, if METRICS_PORT is set."""
+    if not config.METRICS_PORT:
+        return None
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, config.METRICS_HOST, config.METRICS_PORT).start()
+    print(f"Serving metrics on {config.METRICS_HOST}:{config.METRICS_PORT}")
+
+    return runner
@@ -1,5 +1,12 @@
+import datetime
+
 import discord
 
 
 def escape(text: str):
     return discord.utils.escape_markdown(discord.utils.escape_mentions(text))
+
+
+def utcnow() -> datetime.datetime:
+    # naive utc, which is what the DateTime columns store
+    return datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
@@ -0,0 +1,311 @@
+import asyncio
+import datetime
+import random
+from collections import defaultdict
+from dataclasses import dataclass
+
+import discord
+from discord.ext import commands
+from discord.http import handle_message_parameters
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .. import config
+from ..database import DiaryOutbox, FollowedUser, SessionLocal
+from . import metrics
+from .misc import utcnow
+
+# discord's limits for a single message
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARS_PER_MESSAGE = 6000
+
+# set when updates are queued in this process, so delivery doesn't wait for
+# the next poll. separate worker processes are picked up by polling instead
+outbox_ready = asyncio.Event()
+
+
+@dataclass(frozen=True)
+class OutboxMessage:
+    id: int
+    follow_id: int
+    channel_id: int
+    embed: dict
+    diary_entry_date: datetime.datetime
+    batch_nonce: str | None = None
+
+
+@dataclass(frozen=True)
+class OutboxBatch:
+    """Updates for one channel that fit in a single discord message."""
+
+    channel_id: int
+    messages: list[OutboxMessage]
+
+    @property
+    def nonce(self) -> str:
+        return self.messages[0].batch_nonce or f"diary-{self.messages[0].id}"
+
+    @property
+    def stamped(self) -> bool:
+        return all(message.batch_nonce for message in self.messages)
+
+    @property
+    def embeds(self) -> list[discord.Embed]:
+        return [discord.Embed.from_dict(message.embed) for message in self.messages]
+
+
+async def get_pending_messages(limit: int) -> list[OutboxMessage]:
+    now = utcnow()
+    # a channel waiting on a retry is skipped entirely so its updates stay in order
+    backing_off = select(DiaryOutbox.channel_id).where(
+        DiaryOutbox.next_attempt_at > now
+    )
+
+    async with SessionLocal() as db:
+        rows = list(
+            await db.scalars(
+                select(DiaryOutbox)
+                .where(DiaryOutbox.channel_id.not_in(backing_off))
+                .order_by(DiaryOutbox.id)
+                .limit(limit)
+            )
+        )
+
+        # the limit can cut a batch that's already been sent in two, and the
+        # rest would go out later under a nonce discord has seen and drops.
+        # fetch the rest of any batch that was cut
+        nonces = {row.batch_nonce for row in rows if row.batch_nonce}
+        if nonces:
+            rows += await db.scalars(
+                select(DiaryOutbox)
+                .where(
+                    DiaryOutbox.batch_nonce.in_(nonces),
+                    DiaryOutbox.id > rows[-1].id,
+                )
+                .order_by(DiaryOutbox.id)
+            )
+
+        return [
+            OutboxMessage(
+                id=row.id,
+                follow_id=row.follow_id,
+                channel_id=row.channel_id,
+                embed=row.embed,
+                diary_entry_date=row.diary_entry_date,
+                batch_nonce=row.batch_nonce,
+            )
+            for row in rows
+        ]
+
+
+async def count_pending_messages() -> int:
+    async with SessionLocal() as db:
+        pending = await db.scalar(select(func.count(DiaryOutbox.id))) or 0
+
+    metrics.outbox_pending.set(pending)
+    return pending
+
+
+def batch_messages(messages: list[OutboxMessage]) -> dict[int, list[OutboxBatch]]:
+    """Group messages by channel, packing each channel's into as few sends as possible."""
+    by_channel: dict[int, list[OutboxMessage]] = defaultdict(list)
+    for message in messages:
+        by_channel[message.channel_id].append(message)
+
+    batches: dict[int, list[OutboxBatch]] = {}
+    for channel_id, channel_messages in by_channel.items():
+        batches[channel_id] = []
+        current: list[OutboxMessage] = []
+        chars = 0
+
+        for message in channel_messages:
+            if message.batch_nonce:
+                # already sent (or tried) as a batch, resend it unchanged
+                if current:
+                    batches[channel_id].append(OutboxBatch(channel_id, current))
+                    current, chars = [], 0
+                previous = batches[channel_id][-1] if batches[channel_id] else None
+                if previous and previous.messages[0].batch_nonce == message.batch_nonce:
+                    previous.messages.append(message)
+                else:
+                    batches[channel_id].append(OutboxBatch(channel_id, [message]))
+                continue
+
+            size = len(discord.Embed.from_dict(message.embed))
+            if current and (
+                len(current) == MAX_EMBEDS_PER_MESSAGE
+                or chars + size > MAX_EMBED_CHARS_PER_MESSAGE
+            ):
+                batches[channel_id].append(OutboxBatch(channel_id, current))
+                current, chars = [], 0
+
+            current.append(message)
+            chars += size
+
+        if current:
+            batches[channel_id].append(OutboxBatch(channel_id, current))
+
+    return batches
+
+
+async def stamp_batch(batch: OutboxBatch):
+    # fix the batch's rows and nonce before sending, so a retry can't pack
+    # newer updates in under a nonce discord has already seen
+    async with SessionLocal() as db:
+        await db.execute(
+            update(DiaryOutbox)
+            .where(DiaryOutbox.id.in_([message.id for message in batch.messages]))
+            .values(batch_nonce=batch.nonce)
+        )
+        await db.commit()
+
+
+async def send_batch(bot: commands.Bot, batch: OutboxBatch):
+    # discord only drops a resend with a nonce it's already seen when
+    # enforce_nonce is set, and only for a few minutes. channel.send doesn't
+    # set it, so build the request the same way and send it through the
+    # http client directly (which still handles rate limits). this covers a
+    # crash or db error between sending and deleting the rows, or a timeout
+    # after discord accepted the message. a retry after the window has passed
+    # can still post twice
+    with handle_message_parameters(embeds=batch.embeds, nonce=batch.nonce) as params:
+        payload = params.payload or {}
+        payload["enforce_nonce"] = True
+        await bot.http.send_message(
+            batch.channel_id, params=params._replace(payload=payload)
+        )
+
+
+async def finish_message(db: AsyncSession, message: OutboxMessage):
+    # the channel's watermark only moves past an entry once it's been dealt
+    # with, a crash before this just means the update is sent again
+    await db.execute(delete(DiaryOutbox).where(DiaryOutbox.id == message.id))
+    await db.execute(
+        update(FollowedUser)
+        .where(
+            FollowedUser.id == message.follow_id,
+            or_(
+                FollowedUser.last_diary_entry.is_(None),
+                FollowedUser.last_diary_entry < message.diary_entry_date,
+            ),
+        )
+        .values(last_diary_entry=message.diary_entry_date)
+    )
+
+
+async def delete_messages(messages: list[OutboxMessage]):
+    async with SessionLocal() as db:
+        for message in messages:
+            await finish_message(db, message)
+        await db.commit()
+
+
+async def record_failure(messages: list[OutboxMessage]):
+    now = utcnow()
+
+    async with SessionLocal() as db:
+        for message in messages:
+            row = await db.get(DiaryOutbox, message.id)
+            if not row:
+                continue
+
+            row.attempts += 1
+            if row.attempts >= config.OUTBOX_MAX_ATTEMPTS:
+                print(f"error: giving up on outbox message {message.id}")
+                await finish_message(db, message)
+                continue
+
+            # exponential backoff with jitter
+            delay = config.OUTBOX_RETRY_SECONDS * 2 ** (row.attempts - 1)
+            row.next_attempt_at = now + datetime.timedelta(
+                seconds=random.uniform(delay / 2, delay)
+            )
+
+        await db.commit()
+
+
+async def wait_for_outbox(timeout: float):
+    try:
+        await asyncio.wait_for(outbox_ready.wait(), timeout=timeout)
+    except TimeoutError:
+        pass
+
+    outbox_ready.clear()
+
+
+async def deliver_channel(bot: commands.Bot, batches: list[OutboxBatch]) -> int:
+    """Send one channel's batches in order. Returns how many updates were sent."""
+    channel = bot.get_channel(batches[0].channel_id)
+    if not isinstance(channel, discord.abc.Messageable):
+        # channel was deleted, or we're not in that server any more
+        await delete_messages(
+            [message for batch in batches for message in batch.messages]
+        )
+        return 0
+
+    sent = 0
+    for i, batch in enumerate(batches):
+        try:
+            if not batch.stamped:
+                await stamp_batch(batch)
+
+            # discord.py waits out the channel's rate limit bucket by itself,
+            # other channels keep sending in the meantime
+            with metrics.discord_send_seconds.time():
+                await send_batch(bot, batch)
+        except (discord.Forbidden, discord.NotFound) as e:
+            # lost access to the channel, retrying won't help
+            print(f"Failed to send message: {e}")
+            metrics.discord_sends.inc(result="dropped")
+            await delete_messages(batch.messages)
+            continue
+        except Exception as e:
+            print(f"Failed to send message: {e}")
+            metrics.discord_sends.inc(result="failed")
+            # keep the channel in order, the rest wait for this batch's retry
+            for failed in batches[i:]:
+                await record_failure(failed.messages)
+            break
+
+        metrics.discord_sends.inc(result="sent")
+        await delete_messages(batch.messages)
+        sent += len(batch.messages)
+
+    return sent
+
+
+async def deliver_outbox(bot: commands.Bot, limit: int = 500) -> int:
+    """Send pending diary updates. Only the discord-connected process runs this.
+
+    Each channel gets its own sender, so a rate limited channel doesn't hold up
+    the others. Returns how many updates were sent.
+    """
+    messages = await get_pending_messages(limit)
+    if not messages:
+        return 0
+
+    slots = asyncio.Semaphore(config.DELIVERY_CONCURRENCY)
+
+    async def deliver(batches: list[OutboxBatch]) -> int:
+        async with slots:
+            return await deliver_channel(bot, batches)
+
+    results = await asyncio.gather(
+        *(deliver(batches) for batches in batch_messages(messages).values()),
+        return_exceptions=True,
+    )
+
+    sent = 0
+    for result in results:
+        if isinstance(result, BaseException):
+            print(f"error: exception delivering updates: {result!r}")
+            continue
+        sent += result
+
+    # more waiting, go again without sleeping
+    if len(messages) >= limit:
+        outbox_ready.set()
+
+    await count_pending_messages()
+
+    return sent
@@ -0,0 +1,122 @@
+import datetime
+import random
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .. import config
+from ..database import LetterboxdUser, dialect_insert
+from .letterboxd_actions import describe_profile_error
+from .misc import utcnow
+
+# how much a new gap moves the average
+GAP_EWMA_WEIGHT = 0.3
+# poll roughly this many times per average gap between new diary entries
+POLLS_PER_GAP = 4
+# a dormant user is polled roughly this many times per idle period
+POLLS_PER_IDLE = 8
+# need this many observations before trusting time of day patterns
+MIN_ACTIVE_HOUR_SAMPLES = 5
+
+
+def next_poll_interval(
+    user: LetterboxdUser, now: datetime.datetime
+) -> datetime.timedelta:
+    """Work out how long to wait before checking a user's diary again.
+
+    Frequent loggers approach the minimum interval, dormant accounts drift
+    toward the maximum, and hours the user usually logs in are polled more.
+    """
+    min_interval = datetime.timedelta(minutes=config.DIARY_POLL_MIN_MINUTES)
+    max_interval = datetime.timedelta(minutes=config.DIARY_POLL_MAX_MINUTES)
+
+    if user.diary_gap_ewma is not None:
+        interval = datetime.timedelta(seconds=user.diary_gap_ewma / POLLS_PER_GAP)
+    else:
+        interval = datetime.timedelta(minutes=config.DIARY_POLL_DEFAULT_MINUTES)
+
+    if user.last_diary_activity:
+        idle = now - user.last_diary_activity
+        interval = max(interval, idle / POLLS_PER_IDLE)
+
+    active_hours = user.diary_active_hours or []
+    total = sum(active_hours)
+    if total >= MIN_ACTIVE_HOUR_SAMPLES:
+        # 1.0 = this hour is as active as the average hour
+        share = active_hours[now.hour] / total * 24
+        interval /= min(max(share, 0.5), 2.0)
+
+    return min(max(interval, min_interval), max_interval)
+
+
+async def record_diary_check(
+    db: AsyncSession, username: str, new_entries: int, catching_up: bool = False
+):
+    now = utcnow()
+
+    await db.execute(
+        dialect_insert(db)(LetterboxdUser)
+        .values(username=username, last_diary_activity=now)
+        .on_conflict_do_nothing()
+    )
+    user = (await db.scalars(select(LetterboxdUser).filter_by(username=username))).one()
+
+    # the first check only picks up a baseline entry, so it isn't activity
+    if new_entries and user.next_diary_check is not None:
+        if user.last_diary_activity:
+            gap = (now - user.last_diary_activity).total_seconds()
+            user.diary_gap_ewma = (
+                gap
+                if user.diary_gap_ewma is None
+                else GAP_EWMA_WEIGHT * gap + (1 - GAP_EWMA_WEIGHT) * user.diary_gap_ewma
+            )
+
+        active_hours = list(user.diary_active_hours or [0] * 24)
+        active_hours[now.hour] += 1
+        user.diary_active_hours = active_hours
+        user.last_diary_activity = now
+
+    if user.quarantined_at:
+        print(f"{username} is reachable again, resuming diary checks")
+
+    user.scrape_failures = 0
+    user.last_scrape_error = None
+    user.quarantined_at = None
+
+    # part way through a backlog, carry on at the next tick
+    user.next_diary_check = now if catching_up else now + next_poll_interval(user, now)
+    user.diary_lease_owner = None
+    user.diary_lease_expires = None
+
+
+async def record_diary_failure(db: AsyncSession, username: str, error: Exception):
+    """Back a user off after a failed diary check.
+
+    Once a profile has failed enough times in a row for reasons of its own,
+    it's quarantined: only probed every SCRAPE_QUARANTINE_PROBE_HOURS, and
+    skipped by the watch sync, until a check succeeds again.
+    """
+    now = utcnow()
+    user = (await db.scalars(select(LetterboxdUser).filter_by(username=username))).one()
+
+    user.scrape_failures = (user.scrape_failures or 0) + 1
+    reason = describe_profile_error(error)
+    user.last_scrape_error = reason or repr(error)[:200]
+
+    if reason and user.scrape_failures >= config.SCRAPE_QUARANTINE_FAILURES:
+        if not user.quarantined_at:
+            print(f"warning: quarantining {username}, {reason}")
+            user.quarantined_at = now
+
+        delay = datetime.timedelta(hours=config.SCRAPE_QUARANTINE_PROBE_HOURS)
+    else:
+        # exponential backoff with jitter
+        minutes = min(
+            config.SCRAPE_FAILURE_BACKOFF_MINUTES * 2 ** (user.scrape_failures - 1),
+            config.DIARY_POLL_MAX_MINUTES,
+        )
+        delay = datetime.timedelta(minutes=random.uniform(minutes / 2, minutes))
+
+    user.next_diary_check = now + delay
+    user.diary_lease_owner = None
+    user.diary_lease_expires = None
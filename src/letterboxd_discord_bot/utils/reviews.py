@@ -0,0 +1,26 @@
+from ..database import Review, SessionLocal, dialect_insert
+from . import metrics
+from .letterboxd_actions import get_review_text
+from .misc import utcnow
+
+
+async def get_review(entry_link: str) -> str | None:
+    """Review text for a diary entry, only ever fetched from letterboxd once."""
+    async with SessionLocal() as db:
+        review = await db.get(Review, entry_link)
+
+    if review:
+        metrics.review_lookups.inc(result="db")
+        return review.text
+
+    metrics.review_lookups.inc(result="scrape")
+    text = await get_review_text(entry_link)
+
+    async with SessionLocal() as db:
+        stmt = dialect_insert(db)(Review).values(
+            entry_link=entry_link, text=text, fetched_at=utcnow()
+        )
+        await db.execute(stmt.on_conflict_do_nothing())
+        await db.commit()
+
+    return text
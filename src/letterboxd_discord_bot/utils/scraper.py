@@ -0,0 +1,306 @@
+import asyncio
+import contextvars
+import enum
+import threading
+import time
+from collections import Counter, OrderedDict
+from collections.abc import AsyncIterator, Awaitable, Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import TypeVar
+
+from .. import config
+from . import metrics
+
+R = TypeVar("R")
+
+
+class Lane(enum.IntEnum):
+    """Scrape priority, lower goes first."""
+
+    INTERACTIVE = 0  # slash commands someone is waiting on
+    DIARY = 1
+    SYNC = 2  # bulk watch syncs
+
+
+# letterboxd requests made by the per-user job running in this context
+_job_requests: contextvars.ContextVar[list[int] | None] = contextvars.ContextVar(
+    "job_requests", default=None
+)
+# whose behalf requests in this context are made on
+_lane: contextvars.ContextVar[Lane] = contextvars.ContextVar("lane", default=Lane.DIARY)
+
+# how quickly the lane shares RateLimiter balances on forget older requests
+SHARE_HALF_LIFE_SECONDS = 30
+# how often a waiter checks back while another lane has its turn
+WAITER_POLL_SECONDS = 0.02
+
+
+def set_lane(lane: Lane):
+    """Scrape on behalf of `lane` for the rest of the current task."""
+    _lane.set(lane)
+
+
+def current_lane() -> Lane:
+    return _lane.get()
+
+
+# how many users' latest scrape timings are kept for /botstats
+USER_TIMINGS_KEPT = 1000
+
+
+def count_request():
+    """Call right before sending a request to letterboxd (not on cache hits)."""
+    metrics.letterboxd_requests.inc()
+
+    requests = _job_requests.get()
+    if requests is not None:
+        requests[0] += 1
+
+
+@dataclass(frozen=True)
+class UserTiming:
+    task: str
+    username: str
+    seconds: float
+    requests: int
+
+
+class RateLimiter:
+    """Thread-safe token bucket shared by every scrape worker.
+
+    When callers are queued, tokens go to the highest priority lane waiting,
+    so a command never queues behind a sync that's mid way through thousands
+    of pages. A lower lane that's had less than its `reserved` share of
+    recent requests goes first though, so background work slows down under
+    load but never stops.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: float,
+        burst: int | None = None,
+        reserved: dict[Lane, float] | None = None,
+    ):
+        self.rate = requests_per_second
+        self.capacity = burst or max(1, int(requests_per_second))
+        self.reserved = reserved or {}
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._waiting: Counter[Lane] = Counter()
+        # tokens handed out per lane, decaying over time
+        self._granted = {lane: 0.0 for lane in Lane}
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+
+        decay = 0.5 ** (elapsed / SHARE_HALF_LIFE_SECONDS)
+        for lane in self._granted:
+            self._granted[lane] *= decay
+
+    def _next_lane(self) -> Lane:
+        waiting = sorted(lane for lane, count in self._waiting.items() if count)
+        total = sum(self._granted.values())
+
+        if total:
+            for lane in waiting:
+                if self._granted[lane] / total < self.reserved.get(lane, 0):
+                    return lane
+
+        return waiting[0]
+
+    def _try_take(self, lane: Lane) -> float:
+        """Take a token if it's `lane`'s turn, otherwise how long to wait."""
+        with self._lock:
+            self._refill()
+
+            if self._tokens < 1:
+                return max(WAITER_POLL_SECONDS, (1 - self._tokens) / self.rate)
+            if self._next_lane() != lane:
+                return WAITER_POLL_SECONDS
+
+            self._tokens -= 1
+            self._granted[lane] += 1
+            return 0
+
+    @contextmanager
+    def _queued(self, lane: Lane) -> Iterator[None]:
+        with self._lock:
+            self._waiting[lane] += 1
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._waiting[lane] -= 1
+            metrics.scrape_wait_seconds.observe(
+                time.monotonic() - start, lane=lane.name.lower()
+            )
+
+    def acquire(self, lane: Lane | None = None):
+        lane = current_lane() if lane is None else lane
+        with self._queued(lane):
+            while wait := self._try_take(lane):
+                time.sleep(wait)
+
+    async def acquire_async(self, lane: Lane | None = None):
+        lane = current_lane() if lane is None else lane
+        with self._queued(lane):
+            while wait := self._try_take(lane):
+                await asyncio.sleep(wait)
+
+
+class ScrapeExecutor:
+    """Bounded pool for letterboxd scrapes.
+
+    Blocking letterboxdpy calls run on the thread pool, async fetches share the
+    same rate limiter. Every request toward letterboxd.com should go through
+    it so the whole bot stays within one global requests-per-second budget.
+    Commands get a few threads of their own, so they don't queue behind
+    background jobs for one either.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        requests_per_second: float,
+        user_timeout: float | None = None,
+        interactive_workers: int = 2,
+        reserved: dict[Lane, float] | None = None,
+    ):
+        self.rate_limiter = RateLimiter(requests_per_second, reserved=reserved)
+        self.max_workers = max_workers
+        self.user_timeout = user_timeout
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="scrape"
+        )
+        self._interactive_pool = ThreadPoolExecutor(
+            max_workers=interactive_workers, thread_name_prefix="scrape-interactive"
+        )
+        # per lane, so a diary check doesn't queue behind a long sync for a
+        # slot. the rate limiter still keeps the total in check
+        self._user_slots = {lane: asyncio.Semaphore(max_workers) for lane in Lane}
+        self.user_timings: OrderedDict[tuple[str, str], UserTiming] = OrderedDict()
+
+    def throttle(self):
+        self.rate_limiter.acquire()
+
+    async def run(self, fn: Callable[[], R]) -> R:
+        loop = asyncio.get_running_loop()
+        pool = (
+            self._interactive_pool if current_lane() == Lane.INTERACTIVE else self._pool
+        )
+        # carry the context over so requests still count toward the current
+        # job, in its lane
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(pool, context.run, fn)
+
+    def _record_timing(self, timing: UserTiming):
+        metrics.scrape_user_seconds.observe(timing.seconds, task=timing.task)
+        metrics.scrape_user_requests.observe(timing.requests, task=timing.task)
+
+        key = (timing.task, timing.username)
+        self.user_timings.pop(key, None)
+        self.user_timings[key] = timing
+        while len(self.user_timings) > USER_TIMINGS_KEPT:
+            self.user_timings.popitem(last=False)
+
+    def slowest_users(self, count: int) -> list[UserTiming]:
+        return sorted(
+            self.user_timings.values(), key=lambda timing: timing.seconds, reverse=True
+        )[:count]
+
+    async def run_per_user(
+        self,
+        jobs: dict[str, Callable[[], Awaitable[R]]],
+        task: str = "scrape",
+        lane: Lane = Lane.SYNC,
+    ) -> dict[str, R]:
+        """Run one job per letterboxd user and wait for all of them."""
+        return {
+            username: result
+            async for username, result in self.stream_per_user(
+                jobs, task=task, lane=lane
+            )
+        }
+
+    async def stream_per_user(
+        self,
+        jobs: dict[str, Callable[[], Awaitable[R]]],
+        max_buffered: int = 0,
+        on_error: Callable[[str, Exception], None] | None = None,
+        task: str = "scrape",
+        lane: Lane = Lane.SYNC,
+    ) -> AsyncIterator[tuple[str, R]]:
+        """Run one job per letterboxd user, at most `max_workers` per lane at a time.
+
+        Results are yielded as soon as each job finishes. Once `max_buffered`
+        results are waiting on the consumer, finished jobs hold their slot until
+        it catches up. A user whose job raises or times out is logged, passed to
+        `on_error` and left out, everyone else carries on. Timings are
+        recorded per user under `task`, requests are made in `lane`.
+        """
+        pending = iter(jobs.items())
+        results: asyncio.Queue[tuple[str, R] | None] = asyncio.Queue(
+            maxsize=max_buffered or self.max_workers
+        )
+
+        async def run_jobs():
+            set_lane(lane)
+
+            # workers share one iterator, so each job is only picked up once
+            for username, job in pending:
+                async with self._user_slots[lane]:
+                    requests = [0]
+                    _job_requests.set(requests)
+                    start = time.monotonic()
+
+                    try:
+                        result = await asyncio.wait_for(
+                            job(), timeout=self.user_timeout
+                        )
+                    except Exception as e:
+                        print(f"error: scraping {username} failed: {e!r}")
+                        metrics.scrape_failures.inc(task=task)
+                        if on_error:
+                            on_error(username, e)
+                        await results.put(None)
+                        continue
+                    finally:
+                        self._record_timing(
+                            UserTiming(
+                                task, username, time.monotonic() - start, requests[0]
+                            )
+                        )
+
+                    await results.put((username, result))
+
+        workers = [
+            asyncio.create_task(run_jobs())
+            for _ in range(min(self.max_workers, len(jobs)))
+        ]
+
+        try:
+            for _ in range(len(jobs)):
+                item = await results.get()
+                if item is not None:
+                    yield item
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+
+scrape_executor = ScrapeExecutor(
+    config.SCRAPE_CONCURRENCY,
+    config.SCRAPE_REQUESTS_PER_SECOND,
+    config.SCRAPE_USER_TIMEOUT,
+    config.SCRAPE_INTERACTIVE_THREADS,
+    {Lane.DIARY: config.SCRAPE_DIARY_SHARE, Lane.SYNC: config.SCRAPE_SYNC_SHARE},
+)
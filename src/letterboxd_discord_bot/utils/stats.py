@@ -0,0 +1,276 @@
+import datetime
+from collections import Counter
+from dataclasses import dataclass
+
+from sqlalchemy import case, delete, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..database import (
+    ChannelFilmStats,
+    DiaryMonth,
+    FollowedUser,
+    LetterboxdUser,
+    MovieWatch,
+    SessionLocal,
+    dialect_insert,
+)
+
+# (rating, liked) of one watch as far as the totals care, None if not watched
+WatchState = tuple[int | None, bool | None] | None
+
+TOTAL_COLUMNS = ["watch_count", "rating_sum", "rating_count", "like_count"]
+STATS_BATCH_SIZE = 1000
+
+# films need this many ratings in a channel to make /top, so one 5 star
+# rating doesn't win
+TOP_MIN_RATINGS = 3
+
+
+def month_start(date: datetime.date) -> datetime.datetime:
+    return datetime.datetime(date.year, date.month, 1)
+
+
+def watch_delta(movie_id: int, old: WatchState, new: WatchState) -> dict | None:
+    old_rating, old_liked = old or (None, None)
+    new_rating, new_liked = new or (None, None)
+
+    delta = {
+        "watch_count": (new is not None) - (old is not None),
+        "rating_sum": (new_rating or 0) - (old_rating or 0),
+        "rating_count": (new_rating is not None) - (old_rating is not None),
+        "like_count": bool(new_liked) - bool(old_liked),
+    }
+    if not any(delta.values()):
+        return None
+
+    return {"movie_id": movie_id, **delta}
+
+
+async def lock_user_watches(db: AsyncSession, user_id: int):
+    """Lock a user's row until the caller's transaction ends.
+
+    Take this before reading the old watches that apply_watch_changes gets
+    deltas from, so a likes sync, a full sync page and a diary check for the
+    same user can't both count the same change. sqlite ignores it, it only
+    has one writer anyway.
+    """
+    await db.execute(
+        select(LetterboxdUser.id).where(LetterboxdUser.id == user_id).with_for_update()
+    )
+
+
+async def apply_watch_changes(
+    db: AsyncSession, user_id: int, changes: dict[int, tuple[WatchState, WatchState]]
+):
+    """Add a user's watch changes to the totals of every channel following them.
+
+    `changes` is film id -> (old, new). Runs in the caller's transaction.
+    """
+    deltas = [
+        delta
+        for movie_id, (old, new) in changes.items()
+        if (delta := watch_delta(movie_id, old, new))
+    ]
+    if not deltas:
+        return
+
+    channels = await db.execute(
+        select(FollowedUser.guild_id, FollowedUser.channel_id).filter_by(
+            letterboxd_user_id=user_id
+        )
+    )
+    await add_channel_deltas(db, list(channels.tuples()), deltas)
+
+
+async def apply_follow_change(
+    db: AsyncSession, guild_id: int, channel_id: int, user_id: int, followed: bool
+):
+    """Add a user's watches to a channel's totals on a follow, or take them
+    away on an unfollow. Runs in the caller's transaction.
+    """
+    await lock_user_watches(db, user_id)
+
+    watches = await db.execute(
+        select(MovieWatch.movie_id, MovieWatch.rating, MovieWatch.liked).filter_by(
+            letterboxd_user_id=user_id
+        )
+    )
+    deltas = [
+        delta
+        for movie_id, rating, liked in watches
+        if (
+            delta := watch_delta(movie_id, None, (rating, liked))
+            if followed
+            else watch_delta(movie_id, (rating, liked), None)
+        )
+    ]
+    await add_channel_deltas(db, [(guild_id, channel_id)], deltas)
+
+    if not followed:
+        # films nobody left in the channel has watched
+        await db.execute(
+            delete(ChannelFilmStats).where(
+                ChannelFilmStats.guild_id == guild_id,
+                ChannelFilmStats.channel_id == channel_id,
+                ChannelFilmStats.watch_count <= 0,
+                ChannelFilmStats.movie_id.in_(
+                    select(MovieWatch.movie_id).filter_by(letterboxd_user_id=user_id)
+                ),
+            )
+        )
+
+
+async def add_channel_deltas(
+    db: AsyncSession, channels: list[tuple[int, int]], deltas: list[dict]
+):
+    rows = [
+        {"guild_id": guild_id, "channel_id": channel_id, **delta}
+        for guild_id, channel_id in channels
+        for delta in deltas
+    ]
+
+    upsert = dialect_insert(db)
+    for i in range(0, len(rows), STATS_BATCH_SIZE):
+        stmt = upsert(ChannelFilmStats).values(rows[i : i + STATS_BATCH_SIZE])
+        await db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["guild_id", "channel_id", "movie_id"],
+                set_={
+                    column: getattr(ChannelFilmStats, column)
+                    + getattr(stmt.excluded, column)
+                    for column in TOTAL_COLUMNS
+                },
+            )
+        )
+
+
+async def record_diary_months(
+    db: AsyncSession, user_id: int, dates: list[datetime.date]
+):
+    if not dates:
+        return
+
+    stmt = dialect_insert(db)(DiaryMonth).values(
+        [
+            {"letterboxd_user_id": user_id, "month": month, "entries": entries}
+            for month, entries in Counter(map(month_start, dates)).items()
+        ]
+    )
+    await db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["letterboxd_user_id", "month"],
+            set_={"entries": DiaryMonth.entries + stmt.excluded.entries},
+        )
+    )
+
+
+async def get_top_films(
+    guild_id: int, channel_id: int, limit: int
+) -> list[ChannelFilmStats]:
+    async with SessionLocal() as db:
+        followers = await db.scalar(
+            select(func.count())
+            .select_from(FollowedUser)
+            .filter_by(guild_id=guild_id, channel_id=channel_id)
+        )
+        min_ratings = max(1, min(TOP_MIN_RATINGS, followers or 0))
+
+        average = ChannelFilmStats.rating_sum * 1.0 / ChannelFilmStats.rating_count
+        return list(
+            await db.scalars(
+                select(ChannelFilmStats)
+                .where(
+                    ChannelFilmStats.guild_id == guild_id,
+                    ChannelFilmStats.channel_id == channel_id,
+                    ChannelFilmStats.rating_count >= min_ratings,
+                )
+                .order_by(average.desc(), ChannelFilmStats.rating_count.desc())
+                .limit(limit)
+            )
+        )
+
+
+async def get_leaderboard(
+    guild_id: int, channel_id: int, month: datetime.datetime, limit: int
+) -> list[tuple[str, int]]:
+    """(username, diary entries) for the channel's most active users in a month."""
+    async with SessionLocal() as db:
+        rows = await db.execute(
+            select(LetterboxdUser.username, DiaryMonth.entries)
+            .join(
+                FollowedUser,
+                FollowedUser.letterboxd_user_id == DiaryMonth.letterboxd_user_id,
+            )
+            .join(LetterboxdUser, LetterboxdUser.id == DiaryMonth.letterboxd_user_id)
+            .where(
+                FollowedUser.guild_id == guild_id,
+                FollowedUser.channel_id == channel_id,
+                DiaryMonth.month == month,
+                DiaryMonth.entries > 0,
+            )
+            .order_by(DiaryMonth.entries.desc(), LetterboxdUser.username)
+            .limit(limit)
+        )
+        return [(username, entries) for username, entries in rows]
+
+
+@dataclass(frozen=True)
+class UserStats:
+    username: str
+    watched: int
+    rated: int
+    average_rating: float | None  # out of 10
+    liked: int
+    this_month: int  # diary entries
+    this_year: int
+
+
+async def get_user_stats(
+    guild_id: int, channel_id: int, username: str, today: datetime.date
+) -> UserStats | None:
+    """None if the user isn't followed in the channel."""
+    async with SessionLocal() as db:
+        user_id = await db.scalar(
+            select(LetterboxdUser.id)
+            .join(FollowedUser, FollowedUser.letterboxd_user_id == LetterboxdUser.id)
+            .where(
+                FollowedUser.guild_id == guild_id,
+                FollowedUser.channel_id == channel_id,
+                LetterboxdUser.username == username,
+            )
+        )
+        if user_id is None:
+            return None
+
+        # one user's watches are a range of the primary key
+        watched, rated, average_rating, liked = (
+            await db.execute(
+                select(
+                    func.count(),
+                    func.count(MovieWatch.rating),
+                    func.avg(MovieWatch.rating),
+                    func.sum(case((MovieWatch.liked.is_(True), 1), else_=0)),
+                ).where(MovieWatch.letterboxd_user_id == user_id)
+            )
+        ).one()
+
+        months = dict(
+            (
+                await db.execute(
+                    select(DiaryMonth.month, DiaryMonth.entries).where(
+                        DiaryMonth.letterboxd_user_id == user_id,
+                        DiaryMonth.month >= datetime.datetime(today.year, 1, 1),
+                    )
+                )
+            ).all()
+        )
+
+    return UserStats(
+        username=username,
+        watched=watched,
+        rated=rated,
+        average_rating=float(average_rating) if average_rating is not None else None,
+        liked=liked or 0,
+        this_month=months.get(month_start(today), 0),
+        this_year=sum(months.values()),
+    )
@@ -0,0 +1,252 @@
+import datetime
+import math
+import threading
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+
+from sqlalchemy import select
+
+from .. import config
+from ..database import FollowedUser, LetterboxdUser, MovieWatch, SessionLocal
+
+# a like counts as this many stars above the user's average
+LIKE_WEIGHT = 1.0
+# similarity from fewer films in common than this is scaled down, two people
+# agreeing on three films doesn't say much
+FULL_OVERLAP = 20
+# most similar users that recommendations are drawn from
+RECOMMEND_NEIGHBOURS = 20
+# how many of them have to have seen a film for it to be recommended
+RECOMMEND_MIN_SUPPORT = 2
+
+
+@dataclass(frozen=True)
+class TasteProfile:
+    """A user's watches as a sparse vector, centred on their own average rating.
+
+    Centring means a harsh rater and a generous one can still agree.
+    """
+
+    letterboxd_user_id: int
+    username: str
+    version: datetime.datetime | None  # watches_changed_at when built
+    scores: dict[int, float]  # film id -> stars above their average, plus likes
+    watched: frozenset[int]
+
+    @classmethod
+    def from_watches(
+        cls,
+        letterboxd_user_id: int,
+        username: str,
+        version: datetime.datetime | None,
+        watches: list[tuple[int, int | None, bool | None]],
+    ) -> "TasteProfile":
+        ratings = [rating for _, rating, _ in watches if rating is not None]
+        average = sum(ratings) / len(ratings) if ratings else 0
+
+        scores = {}
+        for movie_id, rating, liked in watches:
+            # ratings are out of 10, scores are in stars
+            score = (rating - average) / 2 if rating is not None else 0
+            if liked:
+                score += LIKE_WEIGHT
+            if score:
+                scores[movie_id] = score
+
+        return cls(
+            letterboxd_user_id=letterboxd_user_id,
+            username=username,
+            version=version,
+            scores=scores,
+            watched=frozenset(movie_id for movie_id, _, _ in watches),
+        )
+
+    def similarity(self, other: "TasteProfile") -> float:
+        """Cosine of the scores both have for the same films, -1 to 1."""
+        shared = self.scores.keys() & other.scores.keys()
+        if not shared:
+            return 0
+
+        dot = self_norm = other_norm = 0.0
+        for movie_id in shared:
+            a, b = self.scores[movie_id], other.scores[movie_id]
+            dot += a * b
+            self_norm += a * a
+            other_norm += b * b
+
+        confidence = min(len(shared), FULL_OVERLAP) / FULL_OVERLAP
+        return confidence * dot / math.sqrt(self_norm * other_norm)
+
+
+@dataclass(frozen=True)
+class Compatibility:
+    similarity: float
+    shared: int  # films both have watched
+    both_loved: list[int]  # film ids, best first
+    disagreed: list[int]  # film ids, biggest split first
+
+    @property
+    def percent(self) -> int:
+        return round((self.similarity + 1) * 50)
+
+
+@dataclass(frozen=True)
+class Recommendation:
+    movie_id: int
+    score: float  # predicted stars above the user's average
+    support: int  # similar users who have seen it
+
+
+def compare(a: TasteProfile, b: TasteProfile, limit: int = 3) -> Compatibility:
+    shared_scores = [
+        (movie_id, a.scores.get(movie_id, 0), b.scores.get(movie_id, 0))
+        for movie_id in a.watched & b.watched
+    ]
+
+    both_loved = sorted(
+        (item for item in shared_scores if item[1] > 0 and item[2] > 0),
+        key=lambda item: -min(item[1], item[2]),
+    )
+    disagreed = sorted(
+        (item for item in shared_scores if item[1] * item[2] < 0),
+        key=lambda item: -abs(item[1] - item[2]),
+    )
+
+    return Compatibility(
+        similarity=a.similarity(b),
+        shared=len(shared_scores),
+        both_loved=[movie_id for movie_id, _, _ in both_loved[:limit]],
+        disagreed=[movie_id for movie_id, _, _ in disagreed[:limit]],
+    )
+
+
+def most_similar(
+    profile: TasteProfile, others: list[TasteProfile], limit: int
+) -> list[tuple[TasteProfile, float]]:
+    similarities = [
+        (other, profile.similarity(other))
+        for other in others
+        if other.letterboxd_user_id != profile.letterboxd_user_id
+    ]
+    similarities.sort(key=lambda item: -item[1])
+    return similarities[:limit]
+
+
+def recommend_films(
+    profile: TasteProfile, others: list[TasteProfile], limit: int
+) -> list[Recommendation]:
+    """Films the user hasn't seen, scored by how much similar users liked them."""
+    neighbours = [
+        (other, similarity)
+        for other, similarity in most_similar(profile, others, RECOMMEND_NEIGHBOURS)
+        if similarity > 0
+    ]
+
+    totals: dict[int, float] = defaultdict(float)
+    weights: dict[int, float] = defaultdict(float)
+    support: dict[int, int] = defaultdict(int)
+
+    for other, similarity in neighbours:
+        for movie_id in other.watched - profile.watched:
+            totals[movie_id] += similarity * other.scores.get(movie_id, 0)
+            weights[movie_id] += similarity
+            support[movie_id] += 1
+
+    recommendations = [
+        Recommendation(movie_id, totals[movie_id] / weights[movie_id], count)
+        for movie_id, count in support.items()
+        if count >= RECOMMEND_MIN_SUPPORT and totals[movie_id] > 0
+    ]
+    recommendations.sort(key=lambda item: (-item.score, -item.support))
+    return recommendations[:limit]
+
+
+class TasteIndex:
+    """Taste profiles of followed users, rebuilt only when their watches change.
+
+    Kept per user rather than per channel, so a user followed in several
+    channels is only built once. Every lookup checks watches_changed_at, so
+    syncs in other processes are picked up too.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._profiles: OrderedDict[int, TasteProfile] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached(
+        self, user_id: int, version: datetime.datetime | None
+    ) -> TasteProfile | None:
+        with self._lock:
+            profile = self._profiles.get(user_id)
+            if not profile or profile.version != version:
+                return None
+
+            self._profiles.move_to_end(user_id)
+            return profile
+
+    def _remember(self, profile: TasteProfile):
+        with self._lock:
+            self._profiles[profile.letterboxd_user_id] = profile
+            self._profiles.move_to_end(profile.letterboxd_user_id)
+
+            while len(self._profiles) > self.max_size:
+                self._profiles.popitem(last=False)
+
+    async def channel_profiles(
+        self, guild_id: int, channel_id: int
+    ) -> dict[str, TasteProfile]:
+        """Profiles of everyone followed in a channel, by username."""
+        profiles: dict[str, TasteProfile] = {}
+        stale: dict[int, tuple[str, datetime.datetime | None]] = {}
+
+        async with SessionLocal() as db:
+            users = await db.execute(
+                select(
+                    LetterboxdUser.id,
+                    LetterboxdUser.username,
+                    LetterboxdUser.watches_changed_at,
+                )
+                .join(
+                    FollowedUser, FollowedUser.letterboxd_user_id == LetterboxdUser.id
+                )
+                .where(
+                    FollowedUser.guild_id == guild_id,
+                    FollowedUser.channel_id == channel_id,
+                )
+            )
+
+            for user_id, username, version in users:
+                profile = self._cached(user_id, version)
+                if profile:
+                    profiles[username] = profile
+                else:
+                    stale[user_id] = (username, version)
+
+            if not stale:
+                return profiles
+
+            watches: dict[int, list[tuple[int, int | None, bool | None]]] = {
+                user_id: [] for user_id in stale
+            }
+            for user_id, movie_id, rating, liked in await db.execute(
+                select(
+                    MovieWatch.letterboxd_user_id,
+                    MovieWatch.movie_id,
+                    MovieWatch.rating,
+                    MovieWatch.liked,
+                ).where(MovieWatch.letterboxd_user_id.in_(stale))
+            ):
+                watches[user_id].append((movie_id, rating, liked))
+
+        for user_id, (username, version) in stale.items():
+            profile = TasteProfile.from_watches(
+                user_id, username, version, watches[user_id]
+            )
+            self._remember(profile)
+            profiles[username] = profile
+
+        return profiles
+
+
+taste_index = TasteIndex(config.TASTE_CACHE_SIZE)
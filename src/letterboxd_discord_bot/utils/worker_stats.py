@@ -0,0 +1,120 @@
+import datetime
+from dataclasses import asdict, dataclass, field
+
+from sqlalchemy import delete, select
+
+from .. import config
+from ..database import SessionLocal, WorkerStats, dialect_insert
+from . import metrics
+from .leases import WORKER_ID
+from .misc import utcnow
+from .scraper import UserTiming, scrape_executor
+
+SCRAPE_LOOPS = ("diary check", "watch sync")
+
+# a worker reports after every loop run, one that's been quiet this long has
+# stopped (each restart reports under a new id)
+STALE_AFTER = datetime.timedelta(minutes=30)
+
+
+@dataclass
+class ScrapeStats:
+    """Scraping numbers summed over every process that scrapes."""
+
+    processes: int = 0
+    # loop -> (runs, total seconds, seconds the latest run took)
+    loops: dict[str, tuple[int, float, float]] = field(default_factory=dict)
+    letterboxd_requests: float = 0
+    scrape_failures: float = 0
+    # cache -> result -> lookups
+    lookups: dict[str, dict[str, float]] = field(default_factory=dict)
+    slowest: list[UserTiming] = field(default_factory=list)
+
+
+def local_report() -> dict:
+    """This process' scraping numbers, as stored in worker_stats."""
+    loops = {}
+    for loop in SCRAPE_LOOPS:
+        runs, total = metrics.loop_seconds.summary(loop=loop)
+        loops[loop] = [runs, total, metrics.loop_last_seconds.get(loop=loop)]
+
+    return {
+        "loops": loops,
+        "letterboxd_requests": metrics.letterboxd_requests.total(),
+        "scrape_failures": metrics.scrape_failures.total(),
+        "lookups": {
+            "page": metrics.http_cache_lookups.by_label("result"),
+            "film": metrics.film_cache_lookups.by_label("result"),
+            "review": metrics.review_lookups.by_label("result"),
+        },
+        "slowest": [asdict(timing) for timing in scrape_executor.slowest_users(5)],
+    }
+
+
+def merge_reports(reports: list[dict]) -> ScrapeStats:
+    """Sum reports, oldest first so each loop's latest run is the newest one."""
+    stats = ScrapeStats(processes=len(reports))
+
+    for report in reports:
+        for loop, (runs, total, last) in report["loops"].items():
+            old_runs, old_total, old_last = stats.loops.get(loop, (0, 0.0, 0.0))
+            stats.loops[loop] = (
+                old_runs + runs,
+                old_total + total,
+                last if runs else old_last,
+            )
+
+        stats.letterboxd_requests += report["letterboxd_requests"]
+        stats.scrape_failures += report["scrape_failures"]
+
+        for cache, results in report["lookups"].items():
+            totals = stats.lookups.setdefault(cache, {})
+            for result, count in results.items():
+                totals[result] = totals.get(result, 0) + count
+
+        stats.slowest.extend(UserTiming(**timing) for timing in report["slowest"])
+
+    stats.slowest.sort(key=lambda timing: timing.seconds, reverse=True)
+    del stats.slowest[5:]
+
+    return stats
+
+
+async def report_worker_stats():
+    """Store this worker's numbers so /botstats in the discord process sees them."""
+    now = utcnow()
+
+    async with SessionLocal() as db:
+        values = {"worker_id": WORKER_ID, "stats": local_report(), "updated_at": now}
+        stmt = dialect_insert(db)(WorkerStats).values(values)
+        await db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["worker_id"],
+                set_={k: v for k, v in values.items() if k != "worker_id"},
+            )
+        )
+        await db.execute(
+            delete(WorkerStats).where(WorkerStats.updated_at < now - STALE_AFTER)
+        )
+        await db.commit()
+
+
+async def get_scrape_stats() -> ScrapeStats:
+    """Scraping numbers of every running worker, and this process if it scrapes."""
+    async with SessionLocal() as db:
+        reports = [
+            row.stats
+            for row in await db.scalars(
+                select(WorkerStats)
+                .where(
+                    WorkerStats.worker_id != WORKER_ID,
+                    WorkerStats.updated_at >= utcnow() - STALE_AFTER,
+                )
+                .order_by(WorkerStats.updated_at)
+            )
+        ]
+
+    if config.BOT_MODE != "discord":
+        reports.append(local_report())
+
+    return merge_reports(reports)
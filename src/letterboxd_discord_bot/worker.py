@@ -0,0 +1,46 @@
+import asyncio
+from collections.abc import Awaitable, Callable
+
+from . import config
+from .utils.db_actions import check_due_diaries, sync_due_user_films
+from .utils.http import letterboxd_http
+from .utils.leases import WORKER_ID
+from .utils.metrics import serve_metrics, time_loop
+from .utils.worker_stats import report_worker_stats
+
+WATCH_SYNC_TICK_SECONDS = 60
+
+
+async def run_forever(name: str, fn: Callable[[], Awaitable[int]], interval: float):
+    while True:
+        try:
+            with time_loop(name):
+                await fn()
+        except Exception as e:  # keep the worker alive
+            print(f"error: exception in {name}: {e!r}")
+
+        try:
+            # the discord process shows these in /botstats
+            await report_worker_stats()
+        except Exception as e:
+            print(f"error: exception reporting stats: {e!r}")
+
+        await asyncio.sleep(interval)
+
+
+async def run_worker():
+    """Scrape-only process. Updates go to the outbox for the discord process."""
+    print(f"Worker {WORKER_ID} started")
+    metrics_server = await serve_metrics()
+
+    try:
+        await asyncio.gather(
+            run_forever(
+                "diary check", check_due_diaries, config.DIARY_POLL_TICK_SECONDS
+            ),
+            run_forever("watch sync", sync_due_user_films, WATCH_SYNC_TICK_SECONDS),
+        )
+    finally:
+        await letterboxd_http.close()
+        if metrics_server:
+            await metrics_server.cleanup()